@@ -0,0 +1,90 @@
+"""
+Compare the results of two benchmark runs and flag the regressions.
+
+Usage (from the backend folder):
+    python -m benchmarks.compare baseline.json candidate.json --tolerance 0.10
+
+Exits with status 1 if the throughput dropped, or a p95/p99 latency grew, by more than the tolerance.
+"""
+
+import argparse
+import json
+import sys
+
+COMPARED_PERCENTILES = ("p50_ms", "p95_ms", "p99_ms")
+# Percentiles whose growth is a regression; p50 is only reported
+GATED_PERCENTILES = ("p95_ms", "p99_ms")
+
+
+def _change(baseline: float, candidate: float) -> float:
+    if baseline == 0:
+        return 0.0 if candidate == 0 else float("inf")
+    return (candidate - baseline) / baseline
+
+
+def compare(baseline: dict, candidate: dict, tolerance: float) -> tuple[list, list]:
+    """
+    Compare two benchmark results.
+
+    Args:
+        baseline (dict): results of the reference run
+        candidate (dict): results of the run to check
+        tolerance (float): relative change allowed before flagging a regression (e.g. 0.1 for 10%)
+
+    Returns:
+        tuple[list, list]: the lines of the report and the regressions found.
+    """
+    lines, regressions = [], []
+
+    change = _change(baseline["throughput_rps"], candidate["throughput_rps"])
+    lines.append(
+        f"throughput: {baseline['throughput_rps']} -> {candidate['throughput_rps']} req/s ({change:+.1%})"
+    )
+    if change < -tolerance:
+        regressions.append(f"throughput dropped by {-change:.1%}")
+
+    for route, candidate_stats in candidate["routes"].items():
+        baseline_stats = baseline["routes"].get(route)
+        if baseline_stats is None:
+            lines.append(f"{route}: new route")
+            continue
+        changes = []
+        for key in COMPARED_PERCENTILES:
+            change = _change(baseline_stats[key], candidate_stats[key])
+            changes.append(f"{key[:-3]} {baseline_stats[key]} -> {candidate_stats[key]} ms ({change:+.1%})")
+            if key in GATED_PERCENTILES and change > tolerance:
+                regressions.append(f"{route} {key[:-3]} grew by {change:.1%}")
+        if candidate_stats["errors"] > baseline_stats["errors"]:
+            regressions.append(
+                f"{route} errors grew from {baseline_stats['errors']} to {candidate_stats['errors']}"
+            )
+        lines.append(f"{route}: " + ", ".join(changes))
+
+    lines.append(
+        f"mongo operations: {baseline['mongo']['total']} -> {candidate['mongo']['total']}"
+    )
+    return lines, regressions
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("baseline", help="JSON results of the reference run")
+    parser.add_argument("candidate", help="JSON results of the run to check")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change allowed (default: 0.10)")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    with open(args.candidate, encoding="utf-8") as file:
+        candidate = json.load(file)
+
+    lines, regressions = compare(baseline, candidate, args.tolerance)
+    print("\n".join(lines))
+    if regressions:
+        print("\nRegressions:\n" + "\n".join(f"- {regression}" for regression in regressions))
+        sys.exit(1)
+    print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
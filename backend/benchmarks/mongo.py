@@ -0,0 +1,131 @@
+"""
+Local MongoDB stand-in for the benchmarks, counting the operations sent to the database.
+"""
+
+from collections import Counter
+from threading import Lock
+
+# Collections that must exist for the application to start (see CollectionDispatcher)
+APPLICATION_COLLECTIONS = (
+    "conversations",
+    "user_data",
+    "logs",
+    "managed_conversations",
+)
+
+
+class OperationCounter:
+    """
+    Thread-safe counter of the database operations, keyed by "<collection>.<method>".
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = Lock()
+
+    def increment(self, operation: str) -> None:
+        with self._lock:
+            self._counts[operation] += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+
+    def snapshot(self) -> dict:
+        """
+        Returns the operations counted so far.
+
+        Returns:
+            dict: Dictionary with the total number of operations and the number of operations per collection method.
+        """
+        with self._lock:
+            return {
+                "total": sum(self._counts.values()),
+                "operations": dict(sorted(self._counts.items())),
+            }
+
+
+class CountingCollection:
+    """
+    Proxy of a pymongo (or mongomock) collection counting the calls to its methods.
+    """
+
+    def __init__(self, collection, counter: OperationCounter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute) or name.startswith("_"):
+            return attribute
+        operation = f"{self._collection.name}.{name}"
+
+        def counted(*args, **kwargs):
+            self._counter.increment(operation)
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+class CountingDatabase:
+    """
+    Proxy of a pymongo (or mongomock) database whose collections count their operations.
+    """
+
+    def __init__(self, database, counter: OperationCounter):
+        self._database = database
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return CountingCollection(self._database[name], self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+class CountingClient:
+    """
+    Proxy of a pymongo (or mongomock) client whose databases count their operations.
+    """
+
+    def __init__(self, client, counter: OperationCounter):
+        self._client = client
+        self._counter = counter
+
+    def __getitem__(self, name):
+        return CountingDatabase(self._client[name], self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def create_client(mongodb_uri: str = None, db_name: str = "teachme_main"):
+    """
+    Create the client of the database used by a benchmark, with the collections of the application.
+
+    Args:
+        mongodb_uri (str, optional): URI of a real MongoDB server (e.g. a local container). Defaults to None (in-memory mongomock server).
+        db_name (str, optional): Name of the database. Defaults to 'teachme_main'.
+
+    Returns:
+        client: the MongoDB client.
+    """
+    if mongodb_uri:
+        from pymongo import MongoClient
+
+        client = MongoClient(mongodb_uri)
+    else:
+        try:
+            import mongomock
+        except ImportError as exc:
+            raise ImportError(
+                "The in-memory database needs mongomock (pip install -r benchmarks/requirements.txt), or pass --mongodb-uri."
+            ) from exc
+        client = mongomock.MongoClient()
+
+    database = client[db_name]
+    existing = set(database.list_collection_names())
+    for collection_name in APPLICATION_COLLECTIONS:
+        if collection_name not in existing:
+            database.create_collection(collection_name)
+    return client
@@ -0,0 +1,346 @@
+"""
+End-to-end HTTP load benchmark of the backend, simulating a class period.
+
+The application is booted from main.py with the fake chat model and a local MongoDB stand-in, and
+served over HTTP. Each simulated student creates a conversation, initializes it, sends several
+messages with some think time in between, lists their conversations and then ends the conversation,
+all the students at the same time as when the class ends. Finally each student polls the
+post-conversation info until the final feedback is ready.
+
+Usage (from the backend folder):
+    python -m benchmarks.run --students 30 --turns 6 --output results.json
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from threading import Barrier, BrokenBarrierError, Event, Thread
+
+import httpx
+
+from .mongo import CountingClient, OperationCounter, create_client
+from .stats import LatencyRecorder
+
+STUDENT_MESSAGES = (
+    "I think music is really important in my life because it helps me relax after school.",
+    "Yesterday I go to the cinema with my friends and we watched a comedy.",
+    "My favourite subject is history, especially the Roman empire.",
+    "I don't know, maybe I would like to travel to Japan one day.",
+    "We usually spend the summer holidays at my grandparents' house near the sea.",
+    "Honestly, I prefer reading books rather than watching television.",
+    "My aunt sings in a choir every Wednesday and sometimes I go with her.",
+    "I have been learning English for five years but speaking is still difficult for me.",
+    "Sport is good for health, I play basketball twice a week.",
+    "Technology changed completely the way we communicate with each other.",
+)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--students", type=int, default=20, help="number of simulated students")
+    parser.add_argument("--turns", type=int, default=5, help="messages sent by each student")
+    parser.add_argument("--think-time", type=float, default=0.2, help="mean pause (in seconds) between two messages of a student")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="time (in seconds) over which the students join")
+    parser.add_argument("--stream-ratio", type=float, default=0.0, help="fraction of the messages sent with streaming")
+    parser.add_argument("--no-concurrent-ends", action="store_true", help="let each student end as soon as they are done")
+    parser.add_argument("--feedback-polls", type=int, default=20, help="maximum polls of the post-conversation info per student")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="pause (in seconds) between two polls")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="mean latency (in seconds) of the fake chat model")
+    parser.add_argument("--llm-latency-stddev", type=float, default=0.02, help="standard deviation of the latency of the fake chat model")
+    parser.add_argument("--llm-latency-distribution", default="lognormal", help="latency distribution of the fake chat model")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=None, help="token rate of the fake chat model (instant if omitted)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="fraction of the fake chat model requests failing")
+    parser.add_argument("--mongodb-uri", default=None, help="URI of a disposable MongoDB server (in-memory mongomock if omitted)")
+    parser.add_argument("--sample-interval", type=float, default=0.05, help="sampling period (in seconds) of the background queue")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="maximum wait (in seconds) for the background work after the run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the traffic and of the fake chat model")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="extra environment variable of the application (repeatable)")
+    parser.add_argument("--output", default=None, help="path of the JSON results (stdout if omitted)")
+    return parser.parse_args(argv)
+
+
+def boot_app(args: argparse.Namespace, counter: OperationCounter):
+    """
+    Import main.py with the fake chat model and the MongoDB stand-in.
+
+    Returns:
+        module: the main module, with the Flask app and the chatbot manager.
+    """
+    os.environ.update(
+        {
+            "MONGODB_URI": args.mongodb_uri or "mongodb://stand-in",
+            "OPENAI_API_KEY": "benchmark",
+            "LLM_PROVIDER": "fake",
+            "FAKE_LLM_LATENCY_DISTRIBUTION": args.llm_latency_distribution,
+            "FAKE_LLM_LATENCY_MEAN": str(args.llm_latency),
+            "FAKE_LLM_LATENCY_STDDEV": str(args.llm_latency_stddev),
+            "FAKE_LLM_ERROR_RATE": str(args.llm_error_rate),
+            "FAKE_LLM_SEED": str(args.seed),
+        }
+    )
+    if args.llm_tokens_per_second:
+        os.environ["FAKE_LLM_TOKENS_PER_SECOND"] = str(args.llm_tokens_per_second)
+    for variable in args.env:
+        name, _, value = variable.partition("=")
+        os.environ[name] = value
+
+    client = CountingClient(create_client(args.mongodb_uri), counter)
+    # lib.database re-exports the Connector class under the name of its module
+    connector_module = importlib.import_module("lib.database.Connector")
+    connector_module.MongoClient = lambda key=None: client
+    import main as app_module
+
+    return app_module
+
+
+def start_server(app):
+    from werkzeug.serving import make_server
+
+    # The access log of every request would dominate the run
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    Thread(target=server.serve_forever, name="benchmark-server", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+class BackgroundSampler(Thread):
+    """
+    Periodically samples the queue of the background executor of the chatbot manager.
+    """
+
+    def __init__(self, chatbot_manager, interval: float):
+        super().__init__(name="benchmark-sampler", daemon=True)
+        self._chatbot_manager = chatbot_manager
+        self._interval = interval
+        self._stop_event = Event()
+        self.samples = []
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            stats = self._chatbot_manager.background_executor.stats()
+            self.samples.append(
+                (stats["queued"], stats["in_flight"], self._chatbot_manager.get_stats()["queued_turns"])
+            )
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {"samples": 0}
+        queued, in_flight, queued_turns = zip(*self.samples)
+        return {
+            "samples": len(self.samples),
+            "max_queued": max(queued),
+            "mean_queued": round(sum(queued) / len(queued), 3),
+            "max_in_flight": max(in_flight),
+            "mean_in_flight": round(sum(in_flight) / len(in_flight), 3),
+            "max_queued_turns": max(queued_turns),
+        }
+
+
+class Student:
+    """
+    A simulated student going through a conversation.
+    """
+
+    def __init__(self, index: int, base_url: str, http: httpx.Client, recorder: LatencyRecorder, args, end_barrier):
+        self.index = index
+        self.email = f"student{index}@benchmark.local"
+        self._base_url = base_url
+        self._http = http
+        self._recorder = recorder
+        self._args = args
+        self._end_barrier = end_barrier
+        self._rng = random.Random(args.seed * 100003 + index)
+        self.conversation_id = None
+
+    def _request(self, route: str, method: str, path: str, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            response = self._http.request(method, self._base_url + path, **kwargs)
+            response.read()
+        except httpx.HTTPError:
+            self._recorder.record(route, time.perf_counter() - started_at, True)
+            return None
+        self._recorder.record(route, time.perf_counter() - started_at, response.status_code >= 400)
+        return response
+
+    def run(self):
+        time.sleep(self._rng.uniform(0, self._args.ramp_up))
+        try:
+            self._converse()
+        finally:
+            if self._end_barrier is not None:
+                # Never leave the other students waiting for this one
+                try:
+                    self._end_barrier.wait()
+                except BrokenBarrierError:
+                    pass
+        self._end()
+
+    def _converse(self):
+        response = self._request(
+            "/create-conversation",
+            "POST",
+            "/create-conversation",
+            json={
+                "user_level": "intermediate",
+                "difficulty": self._rng.choice(["easy", "medium", "challenging"]),
+                "topic": self._rng.choice(["music", "travel", "school", "sport"]),
+                "teacher_email": "teacher@benchmark.local",
+                "student_email": self.email,
+                "time_limit": 60,
+            },
+        )
+        if response is None or response.status_code != 200:
+            return
+        self.conversation_id = response.json()["conversation_id"]
+
+        self._request(
+            "/initialize-conversation",
+            "POST",
+            "/initialize-conversation",
+            json={"conversation_id": self.conversation_id},
+        )
+        for _ in range(self._args.turns):
+            time.sleep(self._rng.expovariate(1 / self._args.think_time) if self._args.think_time > 0 else 0)
+            stream = self._rng.random() < self._args.stream_ratio
+            self._request(
+                "/user-chat-message (stream)" if stream else "/user-chat-message",
+                "POST",
+                "/user-chat-message",
+                json={
+                    "conversation_id": self.conversation_id,
+                    "sender_id": self.email,
+                    "message": self._rng.choice(STUDENT_MESSAGES),
+                    "stream": stream,
+                },
+            )
+        self._request(
+            "/list-user-conversations/<user_email>",
+            "GET",
+            f"/list-user-conversations/{self.email}",
+        )
+
+    def _end(self):
+        if self.conversation_id is None:
+            return
+        self._request(
+            "/end-conversation/<conversation_id>",
+            "GET",
+            f"/end-conversation/{self.conversation_id}",
+        )
+        for _ in range(self._args.feedback_polls):
+            response = self._request(
+                "/post-conversation-info/<conversation_id>",
+                "GET",
+                f"/post-conversation-info/{self.conversation_id}",
+            )
+            if response is not None and response.status_code == 200 and response.json().get("overall_feedback"):
+                return
+            time.sleep(self._args.poll_interval)
+
+
+def wait_for_background(chatbot_manager, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = chatbot_manager.background_executor.stats()
+        jobs = chatbot_manager.get_stats()["jobs"]
+        jobs_drained = jobs is None or (
+            jobs["running"] == 0
+            and jobs["enqueued"] <= jobs["completed"] + jobs["failed"]
+        )
+        if stats["queued"] == 0 and stats["in_flight"] == 0 and jobs_drained:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def run(args: argparse.Namespace) -> dict:
+    counter = OperationCounter()
+    app_module = boot_app(args, counter)
+    server, base_url = start_server(app_module.app)
+    counter.reset()
+
+    recorder = LatencyRecorder()
+    sampler = BackgroundSampler(app_module.chatbot_manager, args.sample_interval)
+    end_barrier = None if args.no_concurrent_ends else Barrier(args.students)
+    limits = httpx.Limits(max_connections=args.students + 8, max_keepalive_connections=args.students + 8)
+
+    with httpx.Client(limits=limits, timeout=120) as http:
+        students = [
+            Student(i, base_url, http, recorder, args, end_barrier)
+            for i in range(args.students)
+        ]
+        threads = [Thread(target=student.run, name=f"student-{student.index}") for student in students]
+
+        sampler.start()
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started_at
+
+    drained = wait_for_background(app_module.chatbot_manager, args.drain_timeout)
+    sampler.stop()
+    server.shutdown()
+
+    requests_count = recorder.count
+    return {
+        "benchmark": "class-period",
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ("output",)
+        },
+        "duration_s": round(duration, 3),
+        "requests": requests_count,
+        "throughput_rps": round(requests_count / duration, 3) if duration > 0 else 0.0,
+        "routes": recorder.summary(),
+        "mongo": counter.snapshot(),
+        "background": {
+            **sampler.summary(),
+            "drained": drained,
+            "executor": app_module.chatbot_manager.background_executor.stats(),
+        },
+        "chatbot_manager": app_module.chatbot_manager.get_stats(),
+    }
+
+
+def print_summary(results: dict, file=sys.stderr) -> None:
+    print(
+        f"{results['requests']} requests in {results['duration_s']} s ({results['throughput_rps']} req/s), "
+        f"{results['mongo']['total']} MongoDB operations, "
+        f"max background queue {results['background'].get('max_queued')}",
+        file=file,
+    )
+    print(f"{'route':45} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=file)
+    for route, stats in results["routes"].items():
+        print(
+            f"{route:45} {stats['count']:6} {stats['errors']:6} {stats['p50_ms']:9.1f} {stats['p95_ms']:9.1f} {stats['p99_ms']:9.1f}",
+            file=file,
+        )
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    results = run(args)
+    print_summary(results)
+    output = json.dumps(results, indent=2, default=str)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Latency statistics of the benchmarks.
+"""
+
+import math
+from collections import defaultdict
+from threading import Lock
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """
+    Nearest-rank percentile of some sorted values.
+
+    Args:
+        sorted_values (list): the values, sorted in ascending order
+        p (float): the percentile, between 0 and 100
+
+    Returns:
+        float: the percentile, or 0 if there are no values
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LatencyRecorder:
+    """
+    Thread-safe recorder of the latencies and errors of the requests, per route.
+    """
+
+    def __init__(self):
+        self._latencies = defaultdict(list)
+        self._errors = defaultdict(int)
+        self._lock = Lock()
+
+    def record(self, route: str, latency: float, is_error: bool) -> None:
+        """
+        Record a request.
+
+        Args:
+            route (str): the route of the request (e.g. "/end-conversation/<conversation_id>")
+            latency (float): the latency (in seconds) of the request
+            is_error (bool): whether the request failed
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._latencies[route].append(latency)
+            if is_error:
+                self._errors[route] += 1
+
+    @property
+    def count(self) -> int:
+        with self._lock:
+            return sum(len(latencies) for latencies in self._latencies.values())
+
+    def summary(self) -> dict:
+        """
+        Returns the statistics of each route, with the latencies in milliseconds.
+
+        Returns:
+            dict: Dictionary mapping each route to its number of requests, errors and its mean, p50, p95, p99 and max latencies.
+        """
+        with self._lock:
+            routes = {route: sorted(latencies) for route, latencies in self._latencies.items()}
+            errors = dict(self._errors)
+
+        summary = dict()
+        for route, latencies in sorted(routes.items()):
+            summary[route] = {
+                "count": len(latencies),
+                "errors": errors.get(route, 0),
+                "mean_ms": round(1000 * sum(latencies) / len(latencies), 3),
+                "p50_ms": round(1000 * percentile(latencies, 50), 3),
+                "p95_ms": round(1000 * percentile(latencies, 95), 3),
+                "p99_ms": round(1000 * percentile(latencies, 99), 3),
+                "max_ms": round(1000 * latencies[-1], 3),
+            }
+        return summary
@@ -4,19 +4,73 @@ Module containing classes for managing collections in the database.
 
 # pylint: disable=line-too-long
 
-from datetime import datetime
+import inspect
+import json
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from threading import local
 from typing import List, Optional
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
 
 from ..log import LogType
-from .data_objects import Conversation, User, ManagedConversation
+from ..metrics import Counter, Histogram
+from .data_objects import Conversation, User, ManagedConversation, Job
+
+MONGO_OPERATIONS = Counter(
+    "teachme_mongo_operations_total",
+    "Calls to the methods of the database collections.",
+    ("collection", "method", "status"),
+)
+MONGO_OPERATION_DURATION = Histogram(
+    "teachme_mongo_operation_duration_seconds",
+    "Duration of the calls to the methods of the database collections.",
+    ("collection", "method"),
+)
+
+# Calls made by another method of a collection are part of the outer call, and are not measured
+_instrumentation_state = local()
+
+
+def _instrument(collection_class: str, method_name: str, method):
+    @wraps(method)
+    def instrumented(*args, **kwargs):
+        if getattr(_instrumentation_state, "active", False):
+            return method(*args, **kwargs)
+
+        _instrumentation_state.active = True
+        started_at = time.perf_counter()
+        status = "error"
+        try:
+            result = method(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            _instrumentation_state.active = False
+            MONGO_OPERATIONS.labels(collection_class, method_name, status).inc()
+            MONGO_OPERATION_DURATION.labels(collection_class, method_name).observe(
+                time.perf_counter() - started_at
+            )
+
+    return instrumented
 
 
 class Collection:
     """
     Represents a generic collection in the database.
+
+    The public methods of the subclasses are instrumented: their calls and durations are recorded in
+    the teachme_mongo_operations_total and teachme_mongo_operation_duration_seconds metrics.
     """
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, attribute in list(vars(cls).items()):
+            if name.startswith("_") or not inspect.isfunction(attribute):
+                continue
+            setattr(cls, name, _instrument(cls.__name__, name, attribute))
+
     def __init__(self, collection, collection_name: str) -> None:
         """
         Initialize a Collection object.
@@ -55,6 +109,9 @@ class ConversationsCollection(Collection):
     - student_email: str
     - time_limit: int
     - is_ended: bool
+    - started_at: datetime (set when the conversation is first initialized)
+    - system_prompt: str (pre-generated rendered system prompt, if any)
+    - opening_message: str (pre-generated opening turn of the chatbot, if any)
     """
 
     def __init__(self, collection, collection_name: str) -> None:
@@ -164,6 +221,49 @@ class ConversationsCollection(Collection):
 
         return Conversation(**conversation_dict)
 
+    def start_conversation(self, conversation_id: str) -> Optional[datetime]:
+        """
+        Records the time the conversation was first initialized, if it has not been recorded yet.
+
+        Args:
+            conversation_id (str): ID of the conversation to start.
+
+        Returns:
+            Optional[datetime]: The recorded time, or None if the conversation had already been started.
+        """
+        started_at = datetime.utcnow()
+        result = self._collection.update_one(
+            {"_id": ObjectId(conversation_id), "started_at": None},
+            {"$set": {"started_at": started_at}},
+        )
+        return started_at if result.modified_count == 1 else None
+
+    def set_opening(
+        self, conversation_id: str, system_prompt: str, opening_message: str
+    ) -> bool:
+        """
+        Stores the pre-generated system prompt and opening turn of a conversation, unless the
+        conversation has already been started.
+
+        Args:
+            conversation_id (str): ID of the conversation.
+            system_prompt (str): Rendered system prompt of the chatbot.
+            opening_message (str): Opening turn of the chatbot.
+
+        Returns:
+            bool: True if they were stored, False if the conversation has already been started.
+        """
+        result = self._collection.update_one(
+            {"_id": ObjectId(conversation_id), "started_at": None},
+            {
+                "$set": {
+                    "system_prompt": system_prompt,
+                    "opening_message": opening_message,
+                }
+            },
+        )
+        return result.modified_count == 1
+
     def end_conversation(self, conversation_id: str):
         """
         Ends a conversation by setting the is_ended attribute to True.
@@ -408,6 +508,10 @@ class UserDataCollection(Collection):
 class ChatMessageHistoryCollection(Collection):
     """
     Represents a collection of chat message history in the database.
+
+    Each document stores a single message of a chat session, with the same layout used by langchain's MongoDBChatMessageHistory:
+    - SessionId: str
+    - History: str (JSON serialized message)
     """
 
     def __init__(self, collection, collection_name: str) -> None:
@@ -420,6 +524,117 @@ class ChatMessageHistoryCollection(Collection):
         """
         super().__init__(collection, collection_name)
 
+    def get_messages(self, session_id: str) -> list[dict]:
+        """
+        Retrieve the messages of a chat session, in insertion order.
+
+        Args:
+            session_id (str): ID of the chat session
+
+        Returns:
+            list[dict]: The messages of the chat session.
+        """
+        cursor = self._collection.find({"SessionId": session_id}).sort("_id", 1)
+        return [json.loads(document["History"]) for document in cursor]
+
+    def add_messages(self, session_id: str, messages: list[dict]) -> None:
+        """
+        Append messages to a chat session.
+
+        Args:
+            session_id (str): ID of the chat session
+            messages (list[dict]): the messages to append
+
+        Returns:
+            None
+        """
+        if len(messages) == 0:
+            return
+        self._collection.insert_many(
+            [
+                {"SessionId": session_id, "History": json.dumps(message)}
+                for message in messages
+            ],
+            ordered=True,
+        )
+
+    def clear(self, session_id: str) -> None:
+        """
+        Delete all the messages of a chat session.
+
+        Args:
+            session_id (str): ID of the chat session
+
+        Returns:
+            None
+        """
+        self._collection.delete_many({"SessionId": session_id})
+
+
+class ChatHistorySummariesCollection(Collection):
+    """
+    Represents a collection of rolling summaries of the chat message histories in the database.
+
+    Each summary has the following fields:
+    - _id: str (the ID of the chat session)
+    - summary: str
+    - summarized_count: int (number of messages of the session folded into the summary)
+    """
+
+    def __init__(self, collection, collection_name: str) -> None:
+        """
+        Initialize a ChatHistorySummariesCollection object.
+
+        Args:
+            collection (any): the collection object from the database
+            collection_name (str): name of the collection
+        """
+        super().__init__(collection, collection_name)
+
+    def get_summary(self, session_id: str) -> Optional[dict]:
+        """
+        Retrieve the rolling summary of a chat session.
+
+        Args:
+            session_id (str): ID of the chat session
+
+        Returns:
+            Optional[dict]: The summary, or None if the session has not been summarized yet.
+        """
+        return self._collection.find_one({"_id": session_id})
+
+    def save_summary(
+        self, session_id: str, summary: str, summarized_count: int
+    ) -> None:
+        """
+        Insert or replace the rolling summary of a chat session.
+
+        Args:
+            session_id (str): ID of the chat session
+            summary (str): the summary of the older messages of the session
+            summarized_count (int): number of messages of the session folded into the summary
+
+        Returns:
+            None
+        """
+        self._collection.update_one(
+            {"_id": session_id},
+            {"$set": {"summary": summary, "summarized_count": summarized_count}},
+            upsert=True,
+        )
+
+    def clear(self, session_id: str) -> None:
+        """
+        Delete the rolling summary of a chat session.
+
+        Args:
+            session_id (str): ID of the chat session
+
+        Returns:
+            None
+        """
+        self._collection.delete_one({"_id": session_id})
+
 
 class LogsCollection(Collection):
     """
@@ -535,6 +750,55 @@ class ManagedConversationsCollection(Collection):
         except KeyError:
             print(f"Conversation with id {conversation_id} not found.")
 
+    def add_messages(self, conversation_id: str, messages: list[dict]) -> None:
+        """
+        Add messages to the managed conversation with a single write, preserving their order.
+
+        Args:
+            conversation_id (str): ID of the conversation. Equal to the conversation id in the conversations collection.
+            messages (list[dict]): The messages to add to the conversation.
+
+        Returns:
+            None
+        """
+        self._collection.update_one(
+            {"_id": ObjectId(conversation_id)},
+            {"$push": {"messages": {"$each": messages}}},
+        )
+
+    def set_message_analysis(
+        self,
+        conversation_id: str,
+        message_index: int,
+        feedback: Optional[dict],
+        synonyms: Optional[list],
+        pronunciation: Optional[list],
+    ) -> None:
+        """
+        Set the post-message analyses of a user message of the managed conversation.
+
+        Args:
+            conversation_id (str): ID of the conversation. Equal to the conversation id in the conversations collection.
+            message_index (int): Index of the message in the conversation.
+            feedback (Optional[dict]): The feedback on the message.
+            synonyms (Optional[list]): The synonyms challenge of the message.
+            pronunciation (Optional[list]): The pronunciation challenge of the message.
+
+        Returns:
+            None
+        """
+        prefix = f"messages.{message_index}"
+        self._collection.update_one(
+            {"_id": ObjectId(conversation_id)},
+            {
+                "$set": {
+                    f"{prefix}.feedback": feedback,
+                    f"{prefix}.synonyms": synonyms,
+                    f"{prefix}.pronunciation": pronunciation,
+                }
+            },
+        )
+
     def get_by_id(self, conversation_id: str) -> ManagedConversation:
         """
         Retrieve a managed conversation by its ID.
@@ -568,16 +832,49 @@ class ManagedConversationsCollection(Collection):
         managed_conversation = self.get_by_id(conversation_id)
         if managed_conversation is None:
             return ""
+        return managed_conversation.format_messages()
 
-        conversation_string = ""
-        for message in managed_conversation.messages:
-            if message["role"] == "ai":
-                conversation_string += (
-                    f"Conversational partner message: {message['message_content']}\n"
-                )
-            else:
-                conversation_string += f"User message: {message['message_content']}\n"
-        return conversation_string
+    def set_running_feedback(
+        self,
+        conversation_id: str,
+        running_feedback: str,
+        running_opinion_summary: str,
+        messages_count: int,
+        previous_messages_count: int,
+    ) -> bool:
+        """
+        Set the running feedback notes and opinion summary of the conversation, unless they have been
+        updated by someone else since they were read.
+
+        Args:
+            conversation_id (str): ID of the conversation. Equal to the conversation id in the conversations collection.
+            running_feedback (str): Notes on the feedback of the first messages_count messages.
+            running_opinion_summary (str): Summary of the opinion of the user in the first messages_count messages.
+            messages_count (int): Number of messages covered by the notes.
+            previous_messages_count (int): Number of messages covered by the notes that were updated.
+
+        Returns:
+            bool: True if the notes were set, False if they had been updated in the meantime.
+        """
+        result = self._collection.update_one(
+            {
+                "_id": ObjectId(conversation_id),
+                # A missing field matches None
+                "running_feedback_messages": (
+                    previous_messages_count
+                    if previous_messages_count
+                    else {"$in": [0, None]}
+                ),
+            },
+            {
+                "$set": {
+                    "running_feedback": running_feedback,
+                    "running_opinion_summary": running_opinion_summary,
+                    "running_feedback_messages": messages_count,
+                }
+            },
+        )
+        return result.modified_count == 1
 
     def set_overall_feedback(self, conversation_id: str, overall_feedback: str) -> None:
         """
@@ -612,11 +909,342 @@ class ManagedConversationsCollection(Collection):
         )
 
 
+class AnalysisCacheCollection(Collection):
+    """
+    Represents a collection of cached post-message analyses in the database.
+
+    Each entry has the following fields:
+    - _id: str (the cache key)
+    - response: str
+    - expires_at: datetime
+    """
+
+    def __init__(self, collection, collection_name: str) -> None:
+        """
+        Initialize an AnalysisCacheCollection object.
+
+        Args:
+            collection (any): The collection object from the database.
+            collection_name (str): The name of the collection.
+        """
+        super().__init__(collection, collection_name)
+
+    def ensure_ttl_index(self) -> None:
+        """
+        Create the index letting MongoDB delete the expired entries.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self._collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def find_entry(self, key: str) -> Optional[dict]:
+        """
+        Find a cache entry that has not expired yet.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            Optional[dict]: The entry, or None if it does not exist or it has expired.
+        """
+        return self._collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}
+        )
+
+    def save_entry(self, key: str, response: str, expires_at: datetime) -> None:
+        """
+        Insert or replace a cache entry.
+
+        Args:
+            key (str): Key of the entry.
+            response (str): The cached response.
+            expires_at (datetime): Expiration time (UTC) of the entry.
+
+        Returns:
+            None
+        """
+        self._collection.update_one(
+            {"_id": key},
+            {"$set": {"response": response, "expires_at": expires_at}},
+            upsert=True,
+        )
+
+
+class JobsCollection(Collection):
+    """
+    Represents a collection of background jobs in the database.
+
+    Each job has the following fields:
+    - _id: str (the deduplication key of the job)
+    - kind: str
+    - conversation_id: str
+    - payload: dict
+    - status: str ("pending", "running", "done" or "failed")
+    - attempts: int
+    - available_at: datetime (when a pending job can be leased)
+    - created_at: datetime
+    - lease_owner: str (the worker running the job)
+    - lease_expires_at: datetime (when another worker can take over the job)
+    - last_error: str
+    - expires_at: datetime (when a done job is deleted)
+    """
+
+    def __init__(self, collection, collection_name: str) -> None:
+        """
+        Initialize a JobsCollection object.
+
+        Args:
+            collection (any): The collection object from the database.
+            collection_name (str): The name of the collection.
+        """
+        super().__init__(collection, collection_name)
+
+    def ensure_indexes(self) -> None:
+        """
+        Create the index used to lease the jobs and the index letting MongoDB delete the expired jobs.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self._collection.create_index([("status", ASCENDING), ("available_at", ASCENDING)])
+        self._collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def enqueue(
+        self, job_id: str, kind: str, conversation_id: str, payload: dict
+    ) -> bool:
+        """
+        Insert a pending job, unless a job with the same id already exists.
+
+        Args:
+            job_id (str): Deduplication key of the job.
+            kind (str): Kind of the job.
+            conversation_id (str): ID of the conversation the job refers to.
+            payload (dict): Arguments of the job.
+
+        Returns:
+            bool: True if the job was inserted, False if it already existed.
+        """
+        now = datetime.utcnow()
+        result = self._collection.update_one(
+            {"_id": job_id},
+            {
+                "$setOnInsert": {
+                    "kind": kind,
+                    "conversation_id": conversation_id,
+                    "payload": payload,
+                    "status": "pending",
+                    "attempts": 0,
+                    "available_at": now,
+                    "created_at": now,
+                }
+            },
+            upsert=True,
+        )
+        return result.upserted_id is not None
+
+    def lease(
+        self, worker_id: str, lease_time: int, max_attempts: int
+    ) -> Optional[Job]:
+        """
+        Lease the oldest job that can run: a pending job whose retry time has come, or a running
+        job whose lease has expired because its worker stopped, if it has attempts left. When no job
+        can run, the running jobs whose lease expired at their last attempt are marked as failed.
+
+        Args:
+            worker_id (str): ID of the worker leasing the job.
+            lease_time (int): Duration (in seconds) of the lease.
+            max_attempts (int): Maximum number of attempts of a job.
+
+        Returns:
+            Optional[Job]: The leased job, with its attempts already incremented, or None if no job can run.
+        """
+        now = datetime.utcnow()
+        job = self._collection.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "pending", "available_at": {"$lte": now}},
+                    {
+                        "status": "running",
+                        "lease_expires_at": {"$lte": now},
+                        "attempts": {"$lt": max_attempts},
+                    },
+                ]
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "lease_owner": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=lease_time),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("available_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is None:
+            # The worker stopped during the last attempt, e.g. killed by the job itself
+            self._collection.update_many(
+                {
+                    "status": "running",
+                    "lease_expires_at": {"$lte": now},
+                    "attempts": {"$gte": max_attempts},
+                },
+                {
+                    "$set": {
+                        "status": "failed",
+                        "lease_owner": None,
+                        "lease_expires_at": None,
+                        "last_error": "The lease of the last attempt expired.",
+                    }
+                },
+            )
+            return None
+        return Job(**job)
+
+    def complete(self, job_id: str, worker_id: str, retention: int) -> bool:
+        """
+        Mark a leased job as done. The job is kept for the retention time to deduplicate it.
+
+        Args:
+            job_id (str): ID of the job.
+            worker_id (str): ID of the worker holding the lease.
+            retention (int): Time (in seconds) before the job is deleted.
+
+        Returns:
+            bool: True if the job was marked as done, False if the worker lost its lease.
+        """
+        result = self._collection.update_one(
+            {"_id": job_id, "status": "running", "lease_owner": worker_id},
+            {
+                "$set": {
+                    "status": "done",
+                    "lease_owner": None,
+                    "lease_expires_at": None,
+                    "expires_at": datetime.utcnow() + timedelta(seconds=retention),
+                }
+            },
+        )
+        return result.modified_count == 1
+
+    def retry(
+        self, job_id: str, worker_id: str, error: str, available_at: datetime
+    ) -> bool:
+        """
+        Put a failed leased job back in the queue, to be leased again after the given time.
+
+        Args:
+            job_id (str): ID of the job.
+            worker_id (str): ID of the worker holding the lease.
+            error (str): Error of the failed attempt.
+            available_at (datetime): Time (UTC) after which the job can be leased again.
+
+        Returns:
+            bool: True if the job was put back in the queue, False if the worker lost its lease.
+        """
+        result = self._collection.update_one(
+            {"_id": job_id, "status": "running", "lease_owner": worker_id},
+            {
+                "$set": {
+                    "status": "pending",
+                    "available_at": available_at,
+                    "lease_owner": None,
+                    "lease_expires_at": None,
+                    "last_error": error,
+                }
+            },
+        )
+        return result.modified_count == 1
+
+    def defer(self, job_id: str, worker_id: str, available_at: datetime) -> bool:
+        """
+        Put a leased job back in the queue without counting its attempt, to be leased again after the
+        given time (e.g. while the model provider is unavailable).
+
+        Args:
+            job_id (str): ID of the job.
+            worker_id (str): ID of the worker holding the lease.
+            available_at (datetime): Time (UTC) after which the job can be leased again.
+
+        Returns:
+            bool: True if the job was put back in the queue, False if the worker lost its lease.
+        """
+        result = self._collection.update_one(
+            {"_id": job_id, "status": "running", "lease_owner": worker_id},
+            {
+                "$set": {
+                    "status": "pending",
+                    "available_at": available_at,
+                    "lease_owner": None,
+                    "lease_expires_at": None,
+                },
+                "$inc": {"attempts": -1},
+            },
+        )
+        return result.modified_count == 1
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """
+        Mark a leased job as failed for good. Failed jobs are kept for inspection.
+
+        Args:
+            job_id (str): ID of the job.
+            worker_id (str): ID of the worker holding the lease.
+            error (str): Error of the last attempt.
+
+        Returns:
+            bool: True if the job was marked as failed, False if the worker lost its lease.
+        """
+        result = self._collection.update_one(
+            {"_id": job_id, "status": "running", "lease_owner": worker_id},
+            {
+                "$set": {
+                    "status": "failed",
+                    "lease_owner": None,
+                    "lease_expires_at": None,
+                    "last_error": error,
+                }
+            },
+        )
+        return result.modified_count == 1
+
+    def count_by_status(self) -> dict:
+        """
+        Count the jobs in each status.
+
+        Args:
+            None
+
+        Returns:
+            dict: Dictionary with the number of jobs per status.
+        """
+        return {
+            entry["_id"]: entry["count"]
+            for entry in self._collection.aggregate(
+                [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+            )
+        }
+
+
 class CollectionDispatcher:
     """
     Dispatcher class for managing collections in the database.
     """
 
+    # Collections that MongoDB creates on the first write, so they may not exist yet
+    LAZILY_CREATED_COLLECTIONS = (
+        "chat_message_history",
+        "chat_history_summaries",
+        "analysis_cache",
+        "jobs",
+    )
+
     def __init__(self, collection_names: List[str], db) -> None:
         """
         Initialize a CollectionDispatcher object.
@@ -647,7 +1275,10 @@ class CollectionDispatcher:
         Returns:
             Collection: The collection object.
         """
-        if collection_name not in self._connection_names:
+        if (
+            collection_name not in self._connection_names
+            and collection_name not in self.LAZILY_CREATED_COLLECTIONS
+        ):
             raise KeyError(f"Collection {collection_name} not found in the database.")
 
         # switching to the correct collection
@@ -659,11 +1290,19 @@ class CollectionDispatcher:
             return ChatMessageHistoryCollection(
                 self._db[collection_name], collection_name
             )
+        elif collection_name == "chat_history_summaries":
+            return ChatHistorySummariesCollection(
+                self._db[collection_name], collection_name
+            )
         elif collection_name == "logs":
             return LogsCollection(self._db[collection_name], collection_name)
         elif collection_name == "managed_conversations":
             return ManagedConversationsCollection(
                 self._db[collection_name], collection_name
             )
+        elif collection_name == "analysis_cache":
+            return AnalysisCacheCollection(self._db[collection_name], collection_name)
+        elif collection_name == "jobs":
+            return JobsCollection(self._db[collection_name], collection_name)
         else:
             return Collection(self._db[collection_name], collection_name)
@@ -1,3 +1,3 @@
 from .Connector import Connector, MongoDBConnector
-from .data_objects import Conversation, ManagedConversation
+from .data_objects import Conversation, ManagedConversation, Job
 from .Database import MongoDB
@@ -35,6 +35,10 @@ class Conversation:
     is_ended: bool
     time_limit: int
     parent_conversation_id: Optional[str]
+    started_at: Optional[datetime] = None
+    # Pre-generated when the conversation is created, if requested
+    system_prompt: Optional[str] = None
+    opening_message: Optional[str] = None
 
 
 @dataclass
@@ -69,3 +73,46 @@ class ManagedConversation:
     messages: list
     role_reversed_prompt: str
     overall_feedback: str
+    # Notes on the feedback and opinion summary of the first running_feedback_messages messages
+    running_feedback: Optional[str] = None
+    running_opinion_summary: Optional[str] = None
+    running_feedback_messages: int = 0
+
+    def format_messages(self, start: int = 0, end: int = None) -> str:
+        """
+        Format the transcript of the messages of the conversation between start and end.
+
+        Args:
+            start (int, optional): Index of the first message. Defaults to 0.
+            end (int, optional): Index after the last message. Defaults to None (until the last message).
+
+        Returns:
+            str: The formatted transcript.
+        """
+        conversation_string = ""
+        for message in self.messages[start:end]:
+            if message["role"] == "ai":
+                conversation_string += (
+                    f"Conversational partner message: {message['message_content']}\n"
+                )
+            else:
+                conversation_string += f"User message: {message['message_content']}\n"
+        return conversation_string
+
+
+@dataclass
+class Job:
+    """Represents a job of the background job queue."""
+
+    _id: str
+    kind: str
+    conversation_id: str
+    payload: dict
+    status: str
+    attempts: int
+    available_at: datetime
+    created_at: datetime
+    lease_owner: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    last_error: Optional[str] = None
+    expires_at: Optional[datetime] = None
@@ -2,6 +2,15 @@
 A module containing the prompts used by the model to generate the conversation.
 """
 
+import hashlib
+from dataclasses import dataclass
+from functools import lru_cache
+from string import Formatter
+from typing import Optional
+
+# Prompt type of the turns of a conversation, as opposed to the post-message prompts
+CONVERSATION_PROMPT_TYPE = "CONVERSATIONAL_SYSTEM_PROMPT"
+
 PROMPTS = {
     "CONVERSATIONAL_SYSTEM_PROMPT": {
         "text": """You are a conversation partner helping users practice and improve their English conversational skills. Your goal is to engage users in conversations to enhance their listening and speaking abilities and boost their confidence in using the language.
@@ -75,12 +84,53 @@ The response should just include the list with no extra formatting.
         If words like this are present in the user's message, please return them in a plain json list, if no such words are present return an empty list.""",
         "args": [],
     },
+    "COMBINED_POST_MESSAGE_SYSTEM_PROMPT": {
+        "text": """You are an assistant to an english teacher.
+You will receive a message from the user. These messages are transcriptions of what the user is saying during a spoken conversation.
+You have to perform three analyses on the message of the user:
+1. Synonyms: if the message features interesting words, pick out one word that you deem to be relevant in the context and provide potential synonyms for it. The result is a json array with the chosen word as the first element and a maximum of three other synonyms. If no words are found to be particularly interesting the result is an empty list.
+2. Pronunciation: if the message features words that are generally considered hard to pronounce, either featuring particular phonetic characteristics or silent letters (e.g. capitalism, aunt, choir), as opposed to regular words (e.g. apple, car, dog), the result is a plain json list with such words. If no such words are present the result is an empty list.
+3. Feedback: if the message of the user has notable spoken English syntax errors, provide a line of feedback explaining why it's wrong and how it could have been said correctly. Never provide feedback on punctuation or suggest the user to review the responses before submitting because in reality he is speaking and not texting. The result is a json object that has two attributes: a boolean \"hasMistake\" that flags whether the user made mistakes and a string \"messageFeedback\" with the feedback correcting such mistake.
+Please return a single json object with three attributes: \"synonyms\" with the result of the first analysis, \"pronunciation\" with the result of the second analysis and \"feedback\" with the result of the third analysis.
+The response should just include the json object with no extra formatting.""",
+        "args": [],
+    },
+    "CONVERSATION_SUMMARY_SYSTEM_PROMPT": {
+        "text": """You are an assistant summarizing a spoken conversation between a user practicing their English and their conversational partner.
+You will receive the current summary of the conversation, if any, followed by the transcript of the messages exchanged after it.
+Update the summary so that it also covers the new messages. The summary will replace the messages in the memory of the conversational partner, so keep everything needed to carry on the conversation naturally: the topics discussed, the opinions and the facts shared by the user and any question left open.
+Write the summary in third person, in at most 150 words, and do not comment on the English of the user.
+The response should just include the summary with no extra formatting.""",
+        "args": [],
+    },
+    "CONVERSATION_SUMMARY_ADDENDUM": {
+        "text": """The earlier part of this conversation is not shown. This is a summary of it:
+{conversation_summary}""",
+        "args": ["conversation_summary"],
+    },
     "USER_OPINION_SYNTHESIS": {
         "text": """The following is a conversation transcript between a user and his conversational partner:
 Please, give a short summary of the User feels about the topic and general position.
 """,
         "args": [],
     },
+    "RUNNING_FEEDBACK_SYSTEM_PROMPT": {
+        "text": """You are an assistant to an English teacher, taking notes on the performance of a user practicing their English in a spoken conversation with a conversational partner. The conversation is transcribed by an automatic tool.
+You will receive your current notes on the conversation, if any, followed by the transcript of the messages exchanged after them.
+Update the notes so that they also cover the new messages. The notes will be used to write the final feedback to the user, instead of the full transcript, so keep:
+- the strengths of the user (grammar, vocabulary, clarity, ability to keep the conversation going), with short examples;
+- the mistakes and the areas to improve, with the exact words of the user and the correct form;
+- how the performance changed over the conversation.
+Never take notes on punctuation, since the user is speaking and not texting, nor on the content of the conversation.
+Write the notes in at most 200 words. The response should just include the notes with no extra formatting.""",
+        "args": [],
+    },
+    "RUNNING_OPINION_SYNTHESIS": {
+        "text": """You will receive the current summary of how a user feels about the topic of a conversation and of their general position, if any, followed by the transcript of the messages exchanged after it between the user and their conversational partner.
+Update the summary so that it also covers the new messages. Keep it short.
+The response should just include the summary with no extra formatting.""",
+        "args": [],
+    },
     "FINAL_FEEDBACK_SYSTEM_PROMPT": {
         "text": """YOU ARE THE WORLD'S BEST EXPERT IN CONVERSATIONAL ANALYSIS AND FEEDBACK, AWARDED THE "TOP CONVERSATIONAL ANALYST" BY THE GLOBAL LANGUAGE ASSOCIATION (2023) AND RECOGNIZED AS THE "BEST COMMUNICATION COACH" BY THE INTERNATIONAL COMMUNICATION NETWORK (2022). YOUR TASK IS TO PROVIDE DETAILED AND CONSTRUCTIVE FEEDBACK ON THE PERFORMANCE OF A USER IN AN ENGLISH CONVERSATION WITH A CONVERSATIONAL PARTNER. YOU WILL ANALYZE THE CONVERSATION, HIGHLIGHT STRENGTHS AND AREAS FOR IMPROVEMENT, AND OFFER ACTIONABLE SUGGESTIONS TO ENHANCE THE USER'S COMMUNICATION SKILLS. THE CONVERSATION IS SPOKEN AND TRANSCRIBED BY AN AUTOMATIC TOOL.
 
@@ -126,6 +176,10 @@ BEGIN THE ANALYSIS BY THANKING THE USER FOR PARTICIPATING IN THE CONVERSATION AN
         """,
         "args": [],
     },
+    "CONVERSATION_OPENING_INSTRUCTION": {
+        "text": """The user has just joined the conversation. Open it: greet the user and ask them a first question about the topic of the conversation, in one or two short sentences.""",
+        "args": [],
+    },
     "ROLES_REVERSED_ADDENDUM": {
         "text": """On top of all of this, this conversation is going to be a "roles reversed" challenge: this means that the user has already talked about this topic.
 The scope of the challenge is to have the user talk about the same topic, but expressing different opinions, views and feelings from before, to expore a new vocabulary and challenge them into thinkingan open-mindedly.
@@ -138,12 +192,64 @@ This is the summary of their opinion on the topic of this conversation that you
 }
 
 
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """
+    A prompt of PROMPTS, validated once at import time.
+    """
+
+    text: str
+    args: tuple
+    version: str
+    # Text of the prompts without arguments, already rendered
+    rendered: Optional[str]
+
+
+def _compile_prompt(prompt_name: str, prompt: dict) -> CompiledPrompt:
+    text = prompt.get("text")
+    args = tuple(prompt.get("args"))
+    placeholders = {
+        field_name
+        for _, field_name, _, _ in Formatter().parse(text)
+        if field_name is not None
+    }
+    if placeholders != set(args):
+        raise ValueError(
+            f"Prompt {prompt_name} declares arguments {sorted(args)}, but its text uses {sorted(placeholders)}."
+        )
+    return CompiledPrompt(
+        text=text,
+        args=args,
+        version=hashlib.sha1(text.encode("utf-8")).hexdigest()[:12],
+        rendered=text.format() if len(args) == 0 else None,
+    )
+
+
+COMPILED_PROMPTS = {
+    prompt_name: _compile_prompt(prompt_name, prompt)
+    for prompt_name, prompt in PROMPTS.items()
+}
+
+
+def _get_compiled_prompt(prompt_name: str) -> CompiledPrompt:
+    compiled = COMPILED_PROMPTS.get(prompt_name)
+    if compiled is None:
+        raise ValueError(f"Prompt {prompt_name} does not exist.")
+    return compiled
+
+
+@lru_cache(maxsize=1024)
+def _render_prompt(prompt_name: str, arguments: tuple) -> str:
+    return COMPILED_PROMPTS[prompt_name].text.format(**dict(arguments))
+
+
 def get_prompt(prompt_name: str, **kwargs) -> str:
     """Given the name of a prompt and the required arguments, return the prompt text with
-    the arguments filled in.
+    the arguments filled in. Rendered prompts are memoized.
 
     :param prompt_name: name of the prompt to retrieve
     :type prompt_name: str
+    :raises ValueError: if the prompt does not exist
     :raises ValueError: if the number of arguments provided does not match the number of arguments
                         required by the prompt
     :raises ValueError: if an argument required by the prompt is not provided
@@ -151,12 +257,16 @@ def get_prompt(prompt_name: str, **kwargs) -> str:
     :return: the prompt text with the arguments filled in
     :rtype: str
     """
-    if len(PROMPTS.get(prompt_name).get("args")) != len(kwargs):
+    compiled = _get_compiled_prompt(prompt_name)
+    if compiled.rendered is not None and len(kwargs) == 0:
+        return compiled.rendered
+
+    if len(compiled.args) != len(kwargs):
         raise ValueError(
-            f"Prompt {prompt_name} requires {len(PROMPTS.get(prompt_name).get('args'))} arguments, but {len(kwargs)} were provided."
+            f"Prompt {prompt_name} requires {len(compiled.args)} arguments, but {len(kwargs)} were provided."
         )
 
-    for arg in PROMPTS.get(prompt_name).get("args"):
+    for arg in compiled.args:
         if arg not in kwargs:
             raise ValueError(
                 f"Prompt {prompt_name} requires argument {arg}, but it was not provided. Provided arguments: {kwargs}"
@@ -167,7 +277,19 @@ def get_prompt(prompt_name: str, **kwargs) -> str:
                 f"Argument {arg} for prompt {prompt_name} must be a string."
             )
 
-    return PROMPTS.get(prompt_name).get("text").format(**kwargs)
+    return _render_prompt(prompt_name, tuple(sorted(kwargs.items())))
+
+
+def get_prompt_version(prompt_name: str) -> str:
+    """Given the name of a prompt, return a short fingerprint of its text, which changes whenever
+    the prompt is edited.
+
+    :param prompt_name: name of the prompt
+    :type prompt_name: str
+    :return: the version of the prompt
+    :rtype: str
+    """
+    return _get_compiled_prompt(prompt_name).version
 
 
 def get_message_feedback_prompt():
@@ -182,9 +304,35 @@ def get_pronunciation_challenge_prompt():
     return get_prompt("CHALLENGE_PRONUNCIATION_SYSTEM_PROMPT")
 
 
+def get_combined_post_message_prompt():
+    return get_prompt("COMBINED_POST_MESSAGE_SYSTEM_PROMPT")
+
+
+def get_conversation_summary_prompt():
+    return get_prompt("CONVERSATION_SUMMARY_SYSTEM_PROMPT")
+
+
+def get_conversation_summary_addendum(conversation_summary: str):
+    return get_prompt(
+        "CONVERSATION_SUMMARY_ADDENDUM", conversation_summary=conversation_summary
+    )
+
+
 def get_roles_reversed_user_summary_prompt():
     return get_prompt("USER_OPINION_SYNTHESIS")
 
 
+def get_conversation_opening_instruction():
+    return get_prompt("CONVERSATION_OPENING_INSTRUCTION")
+
+
+def get_running_feedback_prompt():
+    return get_prompt("RUNNING_FEEDBACK_SYSTEM_PROMPT")
+
+
+def get_running_opinion_summary_prompt():
+    return get_prompt("RUNNING_OPINION_SYNTHESIS")
+
+
 def get_roles_reversed_system_prompt_addendum(user_summary: str):
     return get_prompt("ROLES_REVERSED_ADDENDUM", user_summary=user_summary)
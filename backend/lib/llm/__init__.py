@@ -1,2 +1,14 @@
 from .chatbot import ConversationalChatBot, test_chatbot
-from .chatbot_manager import ChatbotManager
+from .chatbot_manager import (
+    CHATBOT_ERROR_MESSAGE,
+    CHATBOT_TIMEOUT_MESSAGE,
+    ChatbotManager,
+)
+from .history import HistoryCompactionSettings
+from .analysis_cache import AnalysisCache
+from .clients import ChatModelPool
+from .fake import FakeChatModel
+from .scheduler import LLMScheduler
+from .hedging import LLMCallPolicy, LLMTimeoutError
+from .breaker import CircuitBreaker, CircuitOpenError
+from .jobs import JobQueue, JobWorker
@@ -0,0 +1,180 @@
+"""
+Module containing the cache of the post-message analyses.
+"""
+
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from typing import Optional
+
+from ..database.Collection import AnalysisCacheCollection
+
+
+class AnalysisCache:
+    """
+    LRU cache with time-to-live for the responses of the post-message analyses.
+
+    Entries are keyed on the prompt name, the prompt version and the normalized user message, so
+    that editing a prompt invalidates its entries. The least recently used entries are evicted
+    once the cache holds ``max_size`` entries, and entries expire ``ttl`` seconds after being stored.
+    If a collection is given, entries are also persisted in it so that they survive restarts.
+
+    Args:
+        max_size (int, optional): Maximum number of entries kept in memory. Defaults to 10000.
+        ttl (int, optional): Time-to-live (in seconds) of the entries. Defaults to 7 days.
+        collection (AnalysisCacheCollection, optional): Collection persisting the entries. Defaults to None (memory only).
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: int = 7 * 24 * 60 * 60,
+        collection: AnalysisCacheCollection = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._collection = collection
+        if self._collection is not None:
+            self._collection.ensure_ttl_index()
+
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._persistent_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    @staticmethod
+    def normalize_message(user_message: str) -> str:
+        """
+        Normalize a user message, so that messages differing only by case, spacing or surrounding
+        punctuation share the same entry. Messages are spoken transcriptions, so none of these
+        differences matter for the analyses.
+
+        Args:
+            user_message (str): the message sent by the user
+
+        Returns:
+            str: the normalized message
+        """
+        message = re.sub(r"\s+", " ", user_message.casefold())
+        return message.strip(" .,;:!?\"'")
+
+    @classmethod
+    def make_key(cls, prompt_name: str, prompt_version: str, user_message: str) -> str:
+        """
+        Compute the key of an entry.
+
+        Args:
+            prompt_name (str): name of the prompt of the analysis
+            prompt_version (str): version of the prompt of the analysis
+            user_message (str): the message sent by the user
+
+        Returns:
+            str: the key of the entry
+        """
+        normalized = cls.normalize_message(user_message)
+        raw_key = f"{prompt_name}\x00{prompt_version}\x00{normalized}"
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def get(
+        self, prompt_name: str, prompt_version: str, user_message: str
+    ) -> Optional[str]:
+        """
+        Get the cached response of an analysis.
+
+        Args:
+            prompt_name (str): name of the prompt of the analysis
+            prompt_version (str): version of the prompt of the analysis
+            user_message (str): the message sent by the user
+
+        Returns:
+            Optional[str]: the cached response, or None if there is no valid entry
+        """
+        key = self.make_key(prompt_name, prompt_version, user_message)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return response
+                del self._entries[key]
+                self._expirations += 1
+
+        if self._collection is not None:
+            document = self._collection.find_entry(key)
+            if document is not None:
+                # MongoDB returns naive datetimes in UTC
+                expires_at = (
+                    document["expires_at"].replace(tzinfo=timezone.utc).timestamp()
+                )
+                self._store(key, document["response"], expires_at)
+                with self._lock:
+                    self._persistent_hits += 1
+                return document["response"]
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def put(
+        self, prompt_name: str, prompt_version: str, user_message: str, response: str
+    ) -> None:
+        """
+        Store the response of an analysis.
+
+        Args:
+            prompt_name (str): name of the prompt of the analysis
+            prompt_version (str): version of the prompt of the analysis
+            user_message (str): the message sent by the user
+            response (str): the response of the model
+
+        Returns:
+            None
+        """
+        key = self.make_key(prompt_name, prompt_version, user_message)
+        self._store(key, response, time.time() + self.ttl)
+        if self._collection is not None:
+            self._collection.save_entry(
+                key, response, datetime.utcnow() + timedelta(seconds=self.ttl)
+            )
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the cache.
+
+        Returns:
+            dict: Dictionary with the number of entries in memory, the hits (from memory and from the
+            database), the misses, the hit ratio, the evictions and the expirations.
+        """
+        with self._lock:
+            lookups = self._hits + self._persistent_hits + self._misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self._hits,
+                "persistent_hits": self._persistent_hits,
+                "misses": self._misses,
+                "hit_ratio": (
+                    (self._hits + self._persistent_hits) / lookups if lookups else 0.0
+                ),
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+    def _store(self, key: str, response: str, expires_at: float):
+        with self._lock:
+            self._entries[key] = (expires_at, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
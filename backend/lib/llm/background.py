@@ -0,0 +1,352 @@
+"""
+Module containing the bounded executor running the background work of the chatbots.
+"""
+
+import time
+from queue import Queue, Full, Empty
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Sequence
+
+from ..log import Log, LogType, Logger
+
+BACKPRESSURE_POLICIES = ("block", "reject", "caller_runs")
+
+
+class BackgroundQueueFullError(RuntimeError):
+    """
+    Raised when a task is submitted to a saturated BackgroundExecutor and the backpressure policy
+    does not allow to wait for a free slot.
+    """
+
+
+class _ForkedCall:
+    """
+    Call queued by BackgroundExecutor.run_concurrently, run by the first of a worker and its caller
+    to claim it.
+    """
+
+    def __init__(self, fn: Callable[[], Any]):
+        self._fn = fn
+        self._lock = Lock()
+        self._is_claimed = False
+        self._done = Event()
+        self._result = None
+        self._exception = None
+
+    def claim(self) -> bool:
+        with self._lock:
+            if self._is_claimed:
+                return False
+            self._is_claimed = True
+            return True
+
+    def run(self) -> None:
+        try:
+            self._result = self._fn()
+        except Exception as exc:
+            # Raised to the caller by result, like a future
+            self._exception = exc
+        finally:
+            self._done.set()
+
+    def run_if_unclaimed(self) -> None:
+        if self.claim():
+            self.run()
+
+    def result(self):
+        self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class BackgroundExecutor:
+    """
+    Bounded pool of worker threads executing background tasks (e.g. the post-message analyses and
+    the final feedback of the conversations).
+
+    Tasks wait in a bounded queue. When the queue is full, the backpressure policy decides what to do:
+
+    * ``block``: the caller waits for a free slot in the queue, up to ``block_timeout`` seconds,
+      after which the task is rejected;
+    * ``reject``: the task is rejected straight away;
+    * ``caller_runs``: the task is executed synchronously by the caller.
+
+    Rejected tasks raise a BackgroundQueueFullError. The callers that must never wait nor run the
+    task themselves, whatever the policy (e.g. the thread of the deadline scheduler), use offer.
+    The tasks that fan out independent calls and wait for their results (e.g. the three post-message
+    analyses) use run_concurrently, which shares the same queue and workers.
+
+    Args:
+        max_workers (int, optional): Number of worker threads. Defaults to 8.
+        max_queue_size (int, optional): Maximum number of tasks waiting for a worker. Defaults to 256.
+        policy (str, optional): Backpressure policy. Defaults to "reject".
+        block_timeout (float, optional): Maximum waiting time (in seconds) of the "block" policy. Defaults to None (no limit).
+        name (str, optional): Name of the executor, used for the worker threads. Defaults to "background".
+        logger (Logger, optional): Logger for the failures of the tasks. Defaults to None (print to the console).
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        max_queue_size: int = 256,
+        policy: str = "reject",
+        block_timeout: float = None,
+        name: str = "background",
+        logger: Logger = None,
+    ):
+        if max_workers < 1:
+            raise ValueError("The executor needs at least one worker.")
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(
+                f"Invalid backpressure policy {policy}. Possible values: {BACKPRESSURE_POLICIES}."
+            )
+
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.name = name
+        self.logger = logger
+
+        self._queue = Queue(maxsize=max_queue_size)
+        self._workers = []
+        self._workers_lock = Lock()
+        self._is_shutdown = False
+
+        self._stats_lock = Lock()
+        self._in_flight = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._caller_runs = 0
+        self._forked = 0
+        self._joined_inline = 0
+        self._total_queue_wait = 0.0
+        self._max_queue_wait = 0.0
+        self._total_run_time = 0.0
+        self._max_run_time = 0.0
+
+    def submit(self, fn: callable, *args, **kwargs) -> None:
+        """
+        Submit a task to the executor.
+
+        Args:
+            fn (callable): the function to execute
+            *args: positional arguments of the function
+            **kwargs: keyword arguments of the function
+
+        Raises:
+            BackgroundQueueFullError: If the executor is saturated and the backpressure policy rejects the task.
+            RuntimeError: If the executor has been shut down.
+
+        Returns:
+            None
+        """
+        if self._is_shutdown:
+            raise RuntimeError(f"The executor {self.name} has been shut down.")
+        self._ensure_workers()
+
+        task = (fn, args, kwargs, time.monotonic())
+        try:
+            if self.policy == "block":
+                self._queue.put(task, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(task)
+        except Full:
+            if self.policy != "caller_runs":
+                with self._stats_lock:
+                    self._rejected += 1
+                raise BackgroundQueueFullError(
+                    f"The executor {self.name} is saturated ({self.max_queue_size} queued tasks)."
+                )
+            with self._stats_lock:
+                self._submitted += 1
+                self._caller_runs += 1
+            self._run(task)
+            return
+
+        with self._stats_lock:
+            self._submitted += 1
+
+    def offer(self, fn: callable, *args, **kwargs) -> bool:
+        """
+        Submit a task to the executor only if the queue has room for it, whatever the backpressure policy.
+
+        Args:
+            fn (callable): the function to execute
+            *args: positional arguments of the function
+            **kwargs: keyword arguments of the function
+
+        Raises:
+            RuntimeError: If the executor has been shut down.
+
+        Returns:
+            bool: True if the task was queued, False if the queue is full (the task is rejected)
+        """
+        if self._is_shutdown:
+            raise RuntimeError(f"The executor {self.name} has been shut down.")
+        self._ensure_workers()
+
+        try:
+            self._queue.put_nowait((fn, args, kwargs, time.monotonic()))
+        except Full:
+            with self._stats_lock:
+                self._rejected += 1
+            return False
+        with self._stats_lock:
+            self._submitted += 1
+        return True
+
+    def run_concurrently(self, calls: Sequence[Callable[[], Any]]) -> list:
+        """
+        Run calls concurrently and wait for their results, like a fork-join: the caller runs the first
+        call while the others are queued. The calls that do not fit in the queue, and the queued calls
+        that no worker has started once the caller is done, are run by the caller itself, so a task of
+        the executor can fan out on it without deadlocking it, even when all the workers are busy.
+
+        Args:
+            calls (Sequence[Callable[[], Any]]): the functions to call, without arguments
+
+        Raises:
+            Exception: The first error raised by a call, once all of them have completed.
+
+        Returns:
+            list: the results of the calls, in order
+        """
+        forked = [_ForkedCall(fn) for fn in calls]
+        queued = 0
+        for call in forked[1:]:
+            if self._is_shutdown:
+                break
+            self._ensure_workers()
+            try:
+                self._queue.put_nowait(
+                    (call.run_if_unclaimed, (), dict(), time.monotonic())
+                )
+            except Full:
+                # The caller runs it when joining
+                break
+            queued += 1
+
+        joined_inline = 0
+        for call in forked:
+            if call.claim():
+                call.run()
+                joined_inline += 1
+        with self._stats_lock:
+            self._submitted += queued
+            self._forked += queued
+            # The first call always runs on the caller
+            self._joined_inline += joined_inline - 1
+        return [call.result() for call in forked]
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the executor.
+
+        Returns:
+            dict: Dictionary with the number of workers, queued and in-flight tasks, the counters of
+            the submitted, completed, failed, rejected and caller-run tasks, the calls of
+            run_concurrently queued for the workers and those run by their callers instead, and the average and maximum
+            queue wait and run time (in seconds) of the executed tasks.
+        """
+        with self._stats_lock:
+            executed = self._completed + self._failed
+            return {
+                "workers": len(self._workers),
+                "max_workers": self.max_workers,
+                "queued": self._queue.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "in_flight": self._in_flight,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "caller_runs": self._caller_runs,
+                "forked": self._forked,
+                "joined_inline": self._joined_inline,
+                "avg_queue_wait": self._total_queue_wait / executed if executed else 0.0,
+                "max_queue_wait": self._max_queue_wait,
+                "avg_run_time": self._total_run_time / executed if executed else 0.0,
+                "max_run_time": self._max_run_time,
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop accepting new tasks and let the workers exit once the queued tasks have been executed.
+
+        Args:
+            wait (bool, optional): Whether to wait for the workers to exit. Defaults to True.
+
+        Returns:
+            None
+        """
+        self._is_shutdown = True
+        with self._workers_lock:
+            workers = list(self._workers)
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _ensure_workers(self):
+        # Workers are started lazily, so that idle executors do not hold any thread
+        if len(self._workers) >= self.max_workers:
+            return
+        with self._workers_lock:
+            while len(self._workers) < self.max_workers:
+                worker = Thread(
+                    target=self._work,
+                    name=f"{self.name}-{len(self._workers)}",
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            try:
+                task = self._queue.get(timeout=1)
+            except Empty:
+                if self._is_shutdown:
+                    return
+                continue
+            if task is None:
+                return
+            self._run(task)
+
+    def _run(self, task):
+        fn, args, kwargs, enqueued_at = task
+        started_at = time.monotonic()
+        queue_wait = started_at - enqueued_at
+        with self._stats_lock:
+            self._in_flight += 1
+
+        failed = False
+        try:
+            fn(*args, **kwargs)
+        except Exception as exc:
+            failed = True
+            self._log_failure(fn, exc)
+        finally:
+            run_time = time.monotonic() - started_at
+            with self._stats_lock:
+                self._in_flight -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+                self._total_queue_wait += queue_wait
+                self._max_queue_wait = max(self._max_queue_wait, queue_wait)
+                self._total_run_time += run_time
+                self._max_run_time = max(self._max_run_time, run_time)
+
+    def _log_failure(self, fn: callable, exc: Exception):
+        message = f"Background task {getattr(fn, '__qualname__', fn)} failed: {exc!r}"
+        if self.logger is not None:
+            self.logger.log(Log(LogType.ERROR, message))
+        else:
+            print(f"[{self.name.upper()}] {message}")
@@ -0,0 +1,253 @@
+"""
+Module containing the circuit breaker of the requests to the chat model.
+"""
+
+import time
+from collections import deque
+from threading import Lock
+from typing import Optional
+
+import httpx
+import openai
+
+from .hedging import is_timeout_error
+from ..metrics import Counter
+
+# States of the circuit breaker
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+LLM_BREAKER_TRANSITIONS = Counter(
+    "teachme_llm_breaker_transitions_total",
+    "Transitions of the circuit breaker of the chat model, by new state (closed, open or half_open).",
+    ("state",),
+)
+
+
+def is_provider_failure(exc: BaseException) -> bool:
+    """
+    Returns True if a request failed because of the model provider: a timeout, a connection error, a
+    server error (5xx) or a rate limit (429). The other errors (e.g. an invalid request) are answers of
+    a healthy provider, and do not count against it in the circuit breaker.
+    """
+    if is_timeout_error(exc) or isinstance(
+        exc, (openai.APIConnectionError, httpx.TransportError)
+    ):
+        return True
+    status_code = getattr(exc, "status_code", None)
+    return isinstance(status_code, int) and (status_code >= 500 or status_code == 429)
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of sending a request to the chat model while the circuit breaker is open.
+
+    Attributes:
+        retry_after (float): Time (in seconds) before the breaker lets a request through again.
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(
+            f"The chat model is unavailable, retry in {retry_after:.0f} seconds."
+        )
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of the requests to the chat model, shared by all the chatbots.
+
+    While the breaker is closed, the outcomes of the last ``window`` requests are recorded: only the
+    failures of the provider (see is_provider_failure) count as failed requests. Once
+    ``min_calls`` of them have been observed, the breaker opens if the share of failed requests
+    reaches ``failure_rate_threshold``, or if the share of requests slower than
+    ``slow_call_duration`` reaches ``slow_call_rate_threshold``: the provider is then overloaded or
+    down, and the requests fail fast with a CircuitOpenError instead of piling up on it.
+
+    After ``open_duration`` seconds the breaker is half open and lets ``half_open_probes`` requests
+    through: if all of them succeed (and are not slow) the breaker closes, otherwise it opens again.
+
+    Args:
+        failure_rate_threshold (float, optional): Share of failed requests that opens the breaker. Defaults to 0.5.
+        slow_call_duration (float, optional): Duration (in seconds) after which a request is slow. Defaults to None (no slow requests).
+        slow_call_rate_threshold (float, optional): Share of slow requests that opens the breaker. Defaults to 0.8.
+        window (int, optional): Number of recent requests the rates are computed on. Defaults to 20.
+        min_calls (int, optional): Requests observed before the breaker can open. Defaults to 10.
+        open_duration (float, optional): Time (in seconds) the breaker stays open before probing the provider. Defaults to 30.
+        half_open_probes (int, optional): Requests let through while half open. Defaults to 3.
+    """
+
+    def __init__(
+        self,
+        failure_rate_threshold: float = 0.5,
+        slow_call_duration: float = None,
+        slow_call_rate_threshold: float = 0.8,
+        window: int = 20,
+        min_calls: int = 10,
+        open_duration: float = 30,
+        half_open_probes: int = 3,
+    ):
+        if not 0 < failure_rate_threshold <= 1:
+            raise ValueError("The failure rate threshold must be in (0, 1].")
+        if not 0 < slow_call_rate_threshold <= 1:
+            raise ValueError("The slow call rate threshold must be in (0, 1].")
+        if half_open_probes < 1:
+            raise ValueError("The breaker needs at least one probe.")
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.min_calls = min(min_calls, window)
+        self.open_duration = open_duration
+        self.half_open_probes = half_open_probes
+
+        self._lock = Lock()
+        self._state = CLOSED
+        # (failed, slow) outcomes of the recent requests, while closed
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        # Generation of the current state: outcomes of requests admitted in another one are ignored
+        self._generation = 0
+        self._probes_sent = 0
+        self._probes_succeeded = 0
+        self._trips = 0
+        self._rejected = 0
+
+    def before_call(self) -> int:
+        """
+        Check that a request can be sent to the chat model.
+
+        Raises:
+            CircuitOpenError: If the breaker is open, or half open with all its probes sent.
+
+        Returns:
+            int: the admission of the request, to pass to record with its outcome
+        """
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_duration:
+                    self._rejected += 1
+                    raise CircuitOpenError(self._retry_after())
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._probes_sent >= self.half_open_probes:
+                    self._rejected += 1
+                    raise CircuitOpenError(self._retry_after())
+                self._probes_sent += 1
+            return self._generation
+
+    def record(self, admission: int, success: bool, duration: float) -> None:
+        """
+        Record the outcome of a request admitted by before_call.
+
+        Args:
+            admission (int): the value returned by before_call
+            success (bool): whether the request succeeded
+            duration (float): duration (in seconds) of the request
+
+        Returns:
+            None
+        """
+        slow = self.slow_call_duration is not None and duration >= self.slow_call_duration
+        with self._lock:
+            if admission != self._generation:
+                return
+            if self._state == HALF_OPEN:
+                if not success or slow:
+                    self._open()
+                    return
+                self._probes_succeeded += 1
+                if self._probes_succeeded >= self.half_open_probes:
+                    self._transition(CLOSED)
+                return
+
+            self._outcomes.append((not success, slow))
+            if len(self._outcomes) < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            slow_calls = sum(1 for _, slow in self._outcomes if slow)
+            if (
+                failures >= self.failure_rate_threshold * len(self._outcomes)
+                or slow_calls >= self.slow_call_rate_threshold * len(self._outcomes)
+            ):
+                self._open()
+
+    def release(self, admission: int) -> None:
+        """
+        Give back the admission of a request cancelled before its outcome was known, so that a half
+        open breaker can send another probe in its place.
+
+        Args:
+            admission (int): the value returned by before_call
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if admission == self._generation and self._state == HALF_OPEN:
+                self._probes_sent = max(0, self._probes_sent - 1)
+
+    def _open(self) -> None:
+        # Called holding the lock
+        self._opened_at = time.monotonic()
+        self._trips += 1
+        self._transition(OPEN)
+
+    def _transition(self, state: str) -> None:
+        # Called holding the lock
+        self._state = state
+        self._generation += 1
+        self._outcomes.clear()
+        self._probes_sent = 0
+        self._probes_succeeded = 0
+        LLM_BREAKER_TRANSITIONS.labels(state).inc()
+
+    def _retry_after(self) -> float:
+        # Called holding the lock
+        if self._state != OPEN:
+            # Half open: the probes will settle the state shortly
+            return 1.0
+        return max(1.0, self.open_duration - (time.monotonic() - self._opened_at))
+
+    @property
+    def state(self) -> str:
+        """Returns the state of the breaker (closed, open or half_open)."""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_duration:
+                return HALF_OPEN
+            return self._state
+
+    def retry_after(self) -> Optional[float]:
+        """Returns the time (in seconds) before a request can be sent again, or None if the breaker is closed."""
+        with self._lock:
+            if self._state == CLOSED:
+                return None
+            return self._retry_after()
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the breaker.
+
+        Returns:
+            dict: Dictionary with the state of the breaker, whether it is open, the times it opened, the
+            requests rejected, and the failure and slow rates of the recent requests.
+        """
+        state = self.state
+        with self._lock:
+            outcomes = len(self._outcomes)
+            return {
+                "state": state,
+                "open": int(state == OPEN),
+                "trips": self._trips,
+                "rejected": self._rejected,
+                "failure_rate": (
+                    sum(1 for failed, _ in self._outcomes if failed) / outcomes
+                    if outcomes
+                    else 0.0
+                ),
+                "slow_call_rate": (
+                    sum(1 for _, slow in self._outcomes if slow) / outcomes
+                    if outcomes
+                    else 0.0
+                ),
+            }
@@ -1,25 +1,183 @@
 """Chatbots for TeachMe project.
 """
 
+import functools
+import numbers
 import warnings
 import time
-from threading import Thread
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from threading import Event, Thread
 import json
+from typing import Generator, Iterator, Optional
 
 from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
 from langchain.agents import create_openai_tools_agent, AgentExecutor
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_mongodb.chat_message_histories import MongoDBChatMessageHistory
+from langchain_core.chat_history import (
+    BaseChatMessageHistory,
+    InMemoryChatMessageHistory,
+)
+from langchain_core.messages import AIMessage, BaseMessage, BaseMessageChunk
 
 from .PROMPTS import *
+from .analysis_cache import AnalysisCache
+from .background import BackgroundExecutor, BackgroundQueueFullError
+from .clients import ChatModelPool
+from .jobs import (
+    JobQueue,
+    OVERALL_FEEDBACK_JOB,
+    POST_MESSAGE_ACTIONS_JOB,
+    RUNNING_FEEDBACK_JOB,
+)
+from .breaker import CircuitBreaker, CircuitOpenError, is_provider_failure
+from .hedging import (
+    LLMAttemptCancelledError,
+    LLMCallPolicy,
+    LLMTimeoutError,
+    is_timeout_error,
+)
+from .scheduler import LLMGrant, LLMScheduler, get_priority
+from .prompt_templates import (
+    get_conversation_prompt_template,
+    get_post_message_prompt_template,
+    get_system_prompt_conversation_template,
+    render_conversation_system_prompt,
+)
+from .history import (
+    BufferedChatMessageHistory,
+    CollectionChatMessageHistory,
+    CompactingChatMessageHistory,
+    HistoryCompactionSettings,
+)
+from .turns import TurnQueue
 from ..database import Connector, MongoDBConnector, MongoDB, Conversation
 from ..log import LogType, Log, Logger
+from ..metrics import Counter, Histogram
 
 # pylint: disable=bare-except
 
+POST_MESSAGE_ACTIONS_MODES = ("serial", "parallel", "combined")
+
+# "final": the feedback is computed from the whole transcript when the conversation ends,
+# "incremental": running notes are kept as the turns arrive, and only finalized at the end
+FEEDBACK_MODES = ("final", "incremental")
+
+# Profile of the conversations created without a level, difficulty or topic
+DEFAULT_USER_LEVEL = "intermediate"
+DEFAULT_CONVERSATION_DIFFICULTY = "medium"
+DEFAULT_CONVERSATION_TOPIC = "left free"
+
+# Reply of the chatbot while the model provider is unavailable (the circuit breaker is open)
+DEGRADED_MODE_REPLY = (
+    "Sorry, I need a moment to think. Please wait a few seconds and tell me again."
+)
+
+# Rough memory footprint of a chatbot without history (objects, prompt template, configuration)
+CHATBOT_BASE_MEMORY_BYTES = 32 * 1024
+
+LLM_REQUESTS = Counter(
+    "teachme_llm_requests_total",
+    "Requests to the chat model, by prompt type and outcome (ok, error, timeout, cancelled or rejected).",
+    ("prompt_type", "status"),
+)
+LLM_REQUEST_DURATION = Histogram(
+    "teachme_llm_request_duration_seconds",
+    "Duration of the requests to the chat model, until the last token.",
+    ("prompt_type",),
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "teachme_llm_time_to_first_token_seconds",
+    "Time before the first token of the streamed requests to the chat model.",
+    ("prompt_type",),
+)
+LLM_TOKENS = Counter(
+    "teachme_llm_tokens_total",
+    "Tokens sent to (input) and generated by (output) the chat model, estimated when the provider does not report them.",
+    ("prompt_type", "direction"),
+)
+
+# Tokens reserved for the response of a request to the chat model, until its usage is known
+ESTIMATED_OUTPUT_TOKENS = 256
+
+def _prompt_messages(prompt) -> list:
+    return prompt.to_messages() if hasattr(prompt, "to_messages") else list(prompt)
+
+
+def _estimate_input_tokens(prompt) -> int:
+    # About 4 characters per token
+    return sum(len(str(message.content)) for message in _prompt_messages(prompt)) // 4
+
+
+def _record_token_usage(prompt_type: str, prompt, response: BaseMessage) -> int:
+    """Records the tokens used by a request to the chat model and returns their total."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        input_tokens, output_tokens = usage["input_tokens"], usage["output_tokens"]
+    else:
+        input_tokens = _estimate_input_tokens(prompt)
+        output_tokens = len(str(response.content)) // 4
+    LLM_TOKENS.labels(prompt_type, "input").inc(input_tokens)
+    LLM_TOKENS.labels(prompt_type, "output").inc(output_tokens)
+    return input_tokens + output_tokens
+
+
+def _timeout_kwargs(timeout: Optional[float]) -> dict:
+    # Passed to the model provider, which aborts the HTTP request at the timeout. Without a
+    # deadline nothing is passed, so that the default timeout of the provider client applies.
+    return {"timeout": timeout} if timeout is not None else {}
+
+
+def _remaining_timeout(timeout: Optional[float], since: float) -> Optional[float]:
+    # What is left of a deadline of ``timeout`` seconds counted from ``since`` (a perf_counter time)
+    if timeout is None:
+        return None
+    return max(0.0, timeout - (time.perf_counter() - since))
+
+
+def _load_json(content: str):
+    try:
+        return json.loads(content)
+    except:
+        return None
+
+
+def validate_synonyms(synonyms) -> Optional[list]:
+    """Returns the synonyms challenge if it has the expected shape (a list), None otherwise."""
+    return synonyms if isinstance(synonyms, list) else None
+
+
+def validate_pronunciation(pronunciation) -> Optional[list]:
+    """Returns the pronunciation challenge if it has the expected shape (a list), None otherwise."""
+    return pronunciation if isinstance(pronunciation, list) else None
+
+
+def validate_message_feedback(feedback) -> Optional[dict]:
+    """Returns the message feedback if it has the expected shape (an object with the "hasMistake"
+    and "messageFeedback" attributes), None otherwise."""
+    if (
+        not isinstance(feedback, dict)
+        or "hasMistake" not in feedback
+        or "messageFeedback" not in feedback
+    ):
+        return None
+    return feedback
+
+
+def validate_combined_post_message_actions(response) -> Optional[dict]:
+    """Returns the combined post-message analyses if all of them have the expected shape, None otherwise."""
+    if (
+        not isinstance(response, dict)
+        or validate_synonyms(response.get("synonyms")) is None
+        or validate_pronunciation(response.get("pronunciation")) is None
+        or validate_message_feedback(response.get("feedback")) is None
+    ):
+        return None
+    return response
+
 
 class BaseChatBot:
     """
@@ -27,7 +185,10 @@ class BaseChatBot:
 
     :ivar str api_key: API key for accessing the chatbot model.
     :ivar float temperature: Sampling temperature parameter for generating responses.
-    :ivar BaseChatModel _chat_base: Instance of the chat model used by the bot.
+    :ivar BaseChatModel _chat_base: Instance of the chat model used by the bot. It is taken from the model pool, if any.
+    :ivar LLMScheduler _scheduler: Scheduler of the requests to the chat model, shared by the chatbots of a manager.
+    :ivar LLMCallPolicy _call_policy: Deadlines and hedging of the requests to the chat model, shared by the chatbots of a manager.
+    :ivar CircuitBreaker _circuit_breaker: Circuit breaker of the requests to the chat model, shared by the chatbots of a manager, or None.
     """
 
     def __init__(
@@ -37,17 +198,217 @@ class BaseChatBot:
         model_version: str = "gpt-3.5-turbo",
         temperature: float = 0.7,
         logger: Logger = None,
+        model_pool: ChatModelPool = None,
+        scheduler: LLMScheduler = None,
+        call_policy: LLMCallPolicy = None,
+        circuit_breaker: CircuitBreaker = None,
     ):
         self.api_key = api_key
         self.temperature = temperature
         self.logger = logger
+        # Without a shared scheduler, the requests of the chatbot are not limited
+        self._scheduler = scheduler if scheduler is not None else LLMScheduler()
+        # Without a shared policy, the requests of the chatbot have no deadline and are not hedged
+        self._call_policy = call_policy if call_policy is not None else LLMCallPolicy()
+        # Without a breaker, the requests are sent even while the model provider is failing
+        self._circuit_breaker = circuit_breaker
+
+        if model_pool is not None:
+            self._chat_base: BaseChatModel = model_pool.get(model_version, temperature)
+        else:
+            self._chat_base: BaseChatModel = model(
+                model=model_version,
+                api_key=self.api_key,
+                temperature=temperature,
+            )
 
-        self._chat_base: BaseChatModel = model(
-            model=model_version,
-            api_key=self.api_key,
-            temperature=temperature,
+    def _invoke_model(self, prompt_type: str, prompt) -> BaseMessage:
+        """Invokes the chat model. Every request to the chat model goes through this method or
+        ``_stream_model``, which wait for the scheduler with the priority of the prompt type, apply
+        the deadline of the prompt type and record the LLM metrics of the prompt type. The requests
+        may be hedged, according to the call policy, and fail fast while the circuit breaker is open.
+
+        :param prompt_type: name of the system prompt of the request.
+        :type prompt_type: str
+        :param prompt: the prompt (a prompt value or a list of messages).
+        :raises LLMTimeoutError: if the chat model did not respond before the deadline of the prompt type.
+        :raises CircuitOpenError: if the circuit breaker is open.
+        :return: the response of the chat model.
+        :rtype: BaseMessage
+        """
+        return self._call_policy.call(
+            prompt_type,
+            lambda timeout, cancelled: self._invoke_model_once(
+                prompt_type, prompt, timeout, cancelled
+            ),
         )
 
+    def _invoke_model_once(
+        self,
+        prompt_type: str,
+        prompt,
+        timeout: Optional[float],
+        cancelled: Optional[Event] = None,
+    ) -> BaseMessage:
+        admission = self._admit(prompt_type)
+        queued_at = time.perf_counter()
+        with self._slot(prompt_type, prompt, admission, timeout, cancelled) as grant:
+            # The wait for the scheduler counts in the deadline of the request
+            timeout = _remaining_timeout(timeout, queued_at)
+            started_at = time.perf_counter()
+            try:
+                response = self._chat_base.invoke(prompt, **_timeout_kwargs(timeout))
+            except Exception as exc:
+                self._record_outcome(
+                    admission,
+                    not is_provider_failure(exc),
+                    time.perf_counter() - started_at,
+                )
+                if timeout is not None and is_timeout_error(exc):
+                    LLM_REQUESTS.labels(prompt_type, "timeout").inc()
+                    raise LLMTimeoutError(
+                        f"The {prompt_type} request did not complete in {timeout} seconds."
+                    ) from exc
+                LLM_REQUESTS.labels(prompt_type, "error").inc()
+                raise
+            finally:
+                LLM_REQUEST_DURATION.labels(prompt_type).observe(
+                    time.perf_counter() - started_at
+                )
+            self._record_outcome(admission, True, time.perf_counter() - started_at)
+            LLM_REQUESTS.labels(prompt_type, "ok").inc()
+            grant.settle(_record_token_usage(prompt_type, prompt, response))
+        return response
+
+    def _stream_model(self, prompt_type: str, prompt) -> Iterator[BaseMessageChunk]:
+        """Streams the response of the chat model, recording the LLM metrics of the prompt type.
+        The deadline of the prompt type bounds the wait for each chunk; streams are never hedged.
+
+        :param prompt_type: name of the system prompt of the request.
+        :type prompt_type: str
+        :param prompt: the prompt (a prompt value or a list of messages).
+        :raises LLMTimeoutError: if a chunk did not arrive before the deadline of the prompt type.
+        :raises CircuitOpenError: if the circuit breaker is open.
+        :return: an iterator over the chunks of the response.
+        :rtype: Iterator[BaseMessageChunk]
+        """
+        timeout = self._call_policy.timeout(prompt_type)
+        admission = self._admit(prompt_type)
+        with self._slot(prompt_type, prompt, admission, timeout) as grant:
+            started_at = time.perf_counter()
+            response = None
+            status = "error"
+            try:
+                for chunk in self._chat_base.stream(prompt, **_timeout_kwargs(timeout)):
+                    if response is None:
+                        LLM_TIME_TO_FIRST_TOKEN.labels(prompt_type).observe(
+                            time.perf_counter() - started_at
+                        )
+                        response = chunk
+                    else:
+                        response = response + chunk
+                    yield chunk
+                status = "ok"
+            except GeneratorExit:
+                status = "cancelled"
+                raise
+            except Exception as exc:
+                self._record_outcome(
+                    admission,
+                    not is_provider_failure(exc),
+                    time.perf_counter() - started_at,
+                )
+                if timeout is not None and is_timeout_error(exc):
+                    status = "timeout"
+                    raise LLMTimeoutError(
+                        f"The {prompt_type} request did not stream in {timeout} seconds."
+                    ) from exc
+                raise
+            finally:
+                if status == "ok" or (status == "cancelled" and response is not None):
+                    # A stream cancelled by the client after the first token still reached the provider
+                    self._record_outcome(
+                        admission, True, time.perf_counter() - started_at
+                    )
+                elif status == "cancelled":
+                    self._release_admission(admission)
+                LLM_REQUESTS.labels(prompt_type, status).inc()
+                LLM_REQUEST_DURATION.labels(prompt_type).observe(
+                    time.perf_counter() - started_at
+                )
+            if response is not None:
+                grant.settle(_record_token_usage(prompt_type, prompt, response))
+
+    @contextmanager
+    def _slot(
+        self,
+        prompt_type: str,
+        prompt,
+        admission: Optional[int],
+        timeout: Optional[float],
+        cancelled: Optional[Event] = None,
+    ) -> Iterator[LLMGrant]:
+        """Waits for the scheduler, at most until the deadline of the request, then runs the body of the
+        with statement as a running request. A request that could not start gives back its admission.
+
+        :raises LLMTimeoutError: if the request could not start before its deadline.
+        :raises LLMAttemptCancelledError: if the request was cancelled before it started.
+        """
+        queued_at = time.perf_counter()
+        started = False
+        try:
+            with self._scheduler.slot(
+                get_priority(prompt_type),
+                self._estimate_tokens(prompt),
+                timeout=timeout,
+                cancelled=cancelled,
+            ) as grant:
+                if _remaining_timeout(timeout, queued_at) == 0:
+                    # Admitted at its deadline: not sent, the provider is not to blame
+                    raise LLMTimeoutError(
+                        f"The {prompt_type} request could not start in {timeout} seconds."
+                    )
+                if cancelled is not None and cancelled.is_set():
+                    # The other attempt succeeded while this one was being admitted
+                    raise LLMAttemptCancelledError()
+                started = True
+                yield grant
+        except BaseException as exc:
+            if not started:
+                self._release_admission(admission)
+                if isinstance(exc, LLMTimeoutError):
+                    LLM_REQUESTS.labels(prompt_type, "timeout").inc()
+                elif isinstance(exc, LLMAttemptCancelledError):
+                    LLM_REQUESTS.labels(prompt_type, "cancelled").inc()
+            raise
+
+    def _admit(self, prompt_type: str) -> Optional[int]:
+        """Checks the circuit breaker before a request, returning its admission (None without a breaker).
+
+        :raises CircuitOpenError: if the circuit breaker is open.
+        """
+        if self._circuit_breaker is None:
+            return None
+        try:
+            return self._circuit_breaker.before_call()
+        except CircuitOpenError:
+            LLM_REQUESTS.labels(prompt_type, "rejected").inc()
+            raise
+
+    def _record_outcome(
+        self, admission: Optional[int], success: bool, duration: float
+    ) -> None:
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.record(admission, success, duration)
+
+    def _release_admission(self, admission: Optional[int]) -> None:
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.release(admission)
+
+    @staticmethod
+    def _estimate_tokens(prompt) -> int:
+        return _estimate_input_tokens(prompt) + ESTIMATED_OUTPUT_TOKENS
+
     def log(self, message: str):
         """Logs a message using the logger if available, otherwise prints it to the console.
 
@@ -61,6 +422,20 @@ class BaseChatBot:
 
 
 class PostConversationChatBot(BaseChatBot):
+    """
+    Chatbot computing the analyses on the messages of a conversation.
+
+    The three post-message analyses (synonyms, pronunciation and message feedback) can be run:
+
+    * ``serial``: one after the other, with three LLM calls;
+    * ``parallel``: concurrently, with three LLM calls;
+    * ``combined``: with a single LLM call returning the three analyses at once. The analyses that
+      do not pass validation are retried individually and concurrently.
+
+    The concurrent calls (analyses, feedback and summaries) run on the background executor, or one
+    after the other if the chatbot has none.
+    """
+
     def __init__(
         self,
         api_key: str,
@@ -70,72 +445,461 @@ class PostConversationChatBot(BaseChatBot):
         temperature: float = 0.7,
         model: BaseChatModel = ChatOpenAI,
         model_version: str = "gpt-3.5-turbo",
+        post_actions_mode: str = "parallel",
+        analysis_cache: AnalysisCache = None,
+        model_pool: ChatModelPool = None,
+        scheduler: LLMScheduler = None,
+        call_policy: LLMCallPolicy = None,
+        circuit_breaker: CircuitBreaker = None,
+        executor: BackgroundExecutor = None,
     ):
-        super().__init__(api_key, model, model_version, temperature, logger)
+        super().__init__(
+            api_key,
+            model,
+            model_version,
+            temperature,
+            logger,
+            model_pool,
+            scheduler,
+            call_policy,
+            circuit_breaker,
+        )
 
         self._db = db
         self._conversation_id = conversation_id
+        self._analysis_cache = analysis_cache
+        self._executor = executor
 
         if self._conversation_id is None:
             raise ValueError("The conversation ID must be set.")
 
+        if post_actions_mode not in POST_MESSAGE_ACTIONS_MODES:
+            raise ValueError(
+                f"Invalid post actions mode {post_actions_mode}. Possible values: {POST_MESSAGE_ACTIONS_MODES}."
+            )
+        self._post_actions_mode = post_actions_mode
+
         self._chat = model
         self._config = None
 
-    def _do_post_message_action(self, system_prompt: str, user_message: str):
-        prompt_template = ChatPromptTemplate.from_messages(
-            [("system", system_prompt), ("user", "{user_message}")]
-        )
+    def _do_post_message_action(
+        self, prompt_type: str, system_prompt: str, user_message: str
+    ):
+        prompt_template = get_post_message_prompt_template(system_prompt)
         prompt_template = prompt_template.invoke({"user_message": user_message})
-        response = self._chat_base.invoke(prompt_template)
+        response = self._invoke_model(prompt_type, prompt_template)
         # Extract choice
-        response = response.content  # TODO We should validate the content :)
+        response = response.content
+        # e.g. a list of content blocks, or an empty reply: nothing that could be stored
+        if not isinstance(response, str) or not response.strip():
+            raise ValueError(
+                f"Invalid {prompt_type} response of the chat model: {response!r}"
+            )
+        return response
+
+    def _do_cached_post_message_action(
+        self, prompt_name: str, user_message: str, validate: callable
+    ):
+        """Runs a post-message analysis going through the analysis cache, if any. Only the responses
+        passing validation are cached.
+
+        :param prompt_name: name of the system prompt of the analysis.
+        :type prompt_name: str
+        :param user_message: message sent by the user to the chatbot.
+        :type user_message: str
+        :param validate: shape check of the parsed response, returning None if the response is invalid.
+        :type validate: callable
+        :return: the raw response of the model.
+        :rtype: str
+        """
+        if self._analysis_cache is not None:
+            prompt_version = get_prompt_version(prompt_name)
+            response = self._analysis_cache.get(
+                prompt_name, prompt_version, user_message
+            )
+            if response is not None:
+                return response
+
+        response = self._do_post_message_action(
+            prompt_name, get_prompt(prompt_name), user_message
+        )
+
+        if (
+            self._analysis_cache is not None
+            and validate(_load_json(response)) is not None
+        ):
+            self._analysis_cache.put(
+                prompt_name, prompt_version, user_message, response
+            )
         return response
 
     def _do_synonym_challenge(self, user_message: str):
-        challenge = self._do_post_message_action(
-            get_synonym_challenge_prompt(), user_message
+        challenge = self._do_cached_post_message_action(
+            "CHALLENGE_SYNONYMS_SYSTEM_PROMPT", user_message, validate_synonyms
         )
         return challenge
 
     def _do_pronunciation_challenge(self, user_message: str):
-        challenge = self._do_post_message_action(
-            get_pronunciation_challenge_prompt(), user_message
+        challenge = self._do_cached_post_message_action(
+            "CHALLENGE_PRONUNCIATION_SYSTEM_PROMPT",
+            user_message,
+            validate_pronunciation,
         )
         return challenge
 
     def _do_message_feedback(self, user_message: str):
-        feedback = self._do_post_message_action(
-            get_message_feedback_prompt(), user_message
+        feedback = self._do_cached_post_message_action(
+            "MESSAGE_FEEDBACK_SYSTEM_PROMPT", user_message, validate_message_feedback
         )
         return feedback
 
     def _do_overall_conversation_feedback(self, full_conversation: str):
         feedback = self._do_post_message_action(
-            get_prompt(prompt_name="FINAL_FEEDBACK_SYSTEM_PROMPT"), full_conversation
+            "FINAL_FEEDBACK_SYSTEM_PROMPT",
+            get_prompt(prompt_name="FINAL_FEEDBACK_SYSTEM_PROMPT"),
+            full_conversation,
         )
         return feedback
 
     def _do_user_opinion_summary(self, full_conversation: str):
         summary = self._do_post_message_action(
-            get_roles_reversed_user_summary_prompt(), full_conversation
+            "USER_OPINION_SYNTHESIS",
+            get_roles_reversed_user_summary_prompt(),
+            full_conversation,
         )
         return summary
 
+    def _do_running_feedback(self, previous_notes: Optional[str], transcript: str):
+        return self._do_post_message_action(
+            "RUNNING_FEEDBACK_SYSTEM_PROMPT",
+            get_running_feedback_prompt(),
+            (
+                transcript
+                if previous_notes is None
+                else f"Current notes: {previous_notes}\n\n{transcript}"
+            ),
+        )
+
+    def _do_running_opinion_summary(self, previous_summary: Optional[str], transcript: str):
+        return self._do_post_message_action(
+            "RUNNING_OPINION_SYNTHESIS",
+            get_running_opinion_summary_prompt(),
+            (
+                transcript
+                if previous_summary is None
+                else f"Current summary: {previous_summary}\n\n{transcript}"
+            ),
+        )
+
+    def _do_combined_post_message_actions(self, user_message: str):
+        response = _load_json(
+            self._do_cached_post_message_action(
+                "COMBINED_POST_MESSAGE_SYSTEM_PROMPT",
+                user_message,
+                validate_combined_post_message_actions,
+            )
+        )
+        if not isinstance(response, dict):
+            return None, None, None
+        return (
+            validate_synonyms(response.get("synonyms")),
+            validate_pronunciation(response.get("pronunciation")),
+            validate_message_feedback(response.get("feedback")),
+        )
+
+    def _run_concurrently(self, calls: list) -> list:
+        if self._executor is None:
+            return [call() for call in calls]
+        return self._executor.run_concurrently(calls)
+
+    def _do_parallel_post_message_actions(self, user_message: str, actions: list):
+        return self._run_concurrently(
+            [functools.partial(action, user_message) for action in actions]
+        )
+
     def do_all_post_conversation_actions(self, user_message: str):
-        synonyms = self._do_synonym_challenge(user_message)
-        pronunciation = self._do_pronunciation_challenge(user_message)
-        feedback = self._do_message_feedback(user_message)
-        return synonyms, pronunciation, feedback
+        """Computes the synonyms, pronunciation and message-feedback analyses of a user message.
+
+        :param user_message: message sent by the user to the chatbot.
+        :type user_message: str
+        :return: the raw synonyms, pronunciation and feedback responses of the model.
+        :rtype: tuple[str, str, str]
+        """
+        actions = [
+            self._do_synonym_challenge,
+            self._do_pronunciation_challenge,
+            self._do_message_feedback,
+        ]
+
+        if self._post_actions_mode == "serial":
+            return tuple(action(user_message) for action in actions)
+
+        if self._post_actions_mode == "parallel":
+            return tuple(self._do_parallel_post_message_actions(user_message, actions))
+
+        # Combined mode: the analyses that did not pass validation are asked again individually
+        results = [
+            json.dumps(result) if result is not None else None
+            for result in self._do_combined_post_message_actions(user_message)
+        ]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            self.log(
+                f"Combined post-message analyses for conversation {self._conversation_id} incomplete, retrying {len(missing)} of them."
+            )
+            retried = self._do_parallel_post_message_actions(
+                user_message, [actions[i] for i in missing]
+            )
+            for i, result in zip(missing, retried):
+                results[i] = result
+        return tuple(results)
 
     def do_overall_conversation_feedback(self, full_conversation: str):
         feedback = self._do_overall_conversation_feedback(full_conversation)
         return feedback
 
+    def do_conversation_summary(
+        self, previous_summary: Optional[str], transcript: str
+    ) -> str:
+        """Folds the transcript of some messages into the rolling summary of the conversation.
+
+        :param previous_summary: current summary of the conversation, None if there is none yet.
+        :type previous_summary: Optional[str]
+        :param transcript: formatted transcript of the messages to fold into the summary.
+        :type transcript: str
+        :return: the updated summary.
+        :rtype: str
+        """
+        content = (
+            transcript
+            if previous_summary is None
+            else f"Current summary: {previous_summary}\n\n{transcript}"
+        )
+        return self._do_post_message_action(
+            "CONVERSATION_SUMMARY_SYSTEM_PROMPT",
+            get_conversation_summary_prompt(),
+            content,
+        )
+
     def do_roles_reversed_challenge(self, full_conversation):
         summary = self._do_user_opinion_summary(full_conversation)
         return summary
 
+    def set_post_message_analysis(self, user_message: str, message_index: int):
+        """Computes the synonyms, pronunciation and message-feedback analyses of a user message and
+        sets them on the message in the managed conversation.
+
+        :param user_message: message sent by the user to the chatbot.
+        :type user_message: str
+        :param message_index: index of the user message in the managed conversation.
+        :type message_index: int
+        """
+        synonyms, pronunciation, feedback = self.do_all_post_conversation_actions(
+            user_message
+        )
+
+        # Validate json
+        syn_json = validate_synonyms(_load_json(synonyms))
+        pron_json = validate_pronunciation(_load_json(pronunciation))
+        feed_json = validate_message_feedback(_load_json(feedback))
+
+        mc_collection = self._db.get_collection("managed_conversations")
+        mc_collection.set_message_analysis(
+            self._conversation_id,
+            message_index,
+            feedback=feed_json,
+            synonyms=syn_json,
+            pronunciation=pron_json,
+        )
+
+    def set_overall_feedback_and_summary(self, formatted_conversation_string: str):
+        """Computes the overall feedback and the user opinion summary of the conversation and sets
+        them in the managed conversation.
+
+        :param formatted_conversation_string: overall formatted chat-history.
+        :type formatted_conversation_string: str
+        """
+        # The two calls are independent
+        feedback, summary = self._run_concurrently(
+            [
+                functools.partial(
+                    self.do_overall_conversation_feedback,
+                    full_conversation=formatted_conversation_string,
+                ),
+                functools.partial(
+                    self.do_roles_reversed_challenge, formatted_conversation_string
+                ),
+            ]
+        )
+
+        mc_collection = self._db.get_collection("managed_conversations")
+        mc_collection.set_overall_feedback(self._conversation_id, feedback)
+        mc_collection.set_user_opinion_summary(self._conversation_id, summary)
+
+    def update_running_feedback(self, min_new_messages: int = 1) -> bool:
+        """Folds the messages not covered yet by the running feedback notes and opinion summary of
+        the conversation into them, with two concurrent LLM calls on the new messages only.
+
+        Concurrent updates of the same conversation do not overwrite each other: the notes are only
+        set if no other update completed in the meantime, otherwise the update is dropped and its
+        messages are folded by the next one.
+
+        :param min_new_messages: minimum number of new messages to run the update, defaults to 1.
+        :type min_new_messages: int, optional
+        :return: True if the notes were updated, False otherwise.
+        :rtype: bool
+        """
+        mc_collection = self._db.get_collection("managed_conversations")
+        managed = mc_collection.get_by_id(self._conversation_id)
+        if managed is None:
+            return False
+        folded = managed.running_feedback_messages or 0
+        messages_count = len(managed.messages)
+        if messages_count - folded < min_new_messages:
+            return False
+
+        transcript = managed.format_messages(folded, messages_count)
+        notes, summary = self._run_concurrently(
+            [
+                functools.partial(
+                    self._do_running_feedback, managed.running_feedback, transcript
+                ),
+                functools.partial(
+                    self._do_running_opinion_summary,
+                    managed.running_opinion_summary,
+                    transcript,
+                ),
+            ]
+        )
+        return mc_collection.set_running_feedback(
+            self._conversation_id, notes, summary, messages_count, folded
+        )
+
+    def finalize_overall_feedback_and_summary(self):
+        """Computes the overall feedback and the user opinion summary of the ended conversation and
+        sets them in the managed conversation.
+
+        If running notes have been kept during the conversation, only the messages after them are sent
+        along with the notes, otherwise the whole transcript is sent. The two calls run concurrently.
+        """
+        mc_collection = self._db.get_collection("managed_conversations")
+        managed = mc_collection.get_by_id(self._conversation_id)
+        if managed is None:
+            return
+        if managed.running_feedback is None:
+            self.set_overall_feedback_and_summary(managed.format_messages())
+            return
+
+        folded = managed.running_feedback_messages
+        delta = managed.format_messages(folded)
+        calls = [
+            functools.partial(
+                self.do_overall_conversation_feedback,
+                full_conversation=(
+                    f"Notes on the first {folded} messages of the conversation: {managed.running_feedback}\n\n"
+                    + (f"Transcript of the rest of the conversation:\n{delta}" if delta else "")
+                ),
+            )
+        ]
+        if delta:
+            calls.append(
+                functools.partial(
+                    self._do_running_opinion_summary,
+                    managed.running_opinion_summary,
+                    delta,
+                )
+            )
+        results = self._run_concurrently(calls)
+        feedback = results[0]
+        summary = results[1] if delta else managed.running_opinion_summary
+
+        mc_collection.set_overall_feedback(self._conversation_id, feedback)
+        mc_collection.set_user_opinion_summary(self._conversation_id, summary)
+
+
+class ConversationPreparationChatBot(BaseChatBot):
+    """
+    Chatbot preparing a conversation before it starts: it renders the system prompt of the
+    conversation and generates its opening turn, which are stored in the conversation so that the
+    chatbot of the conversation serves them instead of computing them.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        conversation_id: str,
+        db: MongoDB,
+        logger: Logger = None,
+        temperature: float = 0.7,
+        model: BaseChatModel = ChatOpenAI,
+        model_version: str = "gpt-3.5-turbo",
+        model_pool: ChatModelPool = None,
+        scheduler: LLMScheduler = None,
+        call_policy: LLMCallPolicy = None,
+        circuit_breaker: CircuitBreaker = None,
+    ):
+        super().__init__(
+            api_key,
+            model,
+            model_version,
+            temperature,
+            logger,
+            model_pool,
+            scheduler,
+            call_policy,
+            circuit_breaker,
+        )
+
+        self._db = db
+        self._conversation_id = conversation_id
+
+        if self._conversation_id is None:
+            raise ValueError("The conversation ID must be set.")
+
+    def prepare(self) -> bool:
+        """Renders the system prompt and generates the opening turn of the conversation, then stores
+        them in the conversation unless it has started in the meantime.
+
+        :raises RuntimeError: if the conversation continues a conversation whose opinion summary is
+            not ready yet.
+        :return: True if the system prompt and the opening turn were stored, False if the conversation
+            does not exist or has already started.
+        :rtype: bool
+        """
+        c_collection = self._db.get_collection("conversations")
+        conversation = c_collection.find_by_id(self._conversation_id)
+        if conversation is None or conversation.started_at is not None:
+            return False
+
+        addendum = None
+        if conversation.parent_conversation_id is not None:
+            mc_collection = self._db.get_collection("managed_conversations")
+            managed = mc_collection.get_by_id(conversation.parent_conversation_id)
+            if managed is None or managed.role_reversed_prompt is None:
+                raise RuntimeError(
+                    f"The opinion summary of the parent of conversation {self._conversation_id} is not ready yet."
+                )
+            addendum = get_roles_reversed_system_prompt_addendum(
+                managed.role_reversed_prompt
+            )
+
+        system_prompt = render_conversation_system_prompt(
+            conversation.user_level or DEFAULT_USER_LEVEL,
+            conversation.difficulty or DEFAULT_CONVERSATION_DIFFICULTY,
+            conversation.topic or DEFAULT_CONVERSATION_TOPIC,
+            addendum,
+        )
+        prompt = get_system_prompt_conversation_template(system_prompt).invoke(
+            {"history": [], "answer": get_conversation_opening_instruction()}
+        )
+        opening_message = self._invoke_model(
+            "CONVERSATION_OPENING_INSTRUCTION", prompt
+        ).content
+
+        return c_collection.set_opening(
+            self._conversation_id, system_prompt, opening_message
+        )
+
 
 class ConversationalChatBot(BaseChatBot):
     def __init__(
@@ -148,10 +912,46 @@ class ConversationalChatBot(BaseChatBot):
         db: MongoDB = None,
         idle_timeout: int = 300,  # in seconds | 300 seconds = 5 minutes
         logger: Logger = None,
+        post_actions_mode: str = "parallel",
+        executor: BackgroundExecutor = None,
+        history_compaction: HistoryCompactionSettings = None,
+        analysis_cache: AnalysisCache = None,
+        model_pool: ChatModelPool = None,
+        scheduler: LLMScheduler = None,
+        call_policy: LLMCallPolicy = None,
+        job_queue: JobQueue = None,
+        feedback_mode: str = "final",
+        running_feedback_interval: int = 3,
+        circuit_breaker: CircuitBreaker = None,
+        ahead_of_time: bool = False,
     ):
-        super().__init__(api_key, model, model_version, temperature, logger)
+        super().__init__(
+            api_key,
+            model,
+            model_version,
+            temperature,
+            logger,
+            model_pool,
+            scheduler,
+            call_policy,
+            circuit_breaker,
+        )
 
         self._db = db
+        self._executor = executor
+        # Durable queue of the analyses and of the final feedback, run in memory if None
+        self._job_queue = job_queue
+
+        if feedback_mode not in FEEDBACK_MODES:
+            raise ValueError(
+                f"Invalid feedback mode {feedback_mode}. Possible values: {FEEDBACK_MODES}."
+            )
+        self._feedback_mode = feedback_mode
+        # Number of turns folded into the running feedback at a time, in incremental mode
+        self._running_feedback_interval = running_feedback_interval
+        self._history_compaction = history_compaction
+        # Built before its conversation starts: the opening turn is only added by start
+        self._ahead_of_time = ahead_of_time
 
         # Check if the data already exists in the database collection
         # named 'conversations'
@@ -172,6 +972,11 @@ class ConversationalChatBot(BaseChatBot):
         self._conversation_user_level = conversation.user_level
         self._conversation_difficulty = conversation.difficulty
         self._conversation_topic = conversation.topic
+        self._conversation_time_limit = conversation.time_limit
+        self._conversation_started_at = conversation.started_at
+        # Pre-generated when the conversation was created, if requested
+        self._conversation_system_prompt = conversation.system_prompt
+        self._conversation_opening_message = conversation.opening_message
 
         # The chatbot should be active if the conversation is not ended yet.
         self._is_active = not conversation.is_ended
@@ -180,6 +985,11 @@ class ConversationalChatBot(BaseChatBot):
         self._last_user_message_timestamp = time.time()
         self._idle_timeout = idle_timeout
 
+        # Turns of the conversation run one at a time, in order of arrival
+        self._turns = TurnQueue()
+        # Number of messages in the managed conversation, loaded on the first turn
+        self._managed_messages_count = None
+
         # Checking if the parameters have been set,
         # otherwise, if the conversation is not found in the database, raise an error
         # while if the others are not found, set them to default values.
@@ -187,21 +997,33 @@ class ConversationalChatBot(BaseChatBot):
             raise ValueError("The conversation ID must be set.")
 
         if self._conversation_user_level is None:
-            self._conversation_user_level = "intermediate"
+            self._conversation_user_level = DEFAULT_USER_LEVEL
 
         if self._conversation_difficulty is None:
-            self._conversation_difficulty = "medium"
+            self._conversation_difficulty = DEFAULT_CONVERSATION_DIFFICULTY
 
         if self._conversation_topic is None:
-            self._conversation_topic = "left free"
+            self._conversation_topic = DEFAULT_CONVERSATION_TOPIC
         else:
             self._conversation_topic = self._conversation_topic
 
         self._chat = None
+        self._chat_stream = None
         self._config = None
+        self._history = None
 
         self.post_conversation_chatbot = PostConversationChatBot(
-            api_key=api_key, conversation_id=self._conversation_id, db=db, logger=logger
+            api_key=api_key,
+            conversation_id=self._conversation_id,
+            db=db,
+            logger=logger,
+            post_actions_mode=post_actions_mode,
+            analysis_cache=analysis_cache,
+            model_pool=model_pool,
+            scheduler=self._scheduler,
+            call_policy=self._call_policy,
+            circuit_breaker=self._circuit_breaker,
+            executor=executor,
         )
 
         self.load_chat_history()
@@ -232,57 +1054,111 @@ class ConversationalChatBot(BaseChatBot):
 
         """
 
-        chat_system_prompt = get_prompt(
-            prompt_name="CONVERSATIONAL_SYSTEM_PROMPT",
-            user_level=self._conversation_user_level,
-            conversation_difficulty=self._conversation_difficulty,
-            conversation_topic=self._conversation_topic,
-        )
-
-        summary = self._get_parent_conversation_summary()
-        if summary is not None:
-            addendum = get_roles_reversed_system_prompt_addendum(summary)
-            chat_system_prompt += f"\n{addendum}"
-
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", chat_system_prompt),
-                MessagesPlaceholder(variable_name="history"),
-                ("human", "{answer}"),
-                # MessagesPlaceholder(variable_name="agent_scratchpad"),
-            ]
-        )
-        _chat_with_history = prompt | self._chat_base
+        if self._conversation_system_prompt is not None:
+            # Rendered when the conversation was created, roles reversed addendum included
+            prompt = get_system_prompt_conversation_template(
+                self._conversation_system_prompt
+            )
+        else:
+            addendum = None
+            summary = self._get_parent_conversation_summary()
+            if summary is not None:
+                addendum = get_roles_reversed_system_prompt_addendum(summary)
+
+            # Templates are shared by all the conversations with the same profile
+            prompt = get_conversation_prompt_template(
+                self._conversation_user_level,
+                self._conversation_difficulty,
+                self._conversation_topic,
+                addendum,
+            )
+        # The chat model is called through the helpers of the chatbot, which record its metrics
+        _chat_with_history = prompt | RunnableLambda(self._invoke_conversation_model)
+        _stream_with_history = prompt | RunnableLambda(self._stream_conversation_model)
         # tools = [self._create_end_conversation_tool()]
         # agent = create_openai_tools_agent(self._chat_base, tools, prompt)
         # agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=False)
 
+        # The history is loaded once and then kept in memory for the whole life of the chatbot
+        self._history = BufferedChatMessageHistory(
+            self._get_message_history(f"{self._conversation_id}"),
+            executor=self._executor,
+        )
+        if not self._ahead_of_time:
+            self._add_opening_message()
+        # Long conversations only send the last turns and a rolling summary of the older ones
+        chat_history = self._history
+        if self._history_compaction is not None:
+            chat_history = CompactingChatMessageHistory(
+                self._history,
+                summarize=self.post_conversation_chatbot.do_conversation_summary,
+                settings=self._history_compaction,
+                executor=self._executor,
+                summaries=(
+                    self._db.get_collection("chat_history_summaries")
+                    if self._db is not None
+                    else None
+                ),
+                session_id=f"{self._conversation_id}",
+            )
         self._chat = RunnableWithMessageHistory(
             _chat_with_history,
-            lambda session_id: MongoDBChatMessageHistory(
-                connection_string=self._db.db_connection_string,
-                session_id=session_id,
-                database_name=self._db.db_name,
-                collection_name="chat_message_history",
-            ),
+            lambda session_id: chat_history,
             input_messages_key="answer",
             # output_messages_key="output",
             history_messages_key="history",
         )
+        self._chat_stream = RunnableWithMessageHistory(
+            _stream_with_history,
+            lambda session_id: chat_history,
+            input_messages_key="answer",
+            history_messages_key="history",
+        )
         self._config = {"configurable": {"session_id": f"{self._conversation_id}"}}
 
-    def _get_message_history(self, session_id: int) -> str:
+    def _add_opening_message(self):
+        """Starts a new conversation with its pre-generated opening turn, if any: the turn is added to
+        the chat history and to the managed conversation, as if the chatbot had just sent it.
+        """
+        if self._conversation_opening_message is None or self._history.messages:
+            return
+        self._history.add_messages([AIMessage(content=self._conversation_opening_message)])
         if self._db is None:
-            warnings.warn("No database connection provided. Returning empty string.")
-            return ""
+            return
 
-        return (
-            MongoDBChatMessageHistory(
-                connection_string=self._db.db_connection_string,
-                session_id=session_id,
-                database_name=self._db.db_name,
-                collection_name="chat_message_history",
-            ),
+        mc_collection = self._db.get_collection("managed_conversations")
+        managed = mc_collection.get_by_id(self.conversation_id)
+        if managed is None or len(managed.messages) > 0:
+            return
+        mc_collection.add_messages(
+            self.conversation_id,
+            [
+                {
+                    "message_content": self._conversation_opening_message,
+                    "role": "ai",
+                    "feedback": None,
+                    "synonyms": None,
+                    "pronunciation": None,
+                }
+            ],
+        )
+        self._managed_messages_count = 1
+
+    def _invoke_conversation_model(self, prompt) -> BaseMessage:
+        return self._invoke_model(CONVERSATION_PROMPT_TYPE, prompt)
+
+    def _stream_conversation_model(self, prompt) -> Iterator[BaseMessageChunk]:
+        yield from self._stream_model(CONVERSATION_PROMPT_TYPE, prompt)
+
+    def _get_message_history(self, session_id: str) -> BaseChatMessageHistory:
+        if self._db is None:
+            warnings.warn(
+                "No database connection provided. The chat history will not be persisted."
+            )
+            return InMemoryChatMessageHistory()
+
+        return CollectionChatMessageHistory(
+            self._db.get_collection("chat_message_history"), session_id
         )
 
     def send_message(self, message: str) -> dict:
@@ -290,51 +1166,297 @@ class ConversationalChatBot(BaseChatBot):
 
         :param message: The message to send by the user to the chatbot.
         :type message: str
-        :return: The response from the chatbot. It includes the chatbot's output and the chatbot's active status.
+        :return: The response from the chatbot. It includes the chatbot's output, the chatbot's active status
+            and whether the turn was recorded (``turn_recorded``). While the model provider is unavailable, the
+            output is DEGRADED_MODE_REPLY, ``degraded`` is True and the turn is discarded.
         :rtype: dict
         """
         # Reset the timestamp of the last user message
         self._last_user_message_timestamp = time.time()
 
-        if self._is_active is False:
-            return {
-                "output": "The chatbot is not active. The conversation has ended.",
+        with self._turns.turn():
+            if self._is_active is False:
+                return {
+                    "output": "The chatbot is not active. The conversation has ended.",
+                    "is_chatbot_active": self._is_active,
+                    "turn_recorded": False,
+                }
+
+            # Invoke the chat model with the user message
+            try:
+                response = self._chat.invoke(
+                    {"answer": message},
+                    config=self._config,
+                )
+            except CircuitOpenError:
+                return {
+                    "output": DEGRADED_MODE_REPLY,
+                    "is_chatbot_active": self._is_active,
+                    "degraded": True,
+                    "turn_recorded": False,
+                }
+
+            chatbot_response = {
+                "output": response.content,
                 "is_chatbot_active": self._is_active,
+                "turn_recorded": True,
             }
 
-        # Invoke the chat model with the user message
-        response = self._chat.invoke(
-            {"answer": message},
-            config=self._config,
-        )
+            self._record_turn(message, chatbot_response["output"])
+
+        return chatbot_response
+
+    def stream_message(self, message: str) -> Generator[str, None, bool]:
+        """Sends a message to the chatbot and yields the response as it is generated.
+
+        The chat history is persisted and the post conversation actions are started only once
+        the whole response has been streamed. If the stream is interrupted (e.g. the client
+        disconnects) the turn is discarded. The next turn of the conversation waits for the stream
+        to complete. While the model provider is unavailable, DEGRADED_MODE_REPLY is yielded and
+        the turn is discarded.
+
+        :param message: The message to send by the user to the chatbot.
+        :type message: str
+        :return: A generator over the chunks of the chatbot's response, returning whether the turn was recorded.
+        :rtype: Generator[str, None, bool]
+        """
+        # Reset the timestamp of the last user message
+        self._last_user_message_timestamp = time.time()
 
-        chatbot_response = {
-            "output": response.content,
-            "is_chatbot_active": self._is_active,
-        }
+        with self._turns.turn():
+            if self._is_active is False:
+                yield "The chatbot is not active. The conversation has ended."
+                return False
+
+            chunks = []
+            try:
+                for chunk in self._chat_stream.stream(
+                    {"answer": message}, config=self._config
+                ):
+                    if not chunk.content:
+                        continue
+                    chunks.append(chunk.content)
+                    yield chunk.content
+            except CircuitOpenError:
+                # The breaker rejects the request before its first chunk
+                yield DEGRADED_MODE_REPLY
+                return False
+
+            self._record_turn(message, "".join(chunks))
+        return True
+
+    def _record_turn(self, user_message: str, chatbot_response: str):
+        """Appends the messages of a turn to the managed conversation, then starts the post
+        conversation actions of the user message in the background.
+
+        Must be called during the turn: since the turns are serialized, the messages are appended in
+        the order of the conversation, and the analyses are later set on the message by its index.
 
-        post_actions_thread = Thread(
-            target=self.do_post_conversation_actions,
-            args=[message, chatbot_response["output"]],
+        :param user_message: message sent by the user to the chatbot.
+        :type user_message: str
+        :param chatbot_response: response of the chatbot.
+        :type chatbot_response: str
+        """
+        mc_collection = self._db.get_collection("managed_conversations")
+        self._load_managed_messages_count()
+
+        mc_collection.add_messages(
+            self.conversation_id,
+            [
+                {
+                    "message_content": user_message,
+                    "role": "human",
+                    "feedback": None,
+                    "synonyms": None,
+                    "pronunciation": None,
+                },
+                {
+                    "message_content": chatbot_response,
+                    "role": "ai",
+                    "feedback": None,
+                    "synonyms": None,
+                    "pronunciation": None,
+                },
+            ],
         )
-        post_actions_thread.start()
+        message_index = self._managed_messages_count
+        self._managed_messages_count += 2
+
+        if not self._enqueue_job(
+            POST_MESSAGE_ACTIONS_JOB,
+            {"user_message": user_message, "message_index": message_index},
+            key=str(message_index),
+        ):
+            self._run_in_background(
+                self.do_post_conversation_actions, user_message, message_index
+            )
 
-        return chatbot_response
+        if (
+            self._feedback_mode == "incremental"
+            # Counted in turns, the conversation may start with an opening message
+            and (self._managed_messages_count // 2) % self._running_feedback_interval
+            == 0
+            and not self._enqueue_job(
+                RUNNING_FEEDBACK_JOB, {}, key=str(self._managed_messages_count)
+            )
+        ):
+            self._run_in_background(
+                self.post_conversation_chatbot.update_running_feedback
+            )
+
+    def _load_managed_messages_count(self) -> int:
+        if self._managed_messages_count is None:
+            managed = self._db.get_collection("managed_conversations").get_by_id(
+                self.conversation_id
+            )
+            self._managed_messages_count = (
+                len(managed.messages) if managed is not None else 0
+            )
+        return self._managed_messages_count
+
+    def _enqueue_job(self, kind: str, payload: dict, key: str = None) -> bool:
+        """Enqueues a job of the conversation in the job queue, if the chatbot has one.
+
+        :param kind: kind of the job.
+        :type kind: str
+        :param payload: arguments of the job.
+        :type payload: dict
+        :param key: deduplication key of the job within the conversation, defaults to None.
+        :type key: str, optional
+        :return: True if the job is in the queue, False if the caller must run the work itself.
+        :rtype: bool
+        """
+        if self._job_queue is None:
+            return False
+        try:
+            self._job_queue.enqueue(kind, self.conversation_id, payload, key=key)
+        except Exception as exc:
+            self.log(
+                f"Could not enqueue the {kind} job of conversation {self.conversation_id}, running it in memory: {exc!r}"
+            )
+            return False
+        return True
+
+    def _run_in_background(self, fn: callable, *args, required: bool = False):
+        """Runs a function on the background executor, or on a new thread if the chatbot has no executor.
+
+        If the executor rejects the function because it is saturated, the function is dropped, unless
+        it is required: then the caller runs it. The post-message analyses and the running notes can
+        be dropped (the next update of the notes folds the messages they missed), the final feedback
+        cannot.
+
+        :param fn: The function to run.
+        :type fn: callable
+        :param required: Whether the function must run even if the executor is saturated, defaults to False.
+        :type required: bool, optional
+        """
+        if self._executor is None:
+            Thread(target=fn, args=args).start()
+            return
+        try:
+            self._executor.submit(fn, *args)
+        except BackgroundQueueFullError:
+            if not required:
+                self.log(
+                    f"The background queue is full, {fn.__name__} of conversation {self.conversation_id} is dropped."
+                )
+                return
+            fn(*args)
+
+    def flush_history(self):
+        """Writes to the database the messages of the chat history that have not been persisted yet."""
+        self._history.flush()
+
+    def start(self, started_at: Optional[datetime] = None) -> bool:
+        """Starts the conversation of a chatbot built ahead of time: its idle timeout and, if the
+        conversation had not been started yet, its time limit are counted from now, and its opening
+        turn, if any, is added to the chat history and to the managed conversation.
+
+        :param started_at: time the conversation was started, if it was just started, defaults to None.
+        :type started_at: Optional[datetime], optional
+        :return: False if the chatbot is out of date and must be built again: the conversation has been
+            started since the chatbot was built, at a time the chatbot does not know, or its system prompt
+            or opening turn have been generated since. True otherwise.
+        :rtype: bool
+        """
+        if self._conversation_started_at is None and started_at is None:
+            return False
+        if self._db is not None:
+            conversation = self._db.get_collection("conversations").find_by_id(
+                self._conversation_id
+            )
+            if conversation is None or (
+                conversation.system_prompt != self._conversation_system_prompt
+                or conversation.opening_message != self._conversation_opening_message
+            ):
+                return False
+        if self._conversation_started_at is None:
+            self._conversation_started_at = started_at
+        if self._ahead_of_time:
+            self._ahead_of_time = False
+            self._add_opening_message()
+        self._last_user_message_timestamp = time.time()
+        return True
 
     def deactivate(self):
         """Deactivates the chatbot."""
-        # Get the full conversation from the database
-        mc_collection = self._db.get_collection("managed_conversations")
-        full_conversation_string = mc_collection.get_formatted_conversation_string(
-            self._conversation_id
-        )
-        final_feedback_thread = Thread(
-            target=self.set_overall_conversation_feedback_and_summary,
-            args=[full_conversation_string],
+        self.flush_history()
+
+        # The job reads the conversation and its running notes from the database when it runs
+        if self._enqueue_job(OVERALL_FEEDBACK_JOB, {}):
+            self._is_active = False
+            return
+
+        # The running notes, if any, are read from the database along with the full conversation
+        self._run_in_background(
+            self.post_conversation_chatbot.finalize_overall_feedback_and_summary,
+            required=True,
         )
-        final_feedback_thread.start()
         self._is_active = False
 
+    @property
+    def db(self) -> MongoDB:
+        """Returns the database the chatbot is connected to.
+
+        :return: The database.
+        :rtype: MongoDB
+        """
+        return self._db
+
+    @property
+    def idle_timeout(self) -> int:
+        """Returns the time (in seconds) without messages after which the chatbot becomes idle.
+
+        :return: The idle timeout.
+        :rtype: int
+        """
+        return self._idle_timeout
+
+    @property
+    def idle_deadline(self) -> float:
+        """Returns the time at which the chatbot becomes idle if the user does not send any message.
+
+        :return: The idle deadline, as returned by time.time().
+        :rtype: float
+        """
+        return self._last_user_message_timestamp + self._idle_timeout
+
+    @property
+    def time_limit_deadline(self) -> Optional[float]:
+        """Returns the time at which the time limit of the conversation expires, counted from when the
+        conversation was first initialized.
+
+        :return: The time limit deadline, as returned by time.time(), or None if the conversation has no time limit.
+        :rtype: Optional[float]
+        """
+        if (
+            not isinstance(self._conversation_time_limit, numbers.Real)
+            or self._conversation_started_at is None
+        ):
+            return None
+        started_at = self._conversation_started_at.replace(tzinfo=timezone.utc)
+        return started_at.timestamp() + self._conversation_time_limit * 60
+
     @property
     def conversation_id(self) -> str:
         """Returns the conversation ID of the conversation the chatbot is assigned to.
@@ -344,6 +1466,43 @@ class ConversationalChatBot(BaseChatBot):
         """
         return self._conversation_id
 
+    @property
+    def is_busy(self) -> bool:
+        """Returns True if the chatbot is answering a message, False otherwise.
+
+        :return: True if a turn is in progress or queued.
+        :rtype: bool
+        """
+        return self._turns.length > 0
+
+    @property
+    def messages_count(self) -> int:
+        """Returns the number of messages of the managed conversation, i.e. the position of the next turn.
+
+        :return: The number of messages recorded so far.
+        :rtype: int
+        """
+        return self._load_managed_messages_count()
+
+    @property
+    def queued_turns(self) -> int:
+        """Returns the number of turns waiting for the current turn of the conversation to complete.
+
+        :return: The number of queued turns.
+        :rtype: int
+        """
+        return self._turns.waiting
+
+    @property
+    def estimated_memory_bytes(self) -> int:
+        """Returns a rough estimate of the memory held by the chatbot, dominated by its chat history.
+
+        :return: The estimated memory (in bytes).
+        :rtype: int
+        """
+        history_bytes = self._history.size_bytes if self._history is not None else 0
+        return CHATBOT_BASE_MEMORY_BYTES + 2 * history_bytes
+
     @property
     def is_idle(self):
         """
@@ -370,65 +1529,17 @@ class ConversationalChatBot(BaseChatBot):
 
         return result
 
-    def do_post_conversation_actions(self, user_message: str, chatbot_response: str):
-        """Given a user message and a chatbot response, computes the synonim, pronunciations and message-feedback challenges.
+    def do_post_conversation_actions(self, user_message: str, message_index: int):
+        """Given a user message, computes the synonim, pronunciations and message-feedback challenges
+        and sets them on the message in the managed conversation.
 
         :param user_message: message sent by the user to the chatbot.
         :type user_message: str
-        :param chatbot_response: response of the chatbot.
-        :type chatbot_response: str
+        :param message_index: index of the user message in the managed conversation.
+        :type message_index: int
         """
-        results = self.post_conversation_chatbot.do_all_post_conversation_actions(
-            user_message
-        )
-        synonyms, pronunciation, feedback = results
-
-        # Validate json
-        try:
-            syn_json = json.loads(synonyms)
-            if not isinstance(syn_json, list):
-                syn_json = None
-        except:
-            syn_json = None
-
-        try:
-            pron_json = json.loads(pronunciation)
-            if not isinstance(pron_json, list):
-                pron_json = None
-        except:
-            pron_json = None
-
-        try:
-            feed_json = json.loads(feedback)
-            if (
-                not isinstance(feed_json, dict)
-                or "hasMistake" not in feed_json
-                or "messageFeedback" not in feed_json
-            ):
-                feed_json = None
-        except:
-            feed_json = None
-
-        mc_collection = self._db.get_collection("managed_conversations")
-        mc_collection.add_message(
-            self.conversation_id,
-            {
-                "message_content": user_message,
-                "role": "human",
-                "feedback": feed_json,
-                "synonyms": syn_json,
-                "pronunciation": pron_json,
-            },
-        )
-        mc_collection.add_message(
-            self.conversation_id,
-            {
-                "message_content": chatbot_response,
-                "role": "ai",
-                "feedback": None,
-                "synonyms": None,
-                "pronunciation": None,
-            },
+        self.post_conversation_chatbot.set_post_message_analysis(
+            user_message, message_index
         )
 
     def set_overall_conversation_feedback_and_summary(
@@ -439,17 +1550,10 @@ class ConversationalChatBot(BaseChatBot):
         :param formatted_conversation_string: overall formatted chat-history.
         :type formatted_conversation_string: str
         """
-        feedback = self.post_conversation_chatbot.do_overall_conversation_feedback(
-            full_conversation=formatted_conversation_string
-        )
-        summary = self.post_conversation_chatbot.do_roles_reversed_challenge(
-            full_conversation=formatted_conversation_string
+        self.post_conversation_chatbot.set_overall_feedback_and_summary(
+            formatted_conversation_string
         )
 
-        mc_collection = self._db.get_collection("managed_conversations")
-        mc_collection.set_overall_feedback(self.conversation_id, feedback)
-        mc_collection.set_user_opinion_summary(self.conversation_id, summary)
-
     def _get_parent_conversation_summary(self):
         # Fetch conversation data
         c_collection = self._db.get_collection("conversations")
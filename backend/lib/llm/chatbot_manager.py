@@ -2,52 +2,265 @@
 Module for managing the chatbots for the conversations.
 """
 
-from threading import Lock, Thread
-from time import sleep
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Iterator, Optional, Union
 from os import getenv
 from bson.errors import InvalidId
 
 
 from . import ConversationalChatBot
-from ..database import MongoDB
+from .chatbot import (
+    CHATBOT_BASE_MEMORY_BYTES,
+    ConversationPreparationChatBot,
+    PostConversationChatBot,
+)
+from .analysis_cache import AnalysisCache
+from .background import BackgroundExecutor, BackgroundQueueFullError
+from .breaker import CircuitBreaker, CircuitOpenError
+from .clients import ChatModelPool
+from .deadlines import DeadlineScheduler
+from .hedging import LLMCallPolicy, LLMTimeoutError
+from .history import HistoryCompactionSettings
+from .idempotency import TurnDeduplicator
+from .jobs import (
+    JobDeferredError,
+    JobQueue,
+    JobWorker,
+    OVERALL_FEEDBACK_JOB,
+    POST_MESSAGE_ACTIONS_JOB,
+    PREPARE_CONVERSATION_JOB,
+    RUNNING_FEEDBACK_JOB,
+)
+from .registry import ChatbotRegistry
+from .scheduler import LLMScheduler
+from ..database import Job, MongoDB
 from ..log import *
 
+# Delay (in seconds) before retrying to end a conversation that could not be ended yet
+EXPIRATION_RETRY_DELAY = 5
+
+# Returned when the chat model does not answer a turn before its deadline
+CHATBOT_TIMEOUT_MESSAGE = (
+    "The chatbot is taking too long to answer. Please send your message again."
+)
+
+# Returned when a turn fails for any other reason (e.g. an error of the model provider)
+CHATBOT_ERROR_MESSAGE = (
+    "The chatbot could not answer your message. Please send your message again."
+)
+
+
+def _defer_while_circuit_open(handler: Callable[[Job], None]) -> Callable[[Job], None]:
+    """Wraps a job handler so that its job is deferred, instead of failed, while the circuit breaker is open."""
+
+    def run(job: Job) -> None:
+        try:
+            handler(job)
+        except CircuitOpenError as exc:
+            raise JobDeferredError(exc.retry_after) from exc
+
+    return run
+
 
 class ChatbotManager:
     """
     Manages the chatbots for the conversations.
 
     Args:
-        max_idle_time (int, optional): Idling time (in seconds) for the thread checking the chatbots. Defaults to 10 seconds.
+        max_idle_time (int, optional): Maximum time (in seconds) the deadline scheduler sleeps before checking the deadlines again. Defaults to 10 seconds.
+        post_actions_mode (str, optional): How the chatbots run the post-message analyses, one of "serial", "parallel" or "combined". Defaults to "parallel".
+        background_workers (int, optional): Number of threads running the background work of the chatbots. Defaults to 8.
+        background_queue_size (int, optional): Maximum number of background tasks waiting for a thread. Defaults to 256.
+        background_policy (str, optional): What to do with background tasks submitted when the queue is full, one of "block", "reject" or "caller_runs". Defaults to "reject" (the tasks that can be dropped are dropped, the others run later or on their caller).
+        history_compaction (HistoryCompactionSettings, optional): Thresholds to compact the history of long conversations into a rolling summary. Defaults to None (the whole history is sent).
+        analysis_cache (AnalysisCache, optional): Cache of the post-message analyses shared by the chatbots. Defaults to None (no caching).
+        model_pool (ChatModelPool, optional): Pool of the chat models shared by the chatbots. Defaults to a pool using the OPENAI_API_KEY environment variable.
+        llm_scheduler (LLMScheduler, optional): Scheduler of the requests to the chat model shared by the chatbots, serving the interactive turns first. Defaults to a scheduler without limits.
+        llm_call_policy (LLMCallPolicy, optional): Deadlines and hedging of the requests to the chat model shared by the chatbots. Defaults to no deadline and no hedging.
+        llm_circuit_breaker (CircuitBreaker, optional): Circuit breaker of the requests to the chat model shared by the chatbots. Defaults to None (no breaker).
+        duplicate_turn_ttl (int, optional): Time (in seconds) the response of a message sent with a client id is kept to answer its duplicates. Defaults to 600 seconds (0 disables it).
+        duplicate_content_ttl (int, optional): Time (in seconds) a message sent without a client id is matched against the same message sent again at the same position of the conversation, i.e. before the first one is answered. Defaults to 0 (only the messages with a client id are deduplicated).
+        max_chatbots (int, optional): Maximum number of chatbots kept in memory. Defaults to None (no limit).
+        max_chatbots_memory (int, optional): Maximum estimated memory (in bytes) of the chatbots kept in memory. Defaults to None (no limit).
+        db (MongoDB, optional): Database used to rebuild the evicted chatbots. Defaults to None (evicted chatbots must be initialized again).
+        logger (Logger, optional): Logger of the manager. Defaults to None.
+        time_limit_grace (int, optional): Time (in seconds) granted after the time limit of a conversation before the server ends it. Defaults to 60 seconds.
+        registry_shards (int, optional): Number of shards of the chatbot registry. Defaults to 16.
+        job_queue (JobQueue, optional): Durable queue of the post-message analyses and of the final feedback. Defaults to None (they run on the background executor and are lost on a restart).
+        job_workers (int, optional): Number of threads running the jobs of the queue in this process, once start_job_worker is called. Defaults to 2.
+        feedback_mode (str, optional): How the chatbots compute the final feedback, one of "final" (from the whole transcript when the conversation ends) or "incremental" (from running notes kept as the turns arrive). Defaults to "final".
+        running_feedback_interval (int, optional): Number of turns folded into the running notes at a time, in incremental mode. Defaults to 3.
+        pregenerate_openings (bool, optional): Whether the system prompt and the opening turn of the new conversations are generated when they are created, unless the request says otherwise. Defaults to False.
+        warmup_chatbots (int, optional): Maximum number of chatbots built ahead of time for the conversations the students are likely to start. Defaults to 0 (no warm-up).
+        warmup_ttl (int, optional): Time (in seconds) a chatbot built ahead of time is kept if its conversation does not start. Defaults to 600 seconds.
+
+    The chatbots are kept in a sharded registry: looking up the chatbot of a conversation takes no
+    lock, and slow work (flushing histories, ending conversations) never runs holding a registry lock.
+
+    When a limit is exceeded, the least recently used chatbots that are not answering a message are
+    evicted: their history is flushed to the database and they are rebuilt from it the next time a
+    message is sent to their conversation.
+
+    Conversations are ended when their chatbot becomes idle or when their time limit expires. The
+    deadlines are tracked by a DeadlineScheduler, which ends the conversations on the background
+    executor, off the request path.
+
+    When a student lists their conversations, the chatbot of the conversation they are most likely to
+    start next can be built ahead of time (warmed up), so that starting it costs nothing. The warm
+    chatbots only take the room left by the active ones: they are dropped before any active chatbot
+    is evicted, and when their conversation does not start within ``warmup_ttl`` seconds.
+
+    While the circuit breaker of the chat model is open, the chatbots answer the turns with a canned
+    reply asking the student to wait, without recording them, and the jobs of the queue are deferred
+    until the breaker lets requests through again, without counting as failed attempts.
+
+    A message sent again to a conversation with the same client id while its turn is running, or
+    after it was recorded, is not sent to the chatbot: it gets the response of the first one, so
+    that the retries of the clients neither call the chat model again nor duplicate the turn in the
+    history.
 
     Attributes:
-        chatbots (dict): Dictionary containing the chatbots for the conversations.
-        dict_lock (Lock): Lock for the chatbots dictionary.
-        max_idle_time (int): Idling time (in seconds) for the thread checking the chatbots.
-        heartbeat_thread (Thread): Thread for the heartbeat.
+        chatbots (ChatbotRegistry): Registry containing the chatbots for the conversations.
+        max_idle_time (int): Maximum time (in seconds) the deadline scheduler sleeps before checking the deadlines again.
+        post_actions_mode (str): How the chatbots run the post-message analyses.
+        background_executor (BackgroundExecutor): Executor shared by the chatbots for their background work.
+        history_compaction (HistoryCompactionSettings): Thresholds to compact the history of long conversations.
+        analysis_cache (AnalysisCache): Cache of the post-message analyses shared by the chatbots.
+        model_pool (ChatModelPool): Pool of the chat models shared by the chatbots.
+        llm_scheduler (LLMScheduler): Scheduler of the requests to the chat model shared by the chatbots.
+        llm_call_policy (LLMCallPolicy): Deadlines and hedging of the requests to the chat model shared by the chatbots.
+        llm_circuit_breaker (CircuitBreaker): Circuit breaker of the requests to the chat model shared by the chatbots, or None.
+        turn_deduplicator (TurnDeduplicator): Deduplication of the messages sent again to the conversations.
+        max_chatbots (int): Maximum number of chatbots kept in memory.
+        max_chatbots_memory (int): Maximum estimated memory (in bytes) of the chatbots kept in memory.
+        time_limit_grace (int): Time (in seconds) granted after the time limit of a conversation before the server ends it.
+        job_queue (JobQueue): Durable queue of the post-message analyses and of the final feedback.
+        job_worker (JobWorker): Worker running the jobs of the queue, None without a queue.
+        feedback_mode (str): How the chatbots compute the final feedback.
+        running_feedback_interval (int): Number of turns folded into the running notes at a time, in incremental mode.
+        pregenerate_openings (bool): Whether the opening turn of the new conversations is generated when they are created, by default.
+        warmup_chatbots (int): Maximum number of chatbots built ahead of time.
+        warmup_ttl (int): Time (in seconds) a chatbot built ahead of time is kept if its conversation does not start.
     """
 
 
-    def __init__(self, max_idle_time: int = 10):
+    def __init__(
+        self,
+        max_idle_time: int = 10,
+        post_actions_mode: str = "parallel",
+        background_workers: int = 8,
+        background_queue_size: int = 256,
+        background_policy: str = "reject",
+        history_compaction: HistoryCompactionSettings = None,
+        analysis_cache: AnalysisCache = None,
+        model_pool: ChatModelPool = None,
+        llm_scheduler: LLMScheduler = None,
+        llm_call_policy: LLMCallPolicy = None,
+        max_chatbots: int = None,
+        max_chatbots_memory: int = None,
+        db: MongoDB = None,
+        logger: Logger = None,
+        time_limit_grace: int = 60,
+        registry_shards: int = 16,
+        job_queue: JobQueue = None,
+        job_workers: int = 2,
+        feedback_mode: str = "final",
+        running_feedback_interval: int = 3,
+        pregenerate_openings: bool = False,
+        warmup_chatbots: int = 0,
+        warmup_ttl: int = 600,
+        llm_circuit_breaker: CircuitBreaker = None,
+        duplicate_turn_ttl: int = 600,
+        duplicate_content_ttl: int = 0,
+    ):
         """
         Initializes a ChatbotManager object.
         """
-        self.chatbots = dict()
-        self.dict_lock = Lock()
+        self.chatbots = ChatbotRegistry(shards=registry_shards)
+        self.max_chatbots = max_chatbots
+        self.max_chatbots_memory = max_chatbots_memory
+        self.db = db
+        self.logger = logger
+        # Evicted chatbots whose history is being flushed, reused if their conversation comes back
+        self._evicting = dict()
+        # Chatbots being built, shared by the concurrent initializations of the same conversation
+        self._initializing = dict()
+        # Chatbots built ahead of time with their expiration time, from the oldest, and the ones being built
+        self._warm = OrderedDict()
+        self._warming = set()
+        self._warmups = 0
+        self._warm_hits = 0
+        self._warm_discarded = 0
+        # Protects the evicting and initializing chatbots and the counters, never held during slow work
+        self._lock = Lock()
+        # Serializes the evictions, so that concurrent additions do not evict the same chatbots
+        self._evict_lock = Lock()
+        self._evictions = 0
+        self._rehydrations = 0
         self.max_idle_time = max_idle_time
+        self.post_actions_mode = post_actions_mode
+        self.background_executor = BackgroundExecutor(
+            max_workers=background_workers,
+            max_queue_size=background_queue_size,
+            policy=background_policy,
+            name="chatbot-background",
+            logger=logger,
+        )
+        self.history_compaction = history_compaction
+        self.analysis_cache = analysis_cache
+        self.model_pool = (
+            model_pool
+            if model_pool is not None
+            else ChatModelPool(api_key=getenv("OPENAI_API_KEY"))
+        )
+        self.llm_scheduler = (
+            llm_scheduler if llm_scheduler is not None else LLMScheduler()
+        )
+        self.llm_call_policy = (
+            llm_call_policy if llm_call_policy is not None else LLMCallPolicy()
+        )
+        self.llm_circuit_breaker = llm_circuit_breaker
+        self.turn_deduplicator = TurnDeduplicator(
+            ttl=duplicate_turn_ttl, content_ttl=duplicate_content_ttl
+        )
 
-        def run_check_idle():
-            idle_time = self.max_idle_time
-            while True:
-                sleep(idle_time)
-                self.check_idle()
+        self.time_limit_grace = time_limit_grace
+        self._deadlines = DeadlineScheduler(
+            on_expire=self._on_deadline, max_sleep=max_idle_time
+        )
 
-        self.heartbeat_thread = Thread(target=run_check_idle)
-        # start interval
+        self.feedback_mode = feedback_mode
+        self.running_feedback_interval = running_feedback_interval
+        self.pregenerate_openings = pregenerate_openings
+        self.warmup_chatbots = warmup_chatbots
+        self.warmup_ttl = warmup_ttl
+        self.job_queue = job_queue
+        self.job_worker = (
+            JobWorker(
+                job_queue,
+                handlers={
+                    kind: _defer_while_circuit_open(handler)
+                    for kind, handler in {
+                        POST_MESSAGE_ACTIONS_JOB: self._run_post_message_actions_job,
+                        OVERALL_FEEDBACK_JOB: self._run_overall_feedback_job,
+                        RUNNING_FEEDBACK_JOB: self._run_running_feedback_job,
+                        PREPARE_CONVERSATION_JOB: self._run_prepare_conversation_job,
+                    }.items()
+                },
+                workers=job_workers,
+                logger=logger,
+            )
+            if job_queue is not None
+            else None
+        )
 
     def start_heartbeat(self):
         """
-        Start the heartbeat thread that checks if the chatbots are idle.
+        Start the thread of the deadline scheduler, which ends the idle conversations and the ones past their time limit.
+        The thread is also started automatically when the first deadline is scheduled.
 
         Args:
             None
@@ -55,7 +268,110 @@ class ChatbotManager:
         Returns:
             None
         """
-        self.heartbeat_thread.start()
+        self._deadlines.start()
+
+    def start_job_worker(self):
+        """
+        Start the threads running the jobs of the job queue in this process. The jobs can also be run
+        by a separate process (see worker.py), or by both.
+
+        Args:
+            None
+
+        Raises:
+            RuntimeError: If the manager has no job queue.
+
+        Returns:
+            None
+        """
+        if self.job_worker is None:
+            raise RuntimeError("The chatbot manager has no job queue.")
+        self.job_worker.start()
+
+    def _create_post_conversation_chatbot(self, cid: str) -> PostConversationChatBot:
+        return PostConversationChatBot(
+            api_key=getenv("OPENAI_API_KEY"),
+            conversation_id=cid,
+            db=self.db,
+            logger=self.logger,
+            post_actions_mode=self.post_actions_mode,
+            analysis_cache=self.analysis_cache,
+            model_pool=self.model_pool,
+            scheduler=self.llm_scheduler,
+            call_policy=self.llm_call_policy,
+            circuit_breaker=self.llm_circuit_breaker,
+            executor=self.background_executor,
+        )
+
+    def _run_post_message_actions_job(self, job: Job):
+        self._create_post_conversation_chatbot(
+            job.conversation_id
+        ).set_post_message_analysis(
+            job.payload["user_message"], job.payload["message_index"]
+        )
+
+    def _run_overall_feedback_job(self, job: Job):
+        self._create_post_conversation_chatbot(
+            job.conversation_id
+        ).finalize_overall_feedback_and_summary()
+
+    def _run_running_feedback_job(self, job: Job):
+        self._create_post_conversation_chatbot(
+            job.conversation_id
+        ).update_running_feedback()
+
+    def _run_prepare_conversation_job(self, job: Job):
+        self._create_conversation_preparation_chatbot(
+            job.conversation_id, self.db
+        ).prepare()
+
+    def _create_conversation_preparation_chatbot(
+        self, cid: str, db: MongoDB
+    ) -> ConversationPreparationChatBot:
+        return ConversationPreparationChatBot(
+            api_key=getenv("OPENAI_API_KEY"),
+            conversation_id=cid,
+            db=db,
+            logger=self.logger,
+            model_pool=self.model_pool,
+            scheduler=self.llm_scheduler,
+            call_policy=self.llm_call_policy,
+            circuit_breaker=self.llm_circuit_breaker,
+        )
+
+    def prepare_conversation(self, cid: str, db: MongoDB) -> None:
+        """
+        Generate the system prompt and the opening turn of a new conversation ahead of time, so that
+        its chatbot serves them when the conversation starts. The work is enqueued in the job queue,
+        or runs on the background executor without a queue; if the conversation starts first, its
+        chatbot computes them as usual.
+
+        Args:
+            cid (str): id of the conversation to prepare
+            db (MongoDB): database instance containing the conversations data
+
+        Returns:
+            None
+        """
+        if self.job_queue is not None:
+            try:
+                self.job_queue.enqueue(PREPARE_CONVERSATION_JOB, cid, {})
+                return
+            except Exception as exc:
+                self._log(
+                    LogType.ERROR,
+                    f"Could not enqueue the preparation of conversation {cid}, running it in memory: {exc!r}",
+                )
+        try:
+            self.background_executor.submit(
+                self._create_conversation_preparation_chatbot(cid, db).prepare
+            )
+        except BackgroundQueueFullError:
+            # The opening turn is an optimization: the chatbot computes it if it is missing
+            self._log(
+                LogType.ERROR,
+                f"The background queue is full, conversation {cid} is not prepared.",
+            )
 
     def init_chatbot(self, cid: str, db: MongoDB, logger: Logger) -> tuple[int, str]:
         """
@@ -64,6 +380,7 @@ class ChatbotManager:
         If the conversation is not found in the database, the function returns a 400 status code and an error message because the conversation must be created before initializing it.
         If the chatbot is already initialized, the function returns a 200 status code and a success message.
         Otherwise a new chatbot is created and added to the chatbot manager, finally returning a 200 status code and a success message.
+        Concurrent initializations of the same conversation share a single chatbot construction, and a chatbot being evicted is taken back instead of being rebuilt.
 
         Args:
             cid (str): id of the conversation to initialize
@@ -92,39 +409,426 @@ class ChatbotManager:
         # Initializing the Chatbot for the conversation if not already initialized
         cb = self.get_chatbot(cid)
         if not cb:
-            logger.log(
-                Log(
-                    log_type=LogType.INFO,
-                    message=f"Initializing conversation with id {cid}",
+
+            def create_chatbot():
+                # A chatbot being evicted still holds the whole state of the conversation: building
+                # another one now would load a history that is not completely flushed yet
+                with self._lock:
+                    chatbot = self._evicting.get(cid, None)
+                if chatbot is not None:
+                    return chatbot
+                logger.log(
+                    Log(
+                        log_type=LogType.INFO,
+                        message=f"Initializing conversation with id {cid}",
+                    )
                 )
+                return self._create_chatbot(cid, db, logger)
+
+            self._build_once(cid, create_chatbot)
+
+        return 200, "Conversation initialized successfully"
+
+    def _build_once(
+        self, cid: str, build: Callable[[], Optional[ConversationalChatBot]]
+    ) -> Optional[ConversationalChatBot]:
+        """
+        Build and add the chatbot of a conversation, unless it is already being built: in that case,
+        wait for the construction in progress and return its chatbot (or raise its error).
+
+        Args:
+            cid (str): id of the conversation
+            build (Callable[[], Optional[ConversationalChatBot]]): builds the chatbot, or returns None if it cannot be built
+
+        Returns:
+            Optional[ConversationalChatBot]: Returns the chatbot of the conversation, or None if it cannot be built.
+        """
+        with self._lock:
+            future = self._initializing.get(cid, None)
+            is_builder = future is None
+            if is_builder:
+                future = Future()
+                self._initializing[cid] = future
+        if not is_builder:
+            return future.result()
+
+        try:
+            # Another construction may have completed since the caller's lookup
+            chatbot = self.chatbots.get(cid, None)
+            if chatbot is None:
+                chatbot = build()
+                if chatbot is not None:
+                    self.add_chatbot(cid, chatbot)
+            future.set_result(chatbot)
+            return chatbot
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._initializing[cid]
+
+    def _create_chatbot(
+        self, cid: str, db: MongoDB, logger: Logger
+    ) -> ConversationalChatBot:
+        # The time limit of the conversation is counted from its first initialization
+        started_at = db.get_collection("conversations").start_conversation(cid)
+        chatbot = self._take_warm_chatbot(cid)
+        if chatbot is not None:
+            if chatbot.start(started_at):
+                with self._lock:
+                    self._warm_hits += 1
+                return chatbot
+            # Out of date, e.g. the opening turn of the conversation was generated after the warm-up
+            with self._lock:
+                self._warm_discarded += 1
+        return self._build_chatbot(cid, db, logger)
+
+    def _build_chatbot(
+        self, cid: str, db: MongoDB, logger: Logger, ahead_of_time: bool = False
+    ) -> ConversationalChatBot:
+        return ConversationalChatBot(
+            api_key=getenv("OPENAI_API_KEY"),
+            conversation_id=cid,
+            db=db,
+            logger=logger,
+            post_actions_mode=self.post_actions_mode,
+            executor=self.background_executor,
+            history_compaction=self.history_compaction,
+            analysis_cache=self.analysis_cache,
+            model_pool=self.model_pool,
+            scheduler=self.llm_scheduler,
+            call_policy=self.llm_call_policy,
+            circuit_breaker=self.llm_circuit_breaker,
+            job_queue=self.job_queue,
+            feedback_mode=self.feedback_mode,
+            running_feedback_interval=self.running_feedback_interval,
+            ahead_of_time=ahead_of_time,
+        )
+
+    def warm_up_student_conversations(
+        self, user_email: str, conversations: list[dict], db: MongoDB, logger: Logger
+    ) -> Optional[str]:
+        """
+        Warm up the chatbot of the conversation the student is most likely to start next: the first of
+        their open conversations without a chatbot, in the order they are listed to the student.
+
+        Args:
+            user_email (str): email of the student
+            conversations (list[dict]): conversations of the user, as listed by the conversations collection
+            db (MongoDB): database instance containing the conversations data
+            logger (Logger): logger instance to log messages
+
+        Returns:
+            Optional[str]: Returns the id of the conversation whose chatbot is warm or being warmed up, or None.
+        """
+        if self.warmup_chatbots <= 0:
+            return None
+        for conversation in conversations:
+            cid = conversation["_id"]
+            if conversation["student_email"] != user_email or conversation["is_ended"]:
+                continue
+            if self.get_chatbot(cid) is not None:
+                continue
+            return cid if self.warm_up(cid, db, logger) else None
+        return None
+
+    def warm_up(self, cid: str, db: MongoDB, logger: Logger) -> bool:
+        """
+        Build the chatbot of a conversation on the background executor, ahead of its initialization.
+        The conversation is not started: its time limit is counted from its initialization, and its
+        opening turn is added to the managed conversation then, as usual. Nothing is done if the
+        warm-up budget is exhausted, if the chatbot would not fit in the capacity left by the active
+        chatbots, or if the background queue is full. A warm chatbot whose conversation has been
+        prepared since it was built is discarded when the conversation starts.
+
+        Args:
+            cid (str): id of the conversation
+            db (MongoDB): database instance containing the conversations data
+            logger (Logger): logger instance to log messages
+
+        Returns:
+            bool: True if the chatbot is warm or being warmed up, False otherwise.
+        """
+        with self._lock:
+            self._discard_expired_warm_chatbots()
+            if cid in self._warm or cid in self._warming:
+                return True
+            if (
+                cid in self._initializing
+                or cid in self._evicting
+                or len(self._warm) + len(self._warming) >= self.warmup_chatbots
+            ):
+                return False
+        if not self._has_room_for_warm_chatbot():
+            return False
+        with self._lock:
+            if cid in self._warm or cid in self._warming:
+                return True
+            self._warming.add(cid)
+
+        # The warm-up is an optimization: it never waits for nor runs on the request thread
+        if not self.background_executor.offer(self._warm_up, cid, db, logger):
+            with self._lock:
+                self._warming.discard(cid)
+            return False
+        return True
+
+    def _warm_up(self, cid: str, db: MongoDB, logger: Logger) -> None:
+        chatbot = None
+        try:
+            chatbot = self._build_chatbot(cid, db, logger, ahead_of_time=True)
+        except Exception as exc:
+            self._log(
+                LogType.ERROR,
+                f"Failed to warm up the chatbot for conversation {cid}: {exc!r}",
             )
-            self.add_chatbot(
-                cid,
-                ConversationalChatBot(
-                    api_key=getenv("OPENAI_API_KEY"),
-                    conversation_id=cid,
-                    db=db,
-                    logger=logger,
-                ),
+        with self._lock:
+            self._warming.discard(cid)
+            # The conversation may have been initialized while the warm chatbot was being built
+            if (
+                chatbot is not None
+                and cid not in self._initializing
+                and self.chatbots.get(cid, None) is None
+            ):
+                self._warm[cid] = (chatbot, time.time() + self.warmup_ttl)
+                self._warmups += 1
+
+    def _take_warm_chatbot(self, cid: str) -> Optional[ConversationalChatBot]:
+        with self._lock:
+            self._discard_expired_warm_chatbots()
+            chatbot, _ = self._warm.pop(cid, (None, None))
+        return chatbot
+
+    def _discard_expired_warm_chatbots(self) -> None:
+        # Called holding the lock. The warm chatbots expire in the order they were built.
+        now = time.time()
+        while self._warm:
+            cid, (_, expires_at) = next(iter(self._warm.items()))
+            if expires_at > now:
+                break
+            del self._warm[cid]
+            self._warm_discarded += 1
+
+    def _has_room_for_warm_chatbot(self) -> bool:
+        with self._lock:
+            warm = [chatbot for chatbot, _ in self._warm.values()]
+            warming = len(self._warming)
+        memory = 0
+        if self.max_chatbots_memory is not None:
+            memory = (
+                sum(cb.estimated_memory_bytes for cb in self.chatbots.values())
+                + sum(cb.estimated_memory_bytes for cb in warm)
+                + (warming + 1) * CHATBOT_BASE_MEMORY_BYTES
             )
+        return not self._is_over_capacity(
+            len(self.chatbots) + len(warm) + warming + 1, memory
+        )
 
-        return 200, "Conversation initialized successfully"
+    def _trim_warm_chatbots(self) -> None:
+        """
+        Drop the oldest warm chatbots while the manager is over capacity, so that the warm chatbots
+        never cause the eviction of an active one.
+        """
+        with self._lock:
+            if not self._warm:
+                return
+            warm = [chatbot for chatbot, _ in self._warm.values()]
+        count = len(self.chatbots) + len(warm)
+        memory = 0
+        if self.max_chatbots_memory is not None:
+            memory = sum(cb.estimated_memory_bytes for cb in self.chatbots.values()) + sum(
+                cb.estimated_memory_bytes for cb in warm
+            )
+        with self._lock:
+            while self._warm and self._is_over_capacity(count, memory):
+                _, (chatbot, _) = self._warm.popitem(last=False)
+                count -= 1
+                memory -= chatbot.estimated_memory_bytes
+                self._warm_discarded += 1
 
-    def check_idle(self) -> None:
+    def _get_or_rehydrate_chatbot(self, cid: str) -> Optional[ConversationalChatBot]:
         """
-        Check if the chatbots are idle and deactivate them if necessary.
+        Get the chatbot for the specified conversation, rebuilding it if it has been evicted.
+        Only conversations that exist and have not ended are rebuilt, once even if several messages arrive together.
 
         Args:
-            None
+            cid (str): id of the conversation
+
+        Returns:
+            Optional[ConversationalChatBot]: Returns the chatbot for the specified conversation or None if it cannot be rebuilt.
+        """
+        chatbot = self.get_chatbot(cid)
+        if chatbot is not None:
+            return chatbot
+        return self._build_once(cid, lambda: self._rehydrate_chatbot(cid))
+
+    def _rehydrate_chatbot(self, cid: str) -> Optional[ConversationalChatBot]:
+        with self._lock:
+            chatbot = self._evicting.get(cid, None)
+        if chatbot is None:
+            if self.db is None:
+                return None
+            conversations_collection = self.db.get_collection("conversations")
+            try:
+                conversation = conversations_collection.find_by_id(cid)
+            except InvalidId:
+                return None
+            if conversation is None or conversation.is_ended:
+                return None
+            chatbot = self._create_chatbot(cid, self.db, self.logger)
+
+        self._log(LogType.INFO, f"Rehydrating chatbot for conversation {cid}")
+        with self._lock:
+            self._rehydrations += 1
+        return chatbot
+
+    def _is_over_capacity(self, count: int, memory: int) -> bool:
+        return (self.max_chatbots is not None and count > self.max_chatbots) or (
+            self.max_chatbots_memory is not None and memory > self.max_chatbots_memory
+        )
+
+    def _evict(self, protected_cid: str) -> list[tuple[str, ConversationalChatBot]]:
+        # Chatbots are visited from the least recently used one
+        if not self._is_over_capacity(len(self.chatbots), 0) and self.max_chatbots_memory is None:
+            return []
+
+        with self._evict_lock:
+            candidates = self.chatbots.least_recently_used()
+            count = len(candidates)
+            memory = 0
+            if self.max_chatbots_memory is not None:
+                memory = sum(cb.estimated_memory_bytes for _, cb in candidates)
+
+            evicted = []
+            for cid, chatbot in candidates:
+                if not self._is_over_capacity(count, memory):
+                    break
+                if cid == protected_cid or chatbot.is_busy:
+                    continue
+                # The chatbot may have been ended or replaced since the snapshot
+                if self.chatbots.pop(cid, chatbot) is None:
+                    continue
+                count -= 1
+                if self.max_chatbots_memory is not None:
+                    memory -= chatbot.estimated_memory_bytes
+                with self._lock:
+                    self._evicting[cid] = chatbot
+                    self._evictions += 1
+                evicted.append((cid, chatbot))
+            return evicted
+
+    def _flush_evicted(self, evicted: list[tuple[str, ConversationalChatBot]]) -> None:
+        for cid, chatbot in evicted:
+            try:
+                chatbot.flush_history()
+                self._log(LogType.INFO, f"Evicted chatbot for conversation {cid}")
+            except Exception as exc:
+                self._log(
+                    LogType.ERROR,
+                    f"Failed to flush the history of the evicted chatbot for conversation {cid}: {exc!r}",
+                )
+            finally:
+                with self._lock:
+                    if self._evicting.get(cid, None) is chatbot:
+                        del self._evicting[cid]
+
+    def _log(self, log_type: LogType, message: str) -> None:
+        if self.logger is not None:
+            self.logger.log(Log(log_type, message))
+        else:
+            print(f"CHATBOT MANAGER - {message}")
+
+    def _track_deadlines(self, cid: str, chatbot: ConversationalChatBot) -> None:
+        self._deadlines.schedule(cid, "idle", chatbot.idle_deadline)
+        time_limit_deadline = chatbot.time_limit_deadline
+        if time_limit_deadline is not None:
+            self._deadlines.schedule(
+                cid, "time_limit", time_limit_deadline + self.time_limit_grace
+            )
+
+    def _on_deadline(self, cid: str, kind: str) -> None:
+        # Runs on the scheduler thread: ending a conversation reads from the database and starts
+        # the final feedback, so it is handed to the background executor. Whatever its policy, the
+        # scheduler thread never runs it nor waits: if the executor is full, it is tried again later.
+        if not self.background_executor.offer(self._expire_conversation, cid, kind):
+            self._deadlines.schedule(cid, kind, time.time() + EXPIRATION_RETRY_DELAY)
+
+    def _expire_conversation(self, cid: str, kind: str) -> None:
+        """
+        End a conversation whose idle or time limit deadline has expired. Evicted chatbots are
+        rebuilt first, so that the final feedback of the conversation is computed.
+
+        Args:
+            cid (str): id of the conversation
+            kind (str): kind of the expired deadline, "idle" or "time_limit"
 
         Returns:
             None
         """
-        with self.dict_lock:
-            for cid, chatbot in self.chatbots.items():
-                if chatbot.is_idle:
-                    _, _ = self.end_chatbot(cid=cid, db=chatbot.db,
-                                            logger=chatbot.logger)
+        chatbot = self._get_or_rehydrate_chatbot(cid)
+        if chatbot is None:
+            return
+        if chatbot.is_busy:
+            # Let the current turn complete first
+            self._deadlines.schedule(cid, kind, time.time() + EXPIRATION_RETRY_DELAY)
+            return
+
+        if kind == "idle":
+            self._log(LogType.CHATBOT, f"The conversation with ID {cid} is idling.")
+        else:
+            self._log(LogType.CHATBOT, f"The conversation with ID {cid} exceeded its time limit.")
+        self.end_chatbot(
+            cid=cid,
+            db=self.db if self.db is not None else chatbot.db,
+            logger=self.logger if self.logger is not None else chatbot.logger,
+        )
+
+    def get_stats(self) -> dict:
+        """
+        Get the statistics of the chatbot manager.
+
+        Args:
+            None
+
+        Returns:
+            dict: Returns the number and estimated memory of the managed chatbots, the number of evicted,
+            rehydrated and initializing chatbots, the number of warm chatbots and of warm-ups, warm chatbots used and discarded, the number of turns queued behind the running turn of their conversation, the statistics of the deadline scheduler, the statistics of the background executor
+            (queue wait, run time, queued and in-flight tasks), the statistics of the analysis cache,
+            the statistics of the chat model pool, the statistics of the LLM scheduler and of the LLM call policy and the statistics of the job worker.
+        """
+        return {
+            "chatbots": len(self.chatbots),
+            "max_chatbots": self.max_chatbots,
+            "chatbots_memory": sum(
+                cb.estimated_memory_bytes for cb in self.chatbots.values()
+            ),
+            "registry_shards": self.chatbots.shards,
+            "max_chatbots_memory": self.max_chatbots_memory,
+            "evictions": self._evictions,
+            "rehydrations": self._rehydrations,
+            "initializing": len(self._initializing),
+            "warm_chatbots": len(self._warm),
+            "warmups": self._warmups,
+            "warm_hits": self._warm_hits,
+            "warm_discarded": self._warm_discarded,
+            "queued_turns": sum(cb.queued_turns for cb in self.chatbots.values()),
+            "deadlines": self._deadlines.stats(),
+            "background": self.background_executor.stats(),
+            "analysis_cache": (
+                self.analysis_cache.stats() if self.analysis_cache is not None else None
+            ),
+            "model_pool": self.model_pool.stats(),
+            "llm_scheduler": self.llm_scheduler.stats(),
+            "llm_call_policy": self.llm_call_policy.stats(),
+            "llm_circuit_breaker": (
+                self.llm_circuit_breaker.stats()
+                if self.llm_circuit_breaker is not None
+                else None
+            ),
+            "turn_deduplication": self.turn_deduplicator.stats(),
+            "jobs": self.job_worker.stats() if self.job_worker is not None else None,
+        }
 
     def get_chatbot(self, cid: str) -> ConversationalChatBot:
         """
@@ -136,12 +840,11 @@ class ChatbotManager:
         Returns:
         ConversationalChatBot: Returns the chatbot for the specified conversation or None if the conversation is not initialized.
         """
-        with self.dict_lock:
-            return self.chatbots.get(cid, None)
+        return self.chatbots.get(cid, None)
 
     def add_chatbot(self, cid: str, chatbot: ConversationalChatBot) -> None:
         """
-        Add a chatbot to the chatbot manager.
+        Add a chatbot to the chatbot manager, evicting the least recently used ones if the manager is over capacity.
 
         Args:
             cid (str): id of the conversation managed by the chatbot
@@ -150,31 +853,167 @@ class ChatbotManager:
         Returns:
             None
         """
-        with self.dict_lock:
-            self.chatbots[cid] = chatbot
+        self.chatbots.put(cid, chatbot)
+        self._trim_warm_chatbots()
+        evicted = self._evict(protected_cid=cid)
+        self._track_deadlines(cid, chatbot)
+        self._flush_evicted(evicted)
 
-    def send_message_to_chatbot(self, cid: str, message: str) -> tuple[int, str]:
+    def send_message_to_chatbot(
+        self, cid: str, message: str, message_id: str = None
+    ) -> tuple[int, str]:
         """
         Send a message to the chatbot in the specified conversation.
 
         Args:
             cid (str): id of the conversation in which the message is sent
             message (str): the message to send to the chatbot coming from the user
+            message_id (str, optional): id of the message given by the client, the same when the message is sent again. Defaults to None.
 
         Returns:
             tuple[int, str]: Returns a tuple containing the status code and the response message.
             The response message is the chatbot's response to the user message or an error
-            message in case the conversation is not initialized.
+            message in case the conversation is not initialized (400), the chat model did not answer
+            before its deadline (504, the turn is not recorded) or the turn failed (500, the turn is not recorded). While the circuit breaker is open, the
+            response is a canned reply asking to wait (200, the turn is not recorded). Evicted chatbots
+            are rebuilt transparently. A message sent again with the same id while its turn is running,
+            or after it was recorded, gets the response of the first one without calling the chatbot.
         """
-        chatbot = self.get_chatbot(cid)
+        chatbot = self._get_or_rehydrate_chatbot(cid)
+        if chatbot is None:
+            return (
+                400,
+                "Chatbot not initialized. Before sending messages, you must initialize the conversation. See /initialize-conversation.",
+            )
+        self._deadlines.schedule(cid, "idle", time.time() + chatbot.idle_timeout)
+
+        key = self._turn_key(chatbot, message, message_id)
+        if key is None:
+            status_code, response_message, _ = self._send_message(cid, chatbot, message)
+            return status_code, response_message
+        future, response_message = self._begin_turn(cid, key)
+        if future is None:
+            return 200, response_message
+        try:
+            status_code, response_message, recorded = self._send_message(
+                cid, chatbot, message
+            )
+        except BaseException:
+            self.turn_deduplicator.abort(cid, key, future)
+            raise
+        if recorded:
+            self.turn_deduplicator.complete(cid, key, future, response_message)
+        else:
+            self.turn_deduplicator.abort(cid, key, future)
+        return status_code, response_message
+
+    def _turn_key(
+        self, chatbot: ConversationalChatBot, message: str, message_id: Optional[str]
+    ) -> Optional[str]:
+        # The position of the turn is only needed (and read) to deduplicate the messages by content
+        position = (
+            chatbot.messages_count
+            if message_id is None and self.turn_deduplicator.content_ttl > 0
+            else None
+        )
+        return self.turn_deduplicator.key(message, message_id, position)
+
+    def _send_message(
+        self, cid: str, chatbot: ConversationalChatBot, message: str
+    ) -> tuple[int, str, bool]:
+        """Returns the status code, the response message and whether the turn was recorded."""
+        try:
+            response = chatbot.send_message(message)
+        except LLMTimeoutError as exc:
+            self._log(LogType.ERROR, f"Conversation {cid}: {exc}")
+            return 504, CHATBOT_TIMEOUT_MESSAGE, False
+        except Exception as exc:
+            self._log(LogType.ERROR, f"Conversation {cid}: the turn failed: {exc!r}")
+            return 500, CHATBOT_ERROR_MESSAGE, False
+        return 200, response["output"], response["turn_recorded"]
+
+    def _begin_turn(self, cid: str, key: str) -> tuple[Optional[Future], Optional[str]]:
+        """
+        Register a turn in the turn deduplicator, waiting for the running duplicate of the turn, if any.
+
+        Returns:
+            tuple[Optional[Future], Optional[str]]: the future of the turn if the caller must run it, otherwise
+            None and the response of the first message
+        """
+        while True:
+            future, owner = self.turn_deduplicator.begin(cid, key)
+            if owner:
+                return future, None
+            response_message = self.turn_deduplicator.wait(future)
+            if response_message is not None:
+                self._log(
+                    LogType.INFO,
+                    f"Conversation {cid}: message sent again, answered with the response of the first one.",
+                )
+                return None, response_message
+            # The first message did not complete its turn: this one runs it
+
+    def stream_message_to_chatbot(
+        self, cid: str, message: str, message_id: str = None
+    ) -> tuple[int, Union[str, Iterator[str]]]:
+        """
+        Send a message to the chatbot in the specified conversation, streaming back the response.
+
+        Args:
+            cid (str): id of the conversation in which the message is sent
+            message (str): the message to send to the chatbot coming from the user
+            message_id (str, optional): id of the message given by the client, the same when the message is sent again. Defaults to None.
+
+        Returns:
+            tuple[int, Union[str, Iterator[str]]]: Returns a tuple containing the status code and either
+            an iterator over the chunks of the chatbot's response or an error message in case the
+            conversation is not initialized. A message sent again with the same id while its turn is
+            running, or after it was recorded, gets the response of the first one in a single chunk.
+        """
+        chatbot = self._get_or_rehydrate_chatbot(cid)
         if chatbot is None:
             return (
                 400,
                 "Chatbot not initialized. Before sending messages, you must initialize the conversation. See /initialize-conversation.",
             )
-        response = chatbot.send_message(message)
-        response_message = response["output"]
-        return 200, response_message
+        self._deadlines.schedule(cid, "idle", time.time() + chatbot.idle_timeout)
+
+        key = self._turn_key(chatbot, message, message_id)
+        if key is None:
+            return 200, chatbot.stream_message(message)
+        return 200, self._stream_turn(cid, key, chatbot, message)
+
+    def _stream_turn(
+        self, cid: str, key: str, chatbot: ConversationalChatBot, message: str
+    ) -> Iterator[str]:
+        """
+        Yields the chunks of a turn, then records its response in the turn deduplicator. The turn is
+        only registered once the client reads the stream, so that an unread stream never holds its duplicates.
+        """
+        future, response_message = self._begin_turn(cid, key)
+        if future is None:
+            yield response_message
+            return
+        stream = chatbot.stream_message(message)
+        response = []
+        recorded = False
+        try:
+            while True:
+                try:
+                    chunk = next(stream)
+                except StopIteration as stop:
+                    # The chatbot returns whether it recorded the turn
+                    recorded = bool(stop.value)
+                    break
+                response.append(chunk)
+                yield chunk
+        finally:
+            stream.close()
+            if recorded:
+                self.turn_deduplicator.complete(cid, key, future, "".join(response))
+            else:
+                # Interrupted (e.g. the client disconnected), failed or not recorded
+                self.turn_deduplicator.abort(cid, key, future)
 
     def end_chatbot(self, cid: str, db: MongoDB, logger: Logger) -> None:
         """
@@ -189,10 +1028,17 @@ class ChatbotManager:
             tuple[int, str]: Returns a tuple containing the status code and the response message.
             The response message indicates whether the conversation ended successfully or if there was an error.
         """
-        chatbot = self.get_chatbot(cid)
+        chatbot = self.chatbots.pop(cid)
+        with self._lock:
+            if chatbot is None:
+                chatbot = self._evicting.pop(cid, None)
+            # A warm chatbot of the conversation would be out of date
+            self._warm.pop(cid, None)
+        self._deadlines.cancel(cid, "idle")
+        self._deadlines.cancel(cid, "time_limit")
+        self.turn_deduplicator.forget(cid)
         if chatbot:
             chatbot.deactivate()
-            del self.chatbots[cid]
 
         # Set the conversation as ended in the database
         conversations_collection = db.get_collection("conversations")
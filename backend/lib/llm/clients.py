@@ -0,0 +1,145 @@
+"""
+Module containing the pool of chat models shared by the chatbots.
+"""
+
+from threading import Lock
+from typing import Optional
+
+import httpx
+from langchain_openai import ChatOpenAI
+from langchain_core.language_models.chat_models import BaseChatModel
+
+from .fake import FakeChatModel
+
+# Chat model classes of the supported providers
+LLM_PROVIDERS = {
+    "openai": ChatOpenAI,
+    "fake": FakeChatModel,
+}
+
+
+class ChatModelPool:
+    """
+    Process-wide pool of chat models, keyed by model version and temperature.
+
+    Chat models are stateless, so a single instance per key can serve every chatbot. All the
+    models share one HTTP client, whose keep-alive connection pool is reused across conversations.
+
+    The chat models come from a provider of LLM_PROVIDERS: "openai" for the OpenAI API, or "fake"
+    for a local deterministic model (see FakeChatModel), which needs no network.
+
+    Args:
+        api_key (str): API key of the model provider.
+        model (BaseChatModel, optional): Class of the chat models. Defaults to the class of the provider.
+        provider (str, optional): Provider of the chat models, one of LLM_PROVIDERS. Defaults to "openai".
+        model_options (dict, optional): Extra arguments passed to the chat models (e.g. the latencies of the fake model). Defaults to None.
+        max_connections (int, optional): Maximum number of concurrent HTTP connections. Defaults to 100.
+        max_keepalive_connections (int, optional): Maximum number of idle connections kept alive. Defaults to 20.
+        keepalive_expiry (float, optional): Time (in seconds) after which idle connections are closed. Defaults to 30 seconds.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        model: BaseChatModel = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        provider: str = "openai",
+        model_options: Optional[dict] = None,
+    ):
+        if provider not in LLM_PROVIDERS:
+            raise ValueError(
+                f"Invalid LLM provider {provider}. Possible values: {tuple(LLM_PROVIDERS)}."
+            )
+        self.api_key = api_key
+        self.provider = provider
+        self.model = model if model is not None else LLM_PROVIDERS[provider]
+        self.model_options = model_options if model_options is not None else dict()
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._http_client = httpx.Client(limits=self._limits)
+
+        self._models = dict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, model_version: str, temperature: float) -> BaseChatModel:
+        """
+        Get the chat model for the given model version and temperature, creating it on first use.
+
+        Args:
+            model_version (str): version of the model (e.g. "gpt-3.5-turbo")
+            temperature (float): sampling temperature of the model
+
+        Returns:
+            BaseChatModel: the shared chat model
+        """
+        key = (model_version, float(temperature))
+        with self._lock:
+            chat_model = self._models.get(key)
+            if chat_model is not None:
+                self._hits += 1
+                return chat_model
+
+            self._misses += 1
+            chat_model = self._create(model_version, temperature)
+            self._models[key] = chat_model
+            return chat_model
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the pool.
+
+        Returns:
+            dict: Dictionary with the provider and the keys of the pooled models, the hits and misses of the pool, the
+            limits of the HTTP connection pool and the number of open HTTP connections.
+        """
+        with self._lock:
+            return {
+                "provider": self.provider,
+                "models": [
+                    {"model_version": version, "temperature": temperature}
+                    for version, temperature in self._models
+                ],
+                "hits": self._hits,
+                "misses": self._misses,
+                "max_connections": self._limits.max_connections,
+                "max_keepalive_connections": self._limits.max_keepalive_connections,
+                "open_connections": self._count_open_connections(),
+            }
+
+    def close(self) -> None:
+        """
+        Close the shared HTTP client and its connections.
+
+        Returns:
+            None
+        """
+        self._http_client.close()
+
+    def _create(self, model_version: str, temperature: float) -> BaseChatModel:
+        if self.model is ChatOpenAI:
+            return ChatOpenAI(
+                model=model_version,
+                api_key=self.api_key,
+                temperature=temperature,
+                http_client=self._http_client,
+                **self.model_options,
+            )
+        return self.model(
+            model=model_version,
+            api_key=self.api_key,
+            temperature=temperature,
+            **self.model_options,
+        )
+
+    def _count_open_connections(self):
+        # httpx does not expose its connection pool publicly, so this is best effort
+        pool = getattr(getattr(self._http_client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        return len(connections) if connections is not None else None
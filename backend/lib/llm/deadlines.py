@@ -0,0 +1,169 @@
+"""
+Module containing the scheduler of the conversation deadlines (idle timeouts and time limits).
+"""
+
+import heapq
+import time
+from itertools import count
+from threading import Condition, Thread
+from typing import Callable, Hashable
+
+
+class DeadlineScheduler:
+    """
+    Fires a callback when a deadline expires, without scanning all the deadlines periodically.
+
+    Deadlines are identified by a key and a kind (e.g. a conversation id and "idle"), and each
+    (key, kind) has at most one deadline. Deadlines are kept in a min-heap served by a single
+    thread, which sleeps until the earliest one.
+
+    Postponing a deadline, which happens on every message for the idle timeouts, is O(1): only
+    the dictionary of the current deadlines is updated, and the heap entry is re-armed with the
+    current deadline when it comes due. Anticipating a deadline pushes a new entry (O(log n)) and
+    the outdated one is discarded when popped.
+
+    The callback runs on the scheduler thread, so it should hand any slow work to another thread.
+
+    Args:
+        on_expire (Callable[[Hashable, str], None]): Called with the key and the kind of each expired deadline.
+        max_sleep (float, optional): Maximum time (in seconds) the scheduler thread sleeps before checking the heap again. Defaults to 60 seconds.
+    """
+
+    def __init__(
+        self, on_expire: Callable[[Hashable, str], None], max_sleep: float = 60
+    ):
+        self._on_expire = on_expire
+        self._max_sleep = max_sleep
+
+        self._heap = []
+        self._deadlines = dict()
+        self._sequence = count()
+        self._condition = Condition()
+        self._thread = None
+        self._expired = 0
+
+    def schedule(self, key: Hashable, kind: str, deadline: float) -> None:
+        """
+        Set the deadline of a (key, kind), replacing the current one if any.
+
+        Args:
+            key (Hashable): key of the deadline (e.g. the conversation id)
+            kind (str): kind of the deadline (e.g. "idle")
+            deadline (float): expiration time, as returned by time.time()
+
+        Returns:
+            None
+        """
+        self.start()
+        with self._condition:
+            current = self._deadlines.get((key, kind))
+            self._deadlines[(key, kind)] = deadline
+            if current is not None and deadline >= current:
+                # The heap entry of the current deadline will be re-armed when it comes due
+                return
+            heapq.heappush(self._heap, (deadline, next(self._sequence), key, kind))
+            if self._heap[0][2:] == (key, kind):
+                self._condition.notify()
+
+    def cancel(self, key: Hashable, kind: str) -> None:
+        """
+        Remove the deadline of a (key, kind), if any. Its heap entry is discarded when popped.
+
+        Args:
+            key (Hashable): key of the deadline
+            kind (str): kind of the deadline
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self._deadlines.pop((key, kind), None)
+
+    def get_deadline(self, key: Hashable, kind: str):
+        """
+        Get the deadline of a (key, kind).
+
+        Args:
+            key (Hashable): key of the deadline
+            kind (str): kind of the deadline
+
+        Returns:
+            Optional[float]: the expiration time, or None if there is no deadline
+        """
+        with self._condition:
+            return self._deadlines.get((key, kind))
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the scheduler.
+
+        Returns:
+            dict: Dictionary with the number of pending deadlines, the size of the heap (including the
+            outdated entries) and the number of expired deadlines.
+        """
+        with self._condition:
+            return {
+                "deadlines": len(self._deadlines),
+                "heap_size": len(self._heap),
+                "expired": self._expired,
+            }
+
+    def start(self) -> None:
+        """
+        Start the scheduler thread, if it is not running yet.
+
+        Returns:
+            None
+        """
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._run, name="deadline-scheduler", daemon=True
+                )
+                self._thread.start()
+
+    def _pop_expired(self) -> list:
+        # Must be called holding the condition
+        expired = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key, kind = heapq.heappop(self._heap)
+            current = self._deadlines.get((key, kind))
+            if current is None or current < deadline:
+                # Cancelled, or replaced by an earlier deadline with its own entry
+                continue
+            if current > deadline:
+                # Postponed: re-arm the entry with the current deadline
+                heapq.heappush(self._heap, (current, next(self._sequence), key, kind))
+                continue
+            del self._deadlines[(key, kind)]
+            expired.append((key, kind))
+
+        # Drop the outdated entries once they outnumber the live ones
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [
+                (deadline, next(self._sequence), key, kind)
+                for (key, kind), deadline in self._deadlines.items()
+            ]
+            heapq.heapify(self._heap)
+        self._expired += len(expired)
+        return expired
+
+    def _run(self):
+        while True:
+            with self._condition:
+                expired = self._pop_expired()
+                if not expired:
+                    timeout = self._max_sleep
+                    if self._heap:
+                        timeout = min(timeout, max(0, self._heap[0][0] - time.time()))
+                    self._condition.wait(timeout)
+                    continue
+
+            for key, kind in expired:
+                try:
+                    self._on_expire(key, kind)
+                except Exception as exc:
+                    print(f"[DEADLINE SCHEDULER] Failed to expire {kind} deadline of {key}: {exc!r}")
@@ -0,0 +1,319 @@
+"""
+Module containing a local fake chat model, used to exercise the backend without a model provider.
+"""
+
+import hashlib
+import json
+import math
+import random
+import re
+import time
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+)
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from .PROMPTS import COMPILED_PROMPTS, CONVERSATION_PROMPT_TYPE
+
+LATENCY_DISTRIBUTIONS = ("constant", "normal", "lognormal", "exponential")
+
+# Words usually considered hard to pronounce, picked by the fake pronunciation challenge
+_HARD_TO_PRONOUNCE = {
+    "aunt",
+    "capitalism",
+    "choir",
+    "colonel",
+    "comfortable",
+    "february",
+    "island",
+    "knight",
+    "queue",
+    "rural",
+    "squirrel",
+    "thorough",
+    "wednesday",
+    "worcestershire",
+}
+
+_CONVERSATION_REPLIES = (
+    "That's interesting! What made you think about {word}?",
+    "I see what you mean about {word}. Could you tell me a bit more?",
+    "Nice! How often do you talk about {word} with your friends?",
+    "Really? I'd love to hear more about {word}. What do you like most about it?",
+    "Good point. Do you think {word} will change in the next few years?",
+)
+
+
+class FakeChatModelError(RuntimeError):
+    """Error injected by the fake chat model in place of a provider error."""
+
+    # Like an overloaded provider, so that the circuit breaker counts it
+    status_code = 503
+
+
+class FakeChatModelTimeoutError(TimeoutError):
+    """Raised by the fake chat model when a request is slower than its timeout, like an HTTP client."""
+
+
+def _prompt_types_by_text() -> dict:
+    return {
+        compiled.rendered: prompt_name
+        for prompt_name, compiled in COMPILED_PROMPTS.items()
+        if compiled.rendered
+    }
+
+
+_PROMPT_TYPES_BY_TEXT = _prompt_types_by_text()
+
+
+def get_prompt_type(messages: List[BaseMessage]) -> str:
+    """
+    Get the type of a request to the chat model, i.e. the name of the prompt of its first system
+    message, or CONVERSATION_PROMPT_TYPE for the turns of a conversation. The requests of a
+    conversation whose last message is a prompt (e.g. the opening turn) get the name of that prompt.
+
+    Args:
+        messages (List[BaseMessage]): the messages sent to the chat model
+
+    Returns:
+        str: the prompt type of the request
+    """
+    prompt_type = CONVERSATION_PROMPT_TYPE
+    for message in messages:
+        if isinstance(message, SystemMessage):
+            prompt_type = _PROMPT_TYPES_BY_TEXT.get(message.content, CONVERSATION_PROMPT_TYPE)
+            break
+    if (
+        prompt_type == CONVERSATION_PROMPT_TYPE
+        and messages
+        and isinstance(messages[-1], HumanMessage)
+    ):
+        return _PROMPT_TYPES_BY_TEXT.get(messages[-1].content, prompt_type)
+    return prompt_type
+
+
+def _words(text: str) -> list:
+    return re.findall(r"[A-Za-z']+", text)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic local chat model.
+
+    The responses only depend on the messages sent: the turns of a conversation get a short
+    question about the user message, and the post-message prompts get valid json (synonyms,
+    pronunciation, feedback and the combined analyses). Latencies and errors are drawn from a
+    random generator seeded with ``seed``, so a run is reproducible.
+
+    The latency before the first token follows ``latency_distribution`` with mean ``latency_mean``
+    and standard deviation ``latency_stddev`` (in seconds), possibly overridden per prompt type by
+    ``latency_mean_by_prompt``. The tokens are then produced at ``tokens_per_second`` (instantly if
+    None). A fraction ``error_rate`` of the requests raises a FakeChatModelError after the latency.
+    A request given a ``timeout`` whose latency exceeds it is aborted at the timeout with a
+    FakeChatModelTimeoutError, as the HTTP client of a real provider would do.
+
+    It accepts the ``model``, ``api_key`` and ``temperature`` arguments of ChatOpenAI, so it can
+    replace it in the chatbots and in the ChatModelPool.
+    """
+
+    model: str = "fake"
+    api_key: Optional[str] = None
+    temperature: float = 0.7
+    latency_distribution: str = "constant"
+    latency_mean: float = 0.0
+    latency_stddev: float = 0.0
+    latency_mean_by_prompt: Dict[str, float] = {}
+    tokens_per_second: Optional[float] = None
+    error_rate: float = 0.0
+    seed: int = 0
+
+    _rng: Any = PrivateAttr(default=None)
+    _rng_lock: Any = PrivateAttr(default=None)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(
+                f"Invalid latency distribution {self.latency_distribution}. Possible values: {LATENCY_DISTRIBUTIONS}."
+            )
+        self._rng = random.Random(self.seed)
+        self._rng_lock = Lock()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "latency_distribution": self.latency_distribution,
+            "latency_mean": self.latency_mean,
+            "tokens_per_second": self.tokens_per_second,
+            "error_rate": self.error_rate,
+        }
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        prompt_type = get_prompt_type(messages)
+        content = self._respond(prompt_type, messages)
+        self._wait_first_token(prompt_type, kwargs.get("timeout"))
+        tokens = self._tokenize(content)
+        if self.tokens_per_second:
+            time.sleep(len(tokens) / self.tokens_per_second)
+        message = AIMessage(
+            content=content, usage_metadata=self._usage(messages, len(tokens))
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        prompt_type = get_prompt_type(messages)
+        content = self._respond(prompt_type, messages)
+        self._wait_first_token(prompt_type, kwargs.get("timeout"))
+        tokens = self._tokenize(content)
+        for i, token in enumerate(tokens):
+            if i > 0 and self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            # The usage is reported by the last chunk, like the OpenAI API does
+            usage = self._usage(messages, len(tokens)) if i == len(tokens) - 1 else None
+            chunk = ChatGenerationChunk(
+                message=AIMessageChunk(content=token, usage_metadata=usage)
+            )
+            if run_manager is not None:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    @staticmethod
+    def _tokenize(content: str) -> list:
+        return re.findall(r"\S+\s*|\s+", content)
+
+    @staticmethod
+    def _usage(messages: List[BaseMessage], output_tokens: int) -> dict:
+        # About 4 characters per token, like the estimates of the chat histories
+        input_tokens = sum(len(str(message.content)) for message in messages) // 4
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+
+    def _sample_latency(self, prompt_type: str) -> float:
+        mean = self.latency_mean_by_prompt.get(prompt_type, self.latency_mean)
+        if mean <= 0:
+            return 0.0
+        with self._rng_lock:
+            if self.latency_distribution == "normal":
+                return max(0.0, self._rng.gauss(mean, self.latency_stddev))
+            if self.latency_distribution == "lognormal":
+                # Parameters of the underlying normal giving the requested mean and deviation
+                sigma = math.sqrt(math.log(1 + (self.latency_stddev / mean) ** 2))
+                return self._rng.lognormvariate(math.log(mean) - sigma**2 / 2, sigma)
+            if self.latency_distribution == "exponential":
+                return self._rng.expovariate(1 / mean)
+        return mean
+
+    def _wait_first_token(self, prompt_type: str, timeout: Optional[float] = None) -> None:
+        latency = self._sample_latency(prompt_type)
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise FakeChatModelTimeoutError(
+                f"The {prompt_type} request timed out after {timeout} seconds"
+            )
+        time.sleep(latency)
+        if self.error_rate > 0:
+            with self._rng_lock:
+                failed = self._rng.random() < self.error_rate
+            if failed:
+                raise FakeChatModelError(f"Injected error for a {prompt_type} request")
+
+    def _respond(self, prompt_type: str, messages: List[BaseMessage]) -> str:
+        user_messages = [m.content for m in messages if isinstance(m, HumanMessage)]
+        user_message = str(user_messages[-1]) if user_messages else ""
+        digest = hashlib.sha256(
+            f"{prompt_type}\x00{len(messages)}\x00{user_message}".encode("utf-8")
+        ).digest()
+
+        if prompt_type == "CHALLENGE_SYNONYMS_SYSTEM_PROMPT":
+            return json.dumps(self._synonyms(user_message))
+        if prompt_type == "CHALLENGE_PRONUNCIATION_SYSTEM_PROMPT":
+            return json.dumps(self._pronunciation(user_message))
+        if prompt_type == "MESSAGE_FEEDBACK_SYSTEM_PROMPT":
+            return json.dumps(self._feedback(user_message, digest))
+        if prompt_type == "COMBINED_POST_MESSAGE_SYSTEM_PROMPT":
+            return json.dumps(
+                {
+                    "synonyms": self._synonyms(user_message),
+                    "pronunciation": self._pronunciation(user_message),
+                    "feedback": self._feedback(user_message, digest),
+                }
+            )
+        if prompt_type == "CONVERSATION_SUMMARY_SYSTEM_PROMPT":
+            return f"The user and their partner talked about: {' '.join(_words(user_message)[-40:])}"
+        if prompt_type == "RUNNING_FEEDBACK_SYSTEM_PROMPT":
+            return (
+                "The user answers with complete sentences and a good range of vocabulary. "
+                "They sometimes forget the third person singular form of the verbs."
+            )
+        if prompt_type in ("USER_OPINION_SYNTHESIS", "RUNNING_OPINION_SYNTHESIS"):
+            return "The user is generally positive about the topic and gave a few personal examples."
+        if prompt_type == "CONVERSATION_OPENING_INSTRUCTION":
+            return "Hi, nice to meet you! What would you like to tell me about our topic today?"
+        if prompt_type == "FINAL_FEEDBACK_SYSTEM_PROMPT":
+            return (
+                "Thank you for taking part in the conversation! You expressed your ideas clearly "
+                "and kept the conversation going. Try to use a wider range of linking words and "
+                "to answer with complete sentences."
+            )
+
+        words = sorted(_words(user_message), key=lambda word: (-len(word), word))
+        word = words[0].lower() if words else "that"
+        return _CONVERSATION_REPLIES[digest[0] % len(_CONVERSATION_REPLIES)].format(
+            word=word
+        )
+
+    @staticmethod
+    def _synonyms(user_message: str) -> list:
+        words = [word for word in _words(user_message) if len(word) >= 6]
+        if not words:
+            return []
+        word = max(words, key=lambda word: (len(word), word)).lower()
+        return [word, f"{word}-like", f"quasi-{word}", f"{word}ish"]
+
+    @staticmethod
+    def _pronunciation(user_message: str) -> list:
+        words = []
+        for word in _words(user_message):
+            word = word.lower()
+            if (word in _HARD_TO_PRONOUNCE or len(word) >= 12) and word not in words:
+                words.append(word)
+        return words
+
+    @staticmethod
+    def _feedback(user_message: str, digest: bytes) -> dict:
+        if digest[1] % 4 != 0 or not user_message:
+            return {"hasMistake": False, "messageFeedback": ""}
+        return {
+            "hasMistake": True,
+            "messageFeedback": "Remember to use the third person singular form of the verb, e.g. 'she goes' instead of 'she go'.",
+        }
@@ -0,0 +1,275 @@
+"""
+Module containing the deadlines and the hedging of the requests to the chat model.
+"""
+
+import math
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Event, Lock
+from typing import Callable, Dict, Iterable, Optional, TypeVar
+
+import httpx
+import openai
+
+from .PROMPTS import CONVERSATION_PROMPT_TYPE
+from ..metrics import Counter
+
+T = TypeVar("T")
+
+LLM_HEDGES = Counter(
+    "teachme_llm_hedges_total",
+    "Hedged requests to the chat model, by prompt type and outcome (won, lost or over_budget).",
+    ("prompt_type", "outcome"),
+)
+
+
+class LLMTimeoutError(TimeoutError):
+    """Raised when a request to the chat model does not complete before its deadline."""
+
+
+class LLMAttemptCancelledError(Exception):
+    """Raised by an attempt of a hedged request cancelled before it was sent, because another attempt succeeded."""
+
+
+def is_timeout_error(exc: BaseException) -> bool:
+    """Returns True if the error was raised by a model provider aborting a request at its timeout."""
+    return isinstance(
+        exc, (TimeoutError, httpx.TimeoutException, openai.APITimeoutError)
+    )
+
+
+class LLMCallPolicy:
+    """
+    Deadlines and hedging of the requests to the chat model, shared by all the chatbots.
+
+    Each request gets the deadline of its prompt type (``timeouts``, or ``default_timeout``), which
+    is passed to the model provider as the timeout of the HTTP request: a request past its deadline
+    is aborted and raises an LLMTimeoutError, instead of holding its worker indefinitely.
+
+    The requests of the ``hedged_prompt_types`` (by default, the turns of the conversations) can be
+    hedged: if a request has not completed after the ``hedge_percentile`` of the recent latencies of
+    its prompt type, a second attempt is sent and the first one to succeed is returned. Hedging
+    starts once ``hedge_min_samples`` latencies have been observed, and at most ``hedge_budget``
+    extra requests are sent per request (plus a burst of ``hedge_burst``), so that a slow provider
+    does not get twice the load. Once an attempt succeeds, the other one is cancelled: it is dropped
+    if it is still waiting for a thread or for the scheduler, and abandoned (its response is
+    discarded, and its deadline still bounds it) if it was already sent to the provider.
+
+    The attempts of the requests that can be hedged run on a pool of ``hedge_workers`` threads, which
+    caps the requests of the hedged prompt types running at the same time: the others wait for a
+    thread, and their wait counts in their deadline. The pool must be sized for the peak of concurrent
+    conversations (e.g. twice the number of students that can talk at the same time).
+
+    Args:
+        timeouts (Dict[str, float], optional): Deadline (in seconds) of the requests by prompt type. Defaults to None.
+        default_timeout (float, optional): Deadline (in seconds) of the requests of the other prompt types. Defaults to None (no deadline).
+        hedge_percentile (float, optional): Percentile of the recent latencies after which a request is hedged, e.g. 0.95. Defaults to None (no hedging).
+        hedged_prompt_types (Iterable[str], optional): Prompt types whose requests can be hedged. Defaults to the turns of the conversations.
+        hedge_budget (float, optional): Maximum ratio of hedges to requests. Defaults to 0.05.
+        hedge_burst (int, optional): Hedges allowed on top of the budget. Defaults to 5.
+        hedge_min_samples (int, optional): Latencies observed before the requests of a prompt type are hedged. Defaults to 20.
+        hedge_window (int, optional): Number of recent latencies the percentile is computed on. Defaults to 200.
+        hedge_workers (int, optional): Threads running the attempts of the requests that can be hedged, see above. Defaults to 64.
+    """
+
+    def __init__(
+        self,
+        timeouts: Dict[str, float] = None,
+        default_timeout: float = None,
+        hedge_percentile: float = None,
+        hedged_prompt_types: Iterable[str] = (CONVERSATION_PROMPT_TYPE,),
+        hedge_budget: float = 0.05,
+        hedge_burst: int = 5,
+        hedge_min_samples: int = 20,
+        hedge_window: int = 200,
+        hedge_workers: int = 64,
+    ):
+        if hedge_percentile is not None and not 0 < hedge_percentile < 1:
+            raise ValueError("The hedge percentile must be in (0, 1).")
+        if hedge_workers < 1:
+            raise ValueError("The hedging needs at least one worker.")
+        self.timeouts = dict(timeouts) if timeouts is not None else dict()
+        self.default_timeout = default_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedged_prompt_types = frozenset(hedged_prompt_types)
+        self.hedge_budget = hedge_budget
+        self.hedge_burst = hedge_burst
+        self.hedge_min_samples = hedge_min_samples
+
+        self._lock = Lock()
+        self._latencies = {
+            prompt_type: deque(maxlen=hedge_window)
+            for prompt_type in self.hedged_prompt_types
+        }
+        # Hedges that can be sent, earned by the requests of the hedged prompt types
+        self._hedge_tokens = float(hedge_burst)
+        self._requests = 0
+        self._hedges = 0
+        self._hedges_won = 0
+        self._hedges_cancelled = 0
+        self._timeouts = 0
+        self.hedge_workers = hedge_workers
+        self._executor = (
+            ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="llm-hedge")
+            if hedge_percentile is not None
+            else None
+        )
+
+    def timeout(self, prompt_type: str) -> Optional[float]:
+        """
+        Get the deadline of the requests of a prompt type.
+
+        Args:
+            prompt_type (str): name of the system prompt of the request
+
+        Returns:
+            Optional[float]: the deadline (in seconds), or None if the requests have no deadline
+        """
+        return self.timeouts.get(prompt_type, self.default_timeout)
+
+    def hedge_delay(self, prompt_type: str) -> Optional[float]:
+        """
+        Get the time after which a request of a prompt type is hedged.
+
+        Args:
+            prompt_type (str): name of the system prompt of the request
+
+        Returns:
+            Optional[float]: the percentile of the recent latencies of the prompt type, or None if its requests are not hedged (yet)
+        """
+        if self.hedge_percentile is None or prompt_type not in self.hedged_prompt_types:
+            return None
+        with self._lock:
+            latencies = sorted(self._latencies[prompt_type])
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        index = math.ceil(self.hedge_percentile * len(latencies)) - 1
+        return latencies[min(len(latencies) - 1, index)]
+
+    def call(
+        self, prompt_type: str, attempt: Callable[[Optional[float], Event], T]
+    ) -> T:
+        """
+        Run a request to the chat model with the deadline of its prompt type, hedging it if needed.
+
+        Args:
+            prompt_type (str): name of the system prompt of the request
+            attempt (Callable[[Optional[float], Event], T]): sends the request with the given timeout (in seconds, None for
+                no timeout), raising an LLMTimeoutError if the request is aborted at its deadline, or an
+                LLMAttemptCancelledError if the event is set before the request is sent
+
+        Raises:
+            LLMTimeoutError: If no attempt completed before the deadline.
+
+        Returns:
+            T: the result of the first attempt that succeeded
+        """
+        timeout = self.timeout(prompt_type)
+        hedge_delay = self.hedge_delay(prompt_type)
+        if prompt_type in self.hedged_prompt_types:
+            with self._lock:
+                self._requests += 1
+                self._hedge_tokens = min(
+                    self.hedge_burst, self._hedge_tokens + self.hedge_budget
+                )
+        if hedge_delay is None or (timeout is not None and hedge_delay >= timeout):
+            return self._timed(prompt_type, attempt, timeout, Event())
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        first_cancelled = Event()
+        first = self._executor.submit(
+            self._timed, prompt_type, attempt, timeout, first_cancelled
+        )
+        done, _ = wait([first], timeout=hedge_delay)
+        if done or not self._take_hedge():
+            if not done:
+                LLM_HEDGES.labels(prompt_type, "over_budget").inc()
+            return first.result()
+
+        # The second attempt gets what is left of the deadline of the request
+        remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+        second_cancelled = Event()
+        second = self._executor.submit(
+            self._timed, prompt_type, attempt, remaining, second_cancelled
+        )
+        cancellations = {first: first_cancelled, second: second_cancelled}
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded or not pending:
+                future = succeeded[0] if succeeded else first
+                won = future is second
+                LLM_HEDGES.labels(prompt_type, "won" if won else "lost").inc()
+                if won:
+                    with self._lock:
+                        self._hedges_won += 1
+                for loser in pending:
+                    self._cancel(loser, cancellations[loser])
+                return future.result()
+
+    def _cancel(self, future, cancelled: Event) -> None:
+        # Drops an attempt still waiting for a thread or for the scheduler; an attempt already sent
+        # to the provider cannot be aborted by a synchronous client and is abandoned
+        cancelled.set()
+        future.cancel()
+        with self._lock:
+            self._hedges_cancelled += 1
+
+    def _timed(
+        self,
+        prompt_type: str,
+        attempt: Callable[[Optional[float], Event], T],
+        timeout: Optional[float],
+        cancelled: Event,
+    ) -> T:
+        started_at = time.monotonic()
+        try:
+            result = attempt(timeout, cancelled)
+        except LLMTimeoutError:
+            with self._lock:
+                self._timeouts += 1
+            raise
+        self._record_latency(prompt_type, time.monotonic() - started_at)
+        return result
+
+    def _record_latency(self, prompt_type: str, latency: float) -> None:
+        if prompt_type not in self.hedged_prompt_types:
+            return
+        with self._lock:
+            self._latencies[prompt_type].append(latency)
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+            self._hedges += 1
+            return True
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the policy.
+
+        Returns:
+            dict: Dictionary with the deadlines, the hedge delay of each hedged prompt type, the requests of the
+            hedged prompt types, the hedges sent, won and cancelled (the attempts that lost), the size of the pool
+            running the hedged attempts, and the requests aborted at their deadline.
+        """
+        hedge_delays = {
+            prompt_type: self.hedge_delay(prompt_type)
+            for prompt_type in sorted(self.hedged_prompt_types)
+        }
+        with self._lock:
+            return {
+                "timeouts": dict(self.timeouts),
+                "default_timeout": self.default_timeout,
+                "hedge_delays": hedge_delays,
+                "requests": self._requests,
+                "hedges": self._hedges,
+                "hedges_won": self._hedges_won,
+                "hedges_cancelled": self._hedges_cancelled,
+                "hedge_workers": self.hedge_workers,
+                "timed_out": self._timeouts,
+            }
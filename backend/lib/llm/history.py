@@ -0,0 +1,383 @@
+"""
+Chat message histories of the chatbots, stored in the application database.
+"""
+
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import (
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    message_to_dict,
+    messages_from_dict,
+)
+
+from ..database.Collection import (
+    ChatHistorySummariesCollection,
+    ChatMessageHistoryCollection,
+)
+from .PROMPTS import get_conversation_summary_addendum
+from .background import BackgroundExecutor, BackgroundQueueFullError
+
+
+def _messages_size(messages: Sequence[BaseMessage]) -> int:
+    return sum(len(str(message.content)) for message in messages)
+
+
+def _turn_starts(messages: Sequence[BaseMessage], start: int = 0) -> list[int]:
+    # A turn starts with a message of the user: the opening message of the chatbot, if any, is part
+    # of the first turn
+    return [
+        index
+        for index in range(start, len(messages))
+        if isinstance(messages[index], HumanMessage)
+    ]
+
+
+class CollectionChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat message history of a session stored in the chat message history collection.
+
+    Unlike langchain's MongoDBChatMessageHistory, which opens a new MongoClient for every history,
+    it goes through the collection of the application database, so all the sessions share the
+    process-wide client and its connection pool.
+
+    :ivar ChatMessageHistoryCollection _collection: The chat message history collection.
+    :ivar str session_id: ID of the chat session.
+    """
+
+    def __init__(self, collection: ChatMessageHistoryCollection, session_id: str):
+        self._collection = collection
+        self.session_id = session_id
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        """Retrieves the messages of the session from the database."""
+        return messages_from_dict(self._collection.get_messages(self.session_id))
+
+    def add_message(self, message: BaseMessage) -> None:
+        """Appends a message to the session.
+
+        :param message: The message to append.
+        :type message: BaseMessage
+        """
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Appends messages to the session with a single write.
+
+        :param messages: The messages to append.
+        :type messages: Sequence[BaseMessage]
+        """
+        self._collection.add_messages(
+            self.session_id, [message_to_dict(message) for message in messages]
+        )
+
+    def clear(self) -> None:
+        """Deletes all the messages of the session."""
+        self._collection.clear(self.session_id)
+
+
+class BufferedChatMessageHistory(BaseChatMessageHistory):
+    """
+    Write-back cache in front of a chat message history.
+
+    The messages of the backing history are loaded once, then reads are served from memory and new
+    messages are appended locally. The new messages are written to the backing history in batches
+    by the background executor, or synchronously if no executor is given. Call ``flush`` to make
+    sure every message has been written (e.g. before the chatbot is discarded).
+
+    :ivar BaseChatMessageHistory _store: The backing chat message history.
+    :ivar BackgroundExecutor _executor: Executor running the asynchronous writes.
+    """
+
+    def __init__(
+        self, store: BaseChatMessageHistory, executor: BackgroundExecutor = None
+    ):
+        self._store = store
+        self._executor = executor
+        self._messages = list(store.messages)
+        self._size_bytes = _messages_size(self._messages)
+        self._pending = []
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._is_flush_scheduled = False
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        """Returns the messages of the session, without reading the backing history."""
+        with self._lock:
+            return list(self._messages)
+
+    @property
+    def size_bytes(self) -> int:
+        """Returns the size (in bytes) of the content of the messages held in memory."""
+        with self._lock:
+            return self._size_bytes
+
+    @property
+    def pending_count(self) -> int:
+        """Returns the number of messages not yet written to the backing history."""
+        with self._lock:
+            return len(self._pending)
+
+    def add_message(self, message: BaseMessage) -> None:
+        """Appends a message to the session.
+
+        :param message: The message to append.
+        :type message: BaseMessage
+        """
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Appends messages to the session and schedules their write to the backing history.
+
+        :param messages: The messages to append.
+        :type messages: Sequence[BaseMessage]
+        """
+        with self._lock:
+            self._messages.extend(messages)
+            self._size_bytes += _messages_size(messages)
+            self._pending.extend(messages)
+            if self._is_flush_scheduled:
+                # The scheduled flush will write these messages in the same batch
+                return
+            self._is_flush_scheduled = self._executor is not None
+
+        if self._executor is None:
+            self.flush()
+            return
+        try:
+            self._executor.submit(self.flush)
+        except BackgroundQueueFullError:
+            # The executor is saturated: write the messages synchronously
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all the pending messages to the backing history."""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = []
+                self._is_flush_scheduled = False
+            if len(batch) == 0:
+                return
+            try:
+                self._store.add_messages(batch)
+            except Exception:
+                # Put the batch back in front of the messages added in the meantime
+                with self._lock:
+                    self._pending = batch + self._pending
+                raise
+
+    def clear(self) -> None:
+        """Deletes all the messages of the session, both locally and in the backing history."""
+        with self._flush_lock:
+            with self._lock:
+                self._messages = []
+                self._size_bytes = 0
+                self._pending = []
+            self._store.clear()
+
+
+@dataclass
+class HistoryCompactionSettings:
+    """
+    Thresholds of the history compaction.
+
+    Once the messages not yet summarized exceed ``max_turns`` turns, or ``max_tokens`` estimated
+    tokens, all of them but the last ``window_turns`` turns are folded into the rolling summary. A
+    turn is a message of the user and the replies of the chatbot that follow it.
+    """
+
+    window_turns: int = 6
+    max_turns: int = 12
+    max_tokens: int = 1500
+
+
+def estimate_tokens(messages: Sequence[BaseMessage]) -> int:
+    """Roughly estimates the number of tokens of some messages (about 4 characters per token).
+
+    :param messages: The messages to measure.
+    :type messages: Sequence[BaseMessage]
+    :return: The estimated number of tokens.
+    :rtype: int
+    """
+    return _messages_size(messages) // 4
+
+
+def format_transcript(messages: Sequence[BaseMessage]) -> str:
+    """Formats chat messages as a transcript, like the managed conversations collection does.
+
+    :param messages: The messages to format.
+    :type messages: Sequence[BaseMessage]
+    :return: The transcript of the messages.
+    :rtype: str
+    """
+    transcript = ""
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            transcript += f"User message: {message.content}\n"
+        else:
+            transcript += f"Conversational partner message: {message.content}\n"
+    return transcript
+
+
+class CompactingChatMessageHistory(BaseChatMessageHistory):
+    """
+    Bounded view of a chat message history: the last turns verbatim, preceded by a rolling summary
+    of the older ones.
+
+    The whole history is still stored by the wrapped chat message history; only the messages
+    returned to the prompt are compacted. The summary is refreshed by the background executor
+    (or synchronously if no executor is given) whenever the thresholds are exceeded, so the
+    turns never wait for it.
+
+    The summary and the number of messages it covers are saved with the history, if a summaries
+    collection is given, so that a chatbot rebuilt from the database resumes from them instead of
+    sending the whole history until the summary is computed again.
+
+    :ivar BaseChatMessageHistory _history: The wrapped chat message history.
+    :ivar Callable[[Optional[str], str], str] _summarize: Given the current summary (or None) and the transcript of the messages to fold, returns the new summary.
+    :ivar HistoryCompactionSettings _settings: The compaction thresholds.
+    :ivar BackgroundExecutor _executor: Executor running the summary refreshes.
+    :ivar ChatHistorySummariesCollection _summaries: The collection the summary is saved in, if any.
+    :ivar str session_id: ID of the chat session.
+    """
+
+    def __init__(
+        self,
+        history: BaseChatMessageHistory,
+        summarize: Callable[[Optional[str], str], str],
+        settings: HistoryCompactionSettings = None,
+        executor: BackgroundExecutor = None,
+        summaries: ChatHistorySummariesCollection = None,
+        session_id: str = None,
+    ):
+        self._history = history
+        self._summarize = summarize
+        self._settings = settings if settings is not None else HistoryCompactionSettings()
+        self._executor = executor
+        self._summaries = summaries
+        self.session_id = session_id
+
+        self._summary = None
+        self._summarized_count = 0
+        self._lock = Lock()
+        self._is_refresh_scheduled = False
+
+        messages = self._history.messages
+        saved = (
+            self._summaries.get_summary(self.session_id)
+            if self._summaries is not None
+            else None
+        )
+        # A summary covering more messages than the history is stale (e.g. the history was cleared)
+        if saved is not None and saved["summarized_count"] <= len(messages):
+            self._summary = saved["summary"]
+            self._summarized_count = saved["summarized_count"]
+        self._schedule_refresh_if_needed(messages)
+
+    @property
+    def summary(self) -> Optional[str]:
+        """Returns the rolling summary of the older messages, if any."""
+        with self._lock:
+            return self._summary
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        """Returns the summary of the older messages followed by the most recent ones."""
+        messages = self._history.messages
+        with self._lock:
+            summary, summarized_count = self._summary, self._summarized_count
+        if summary is None:
+            return messages
+        return [
+            SystemMessage(content=get_conversation_summary_addendum(summary))
+        ] + messages[summarized_count:]
+
+    def add_message(self, message: BaseMessage) -> None:
+        """Appends a message to the session.
+
+        :param message: The message to append.
+        :type message: BaseMessage
+        """
+        self.add_messages([message])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Appends messages to the session and refreshes the summary if the thresholds are exceeded.
+
+        :param messages: The messages to append.
+        :type messages: Sequence[BaseMessage]
+        """
+        self._history.add_messages(messages)
+        self._schedule_refresh_if_needed(self._history.messages)
+
+    def clear(self) -> None:
+        """Deletes all the messages of the session and the summary."""
+        self._history.clear()
+        with self._lock:
+            self._summary = None
+            self._summarized_count = 0
+        if self._summaries is not None:
+            self._summaries.clear(self.session_id)
+
+    def _needs_refresh(self, messages: list[BaseMessage]) -> bool:
+        with self._lock:
+            summarized_count = self._summarized_count
+        turns = len(_turn_starts(messages, summarized_count))
+        if turns <= self._settings.window_turns:
+            return False
+        return (
+            turns > self._settings.max_turns
+            or estimate_tokens(messages[summarized_count:]) > self._settings.max_tokens
+        )
+
+    def _schedule_refresh_if_needed(self, messages: list[BaseMessage]):
+        if not self._needs_refresh(messages):
+            return
+        with self._lock:
+            if self._is_refresh_scheduled:
+                return
+            self._is_refresh_scheduled = True
+
+        if self._executor is None:
+            self._refresh_summary()
+            return
+        try:
+            self._executor.submit(self._refresh_summary)
+        except BackgroundQueueFullError:
+            # Keep sending the whole history, the next turn will try again
+            with self._lock:
+                self._is_refresh_scheduled = False
+
+    def _refresh_summary(self):
+        try:
+            messages = self._history.messages
+            with self._lock:
+                summary, summarized_count = self._summary, self._summarized_count
+            # Fold everything but the window, keeping whole turns
+            turn_starts = _turn_starts(messages, summarized_count)
+            if len(turn_starts) <= self._settings.window_turns:
+                return
+            fold_until = (
+                turn_starts[-self._settings.window_turns]
+                if self._settings.window_turns > 0
+                else len(messages)
+            )
+            if fold_until <= summarized_count:
+                return
+            new_summary = self._summarize(
+                summary, format_transcript(messages[summarized_count:fold_until])
+            )
+            with self._lock:
+                self._summary = new_summary
+                self._summarized_count = fold_until
+            if self._summaries is not None:
+                self._summaries.save_summary(self.session_id, new_summary, fold_until)
+        finally:
+            with self._lock:
+                self._is_refresh_scheduled = False
@@ -0,0 +1,204 @@
+"""
+Module containing the deduplication of the messages sent again by the clients.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from threading import Lock
+from typing import Optional, Tuple
+
+
+class TurnDeduplicator:
+    """
+    Deduplicates the turns of the conversations, so that a message sent again (e.g. retried by a
+    client on a flaky network) is answered once.
+
+    A turn is identified by the id given by the client. The first request of a turn runs it; a
+    duplicate arriving while it runs waits for its response, and a duplicate arriving after it was
+    recorded gets the same response, as long as the turn completed less than ``ttl`` seconds ago.
+    A turn that was not recorded (e.g. an error, a reply of the degraded mode, or a stream
+    interrupted by the client) is forgotten, and its duplicates run it again, as they do when the
+    turn is still running after ``max_turn_time`` seconds.
+
+    The turns without a client id can be identified by the hash of their message and by their
+    position in the conversation (``content_ttl``): since students often send the same short
+    message (e.g. "Yes") twice on purpose, only the copies sent before the first one is answered
+    are duplicates.
+
+    Args:
+        ttl (float, optional): Time (in seconds) the responses of the turns with a client id are kept. Defaults to 600. 0 disables their deduplication.
+        content_ttl (float, optional): Time (in seconds) the responses of the turns without a client id are kept. Defaults to 0 (no deduplication).
+        max_turns (int, optional): Maximum number of responses kept per conversation. Defaults to 32.
+        max_turn_time (float, optional): Time (in seconds) after which a running turn is considered abandoned. Defaults to 300.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 600,
+        content_ttl: float = 0,
+        max_turns: int = 32,
+        max_turn_time: float = 300,
+    ):
+        self.ttl = ttl
+        self.content_ttl = content_ttl
+        self.max_turns = max_turns
+        self.max_turn_time = max_turn_time
+
+        self._lock = Lock()
+        # Turns of each conversation, from the oldest: key -> (future, expiration time, running)
+        self._turns = dict()
+        self._duplicates = 0
+
+    def key(
+        self,
+        message: Optional[str],
+        message_id: Optional[str] = None,
+        position: Optional[int] = None,
+    ) -> Optional[str]:
+        """
+        Get the key identifying a turn.
+
+        Args:
+            message (Optional[str]): message sent by the user
+            message_id (Optional[str], optional): id of the message given by the client. Defaults to None.
+            position (Optional[int], optional): number of messages of the conversation when the message arrived. Defaults to None.
+
+        Returns:
+            Optional[str]: the key of the turn, or None if turns of its kind are not deduplicated
+        """
+        if message_id is not None:
+            return f"id:{message_id}" if self.ttl > 0 else None
+        if self.content_ttl <= 0 or position is None:
+            return None
+        digest = hashlib.sha256((message or "").encode("utf-8")).hexdigest()
+        return f"sha256:{position}:{digest}"
+
+    def begin(self, cid: str, key: str) -> Tuple[Future, bool]:
+        """
+        Register a turn of a conversation, unless it is a duplicate of a running or recent one.
+
+        Args:
+            cid (str): id of the conversation
+            key (str): key of the turn
+
+        Returns:
+            Tuple[Future, bool]: the future of the response of the turn, and True if the caller must run
+            the turn and then call complete or abort, False if the turn is a duplicate
+        """
+        now = time.monotonic()
+        with self._lock:
+            turns = self._turns.setdefault(cid, OrderedDict())
+            for turn_key, (future, expires_at, running) in list(turns.items()):
+                if expires_at <= now:
+                    del turns[turn_key]
+                    if running:
+                        # Abandoned: its waiting duplicates run it again
+                        future.set_result(None)
+            turn = turns.get(key)
+            if turn is not None:
+                self._duplicates += 1
+                return turn[0], False
+            future = Future()
+            turns[key] = (future, now + self.max_turn_time, True)
+            return future, True
+
+    def wait(self, future: Future):
+        """
+        Wait for the response of a running turn, returned by begin to one of its duplicates.
+
+        Args:
+            future (Future): the future returned by begin
+
+        Returns:
+            the response of the turn, or None if the turn did not complete
+        """
+        try:
+            return future.result(timeout=self.max_turn_time)
+        except FutureTimeoutError:
+            return None
+
+    def complete(self, cid: str, key: str, future: Future, response) -> None:
+        """
+        Record the response of a turn registered by begin, which is served to its duplicates.
+
+        Args:
+            cid (str): id of the conversation
+            key (str): key of the turn
+            future (Future): the future returned by begin
+            response: the response of the turn
+
+        Returns:
+            None
+        """
+        ttl = self.ttl if key.startswith("id:") else self.content_ttl
+        with self._lock:
+            turns = self._turns.get(cid)
+            if turns is None or key not in turns or turns[key][0] is not future:
+                # Abandoned: its duplicates got None
+                return
+            turns[key] = (future, time.monotonic() + ttl, False)
+            turns.move_to_end(key)
+            while len(turns) > self.max_turns:
+                _, (oldest, _, running) = turns.popitem(last=False)
+                if running:
+                    oldest.set_result(None)
+        future.set_result(response)
+
+    def abort(self, cid: str, key: str, future: Future) -> None:
+        """
+        Forget a turn registered by begin that did not complete. Its waiting duplicates get None.
+
+        Args:
+            cid (str): id of the conversation
+            key (str): key of the turn
+            future (Future): the future returned by begin
+
+        Returns:
+            None
+        """
+        with self._lock:
+            turns = self._turns.get(cid)
+            if turns is None or key not in turns or turns[key][0] is not future:
+                # Abandoned: its duplicates got None
+                return
+            del turns[key]
+        future.set_result(None)
+
+    def forget(self, cid: str) -> None:
+        """
+        Forget the turns of a conversation, e.g. when it ends.
+
+        Args:
+            cid (str): id of the conversation
+
+        Returns:
+            None
+        """
+        with self._lock:
+            turns = self._turns.pop(cid, None)
+        for future, _, running in (turns or dict()).values():
+            if running:
+                future.set_result(None)
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the deduplication.
+
+        Returns:
+            dict: Dictionary with the turns running and kept, and the duplicates received.
+        """
+        with self._lock:
+            running = sum(
+                1
+                for turns in self._turns.values()
+                for _, _, running in turns.values()
+                if running
+            )
+            kept = sum(len(turns) for turns in self._turns.values())
+            return {
+                "running_turns": running,
+                "kept_turns": kept - running,
+                "duplicates": self._duplicates,
+            }
@@ -0,0 +1,338 @@
+"""
+Module containing the durable queue of the background jobs of the chatbots and its workers.
+"""
+
+import os
+import socket
+from datetime import datetime, timedelta
+from threading import Condition, Event, Lock, Thread
+from typing import Callable, Dict, Optional
+
+from ..database import Job
+from ..log import Log, LogType, Logger
+
+# Kinds of the jobs
+POST_MESSAGE_ACTIONS_JOB = "post_message_actions"
+OVERALL_FEEDBACK_JOB = "overall_feedback"
+RUNNING_FEEDBACK_JOB = "running_feedback"
+PREPARE_CONVERSATION_JOB = "prepare_conversation"
+
+
+class JobDeferredError(Exception):
+    """
+    Raised by a job handler that cannot run the job yet (e.g. while the model provider is
+    unavailable): the job is run again after ``delay`` seconds, and the attempt is not counted.
+    """
+
+    def __init__(self, delay: float):
+        super().__init__(f"The job is deferred by {delay} seconds.")
+        self.delay = delay
+
+
+class JobQueue:
+    """
+    Durable queue of jobs, stored in the "jobs" collection so that they survive a restart of the
+    server. The jobs are deduplicated by key: enqueuing a job whose key is already in the queue (or
+    was completed less than ``retention`` seconds ago) does nothing.
+
+    A worker leases a job for ``lease_time`` seconds; if the worker stops before completing it, the
+    job is leased again by another worker once the lease expires, unless that was its last attempt. A failed job is retried after
+    ``retry_delay`` seconds, doubled at each attempt up to ``max_retry_delay``, and is marked as
+    failed for good after ``max_attempts`` attempts. A job whose handler raises a JobDeferredError
+    is run again after the given delay, without counting the attempt.
+
+    Args:
+        collection (JobsCollection): The "jobs" collection.
+        lease_time (int, optional): Duration (in seconds) of the leases. Defaults to 300.
+        max_attempts (int, optional): Maximum number of attempts of a job. Defaults to 5.
+        retry_delay (float, optional): Delay (in seconds) before the first retry. Defaults to 5.
+        max_retry_delay (float, optional): Maximum delay (in seconds) between two attempts. Defaults to 300.
+        retention (int, optional): Time (in seconds) the completed jobs are kept to deduplicate them. Defaults to 7 days.
+    """
+
+    def __init__(
+        self,
+        collection,
+        lease_time: int = 300,
+        max_attempts: int = 5,
+        retry_delay: float = 5,
+        max_retry_delay: float = 300,
+        retention: int = 7 * 24 * 60 * 60,
+    ):
+        if max_attempts < 1:
+            raise ValueError("A job needs at least one attempt.")
+        self._collection = collection
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retention = retention
+        self._collection.ensure_indexes()
+
+        # Wakes up the local workers when a job is enqueued, instead of waiting for their next poll
+        self._new_jobs = Condition()
+        self._stats_lock = Lock()
+        self._enqueued = 0
+        self._duplicates = 0
+
+    def enqueue(
+        self, kind: str, conversation_id: str, payload: dict, key: str = None
+    ) -> bool:
+        """
+        Enqueue a job.
+
+        Args:
+            kind (str): kind of the job, which selects its handler
+            conversation_id (str): id of the conversation the job refers to
+            payload (dict): arguments of the handler
+            key (str, optional): deduplication key of the job within the conversation and kind. Defaults to None (one job per conversation and kind).
+
+        Returns:
+            bool: True if the job was enqueued, False if it is a duplicate
+        """
+        job_id = f"{kind}:{conversation_id}" + (f":{key}" if key is not None else "")
+        inserted = self._collection.enqueue(job_id, kind, conversation_id, payload)
+        with self._stats_lock:
+            if inserted:
+                self._enqueued += 1
+            else:
+                self._duplicates += 1
+        if inserted:
+            with self._new_jobs:
+                self._new_jobs.notify()
+        return inserted
+
+    def lease(self, worker_id: str) -> Optional[Job]:
+        """
+        Lease the next job that can run.
+
+        Args:
+            worker_id (str): id of the worker
+
+        Returns:
+            Optional[Job]: the leased job, or None if no job can run
+        """
+        return self._collection.lease(worker_id, self.lease_time, self.max_attempts)
+
+    def complete(self, job: Job, worker_id: str) -> bool:
+        """
+        Mark a leased job as done.
+
+        Returns:
+            bool: True if the job was marked as done, False if the worker lost its lease
+        """
+        return self._collection.complete(job._id, worker_id, self.retention)
+
+    def fail(self, job: Job, worker_id: str, error: str) -> bool:
+        """
+        Record a failed attempt of a leased job, which is retried with backoff unless it has no attempts left.
+
+        Returns:
+            bool: True if the job will be retried, False if it failed for good or the worker lost its lease
+        """
+        if job.attempts >= self.max_attempts:
+            self._collection.fail(job._id, worker_id, error)
+            return False
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (job.attempts - 1))
+        return self._collection.retry(
+            job._id, worker_id, error, datetime.utcnow() + timedelta(seconds=delay)
+        )
+
+    def defer(self, job: Job, worker_id: str, delay: float) -> bool:
+        """
+        Put a leased job back in the queue without counting its attempt, to be run after the delay.
+
+        Returns:
+            bool: True if the job was put back in the queue, False if the worker lost its lease
+        """
+        return self._collection.defer(
+            job._id, worker_id, datetime.utcnow() + timedelta(seconds=delay)
+        )
+
+    def wait_for_jobs(self, timeout: float) -> None:
+        """Waits until a job is enqueued by this process, or the timeout expires."""
+        with self._new_jobs:
+            self._new_jobs.wait(timeout)
+
+    def count_by_status(self) -> dict:
+        """
+        Count the jobs in the queue, by status. Unlike stats, it queries the database.
+
+        Returns:
+            dict: Dictionary with the number of jobs per status.
+        """
+        return self._collection.count_by_status()
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the jobs enqueued by this process.
+
+        Returns:
+            dict: Dictionary with the number of jobs enqueued and of duplicates discarded.
+        """
+        with self._stats_lock:
+            return {"enqueued": self._enqueued, "duplicates": self._duplicates}
+
+
+class JobWorker:
+    """
+    Pool of threads running the jobs of a JobQueue, in the web server process or in a separate
+    worker process. Several workers, in any number of processes, can share the same queue.
+
+    Args:
+        queue (JobQueue): The queue of the jobs.
+        handlers (Dict[str, Callable[[Job], None]]): Function running the jobs of each kind.
+        workers (int, optional): Number of threads. Defaults to 2.
+        poll_interval (float, optional): Maximum time (in seconds) between two polls of the queue. Defaults to 1.
+        logger (Logger, optional): Logger for the failures of the jobs. Defaults to None (print to the console).
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handlers: Dict[str, Callable[[Job], None]],
+        workers: int = 2,
+        poll_interval: float = 1,
+        logger: Logger = None,
+    ):
+        if workers < 1:
+            raise ValueError("The job worker needs at least one thread.")
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self._id = f"{socket.gethostname()}-{os.getpid()}"
+
+        self._threads = []
+        self._threads_lock = Lock()
+        self._stopped = Event()
+
+        self._stats_lock = Lock()
+        self._running = 0
+        self._completed = 0
+        self._retried = 0
+        self._failed = 0
+        self._deferred = 0
+        self._lost_leases = 0
+
+    def start(self) -> None:
+        """
+        Start the threads of the worker. Does nothing if they are already running.
+
+        Returns:
+            None
+        """
+        with self._threads_lock:
+            while len(self._threads) < self.workers:
+                thread = Thread(
+                    target=self._work,
+                    args=(f"{self._id}-{len(self._threads)}",),
+                    name=f"job-worker-{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def run_forever(self) -> None:
+        """
+        Start the threads of the worker and wait for them, e.g. in a dedicated worker process.
+
+        Returns:
+            None
+        """
+        self.start()
+        for thread in list(self._threads):
+            thread.join()
+
+    def stop(self) -> None:
+        """
+        Let the threads exit after their current job.
+
+        Returns:
+            None
+        """
+        self._stopped.set()
+
+    def _work(self, worker_id: str):
+        while not self._stopped.is_set():
+            try:
+                job = self.queue.lease(worker_id)
+            except Exception as exc:
+                self._log(f"Job worker {worker_id} could not lease a job: {exc!r}")
+                job = None
+            if job is None:
+                self.queue.wait_for_jobs(self.poll_interval)
+                continue
+            self._run(job, worker_id)
+
+    def _run(self, job: Job, worker_id: str):
+        with self._stats_lock:
+            self._running += 1
+        try:
+            handler = self.handlers.get(job.kind)
+            if handler is None:
+                raise ValueError(f"No handler for the jobs of kind {job.kind}.")
+            handler(job)
+        except JobDeferredError as exc:
+            try:
+                self.queue.defer(job, worker_id, exc.delay)
+            except Exception as defer_exc:
+                self._log(f"Job {job._id} could not be deferred: {defer_exc!r}")
+            with self._stats_lock:
+                self._deferred += 1
+        except Exception as exc:
+            self._log(
+                f"Job {job._id} failed (attempt {job.attempts} of {self.queue.max_attempts}): {exc!r}"
+            )
+            try:
+                retried = self.queue.fail(job, worker_id, repr(exc))
+            except Exception as fail_exc:
+                self._log(f"Job {job._id} could not be marked as failed: {fail_exc!r}")
+                retried = True
+            with self._stats_lock:
+                if retried:
+                    self._retried += 1
+                else:
+                    self._failed += 1
+        else:
+            try:
+                completed = self.queue.complete(job, worker_id)
+            except Exception as exc:
+                self._log(f"Job {job._id} could not be marked as done: {exc!r}")
+                completed = False
+            with self._stats_lock:
+                if completed:
+                    self._completed += 1
+                else:
+                    # The lease expired: another worker may run the job again
+                    self._lost_leases += 1
+        finally:
+            with self._stats_lock:
+                self._running -= 1
+
+    def _log(self, message: str):
+        if self.logger is not None:
+            self.logger.log(Log(LogType.ERROR, message))
+        else:
+            print(f"[JOB-WORKER] {message}")
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the worker and of the jobs enqueued by this process.
+
+        Returns:
+            dict: Dictionary with the number of threads, the running jobs, the jobs completed, retried, failed
+            for good and deferred, the leases lost, and the jobs enqueued and discarded as duplicates.
+        """
+        with self._stats_lock:
+            return {
+                "threads": len(self._threads),
+                "running": self._running,
+                "completed": self._completed,
+                "retried": self._retried,
+                "failed": self._failed,
+                "deferred": self._deferred,
+                "lost_leases": self._lost_leases,
+                **self.queue.stats(),
+            }
@@ -0,0 +1,108 @@
+"""
+Memoized chat prompt templates of the chatbots.
+
+Building a ChatPromptTemplate parses its messages, so the templates are built once per
+conversation profile (or per system prompt) and shared by all the chatbots.
+"""
+
+from functools import lru_cache
+from typing import Optional
+
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+from .PROMPTS import get_prompt
+
+
+def render_conversation_system_prompt(
+    user_level: str,
+    conversation_difficulty: str,
+    conversation_topic: str,
+    addendum: Optional[str] = None,
+) -> str:
+    """Renders the system prompt of a conversation for its profile.
+
+    :param user_level: level of the user.
+    :type user_level: str
+    :param conversation_difficulty: difficulty of the conversation.
+    :type conversation_difficulty: str
+    :param conversation_topic: topic of the conversation.
+    :type conversation_topic: str
+    :param addendum: text appended to the system prompt (e.g. the roles reversed addendum), defaults to None.
+    :type addendum: Optional[str], optional
+    :return: the rendered system prompt.
+    :rtype: str
+    """
+    system_prompt = get_prompt(
+        prompt_name="CONVERSATIONAL_SYSTEM_PROMPT",
+        user_level=user_level,
+        conversation_difficulty=conversation_difficulty,
+        conversation_topic=conversation_topic,
+    )
+    if addendum is not None:
+        system_prompt += f"\n{addendum}"
+    return system_prompt
+
+
+@lru_cache(maxsize=1024)
+def get_conversation_prompt_template(
+    user_level: str,
+    conversation_difficulty: str,
+    conversation_topic: str,
+    addendum: Optional[str] = None,
+) -> ChatPromptTemplate:
+    """Returns the chat prompt template of a conversation: the system prompt rendered for the
+    conversation profile, followed by the chat history and the user answer.
+
+    :param user_level: level of the user.
+    :type user_level: str
+    :param conversation_difficulty: difficulty of the conversation.
+    :type conversation_difficulty: str
+    :param conversation_topic: topic of the conversation.
+    :type conversation_topic: str
+    :param addendum: text appended to the system prompt (e.g. the roles reversed addendum), defaults to None.
+    :type addendum: Optional[str], optional
+    :return: the chat prompt template, with the "history" and "answer" variables.
+    :rtype: ChatPromptTemplate
+    """
+    return get_system_prompt_conversation_template(
+        render_conversation_system_prompt(
+            user_level, conversation_difficulty, conversation_topic, addendum
+        )
+    )
+
+
+@lru_cache(maxsize=1024)
+def get_system_prompt_conversation_template(system_prompt: str) -> ChatPromptTemplate:
+    """Returns the chat prompt template of a conversation whose system prompt is already rendered
+    (e.g. pre-generated when the conversation was created).
+
+    :param system_prompt: the rendered system prompt of the conversation.
+    :type system_prompt: str
+    :return: the chat prompt template, with the "history" and "answer" variables.
+    :rtype: ChatPromptTemplate
+    """
+    # The system prompt is passed as a message, not as a template, so that braces in the topic
+    # or in the addendum are not mistaken for template variables.
+    return ChatPromptTemplate.from_messages(
+        [
+            SystemMessage(content=system_prompt),
+            MessagesPlaceholder(variable_name="history"),
+            ("human", "{answer}"),
+        ]
+    )
+
+
+@lru_cache(maxsize=64)
+def get_post_message_prompt_template(system_prompt: str) -> ChatPromptTemplate:
+    """Returns the chat prompt template of a post-message action: the system prompt followed by
+    the user message.
+
+    :param system_prompt: the rendered system prompt of the action.
+    :type system_prompt: str
+    :return: the chat prompt template, with the "user_message" variable.
+    :rtype: ChatPromptTemplate
+    """
+    return ChatPromptTemplate.from_messages(
+        [SystemMessage(content=system_prompt), ("user", "{user_message}")]
+    )
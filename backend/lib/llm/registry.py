@@ -0,0 +1,143 @@
+"""
+Module containing the registry of the chatbots managed by the chatbot manager.
+"""
+
+from itertools import count
+from threading import Lock
+from typing import Hashable
+from zlib import crc32
+
+
+class _Entry:
+    __slots__ = ("chatbot", "last_used")
+
+    def __init__(self, chatbot, last_used: int):
+        self.chatbot = chatbot
+        self.last_used = last_used
+
+
+class ChatbotRegistry:
+    """
+    Striped registry of the chatbots, keyed by conversation id.
+
+    The chatbots are spread over ``shards`` dictionaries, each with its own lock, so that adding and
+    removing chatbots of different conversations do not contend. Lookups take no lock at all: a
+    single dictionary read is atomic, and the recency of the entry is updated with a plain
+    attribute write. The least recently used order is only computed when chatbots must be evicted.
+
+    Args:
+        shards (int, optional): Number of shards of the registry. Defaults to 16.
+    """
+
+    def __init__(self, shards: int = 16):
+        if shards < 1:
+            raise ValueError("The registry must have at least one shard")
+        self._shards = [dict() for _ in range(shards)]
+        self._locks = [Lock() for _ in range(shards)]
+        self._clock = count()
+
+    @property
+    def shards(self) -> int:
+        """Returns the number of shards of the registry."""
+        return len(self._shards)
+
+    def _shard_index(self, cid: Hashable) -> int:
+        # crc32 is stable across processes, unlike the salted hash of strings
+        if isinstance(cid, str):
+            return crc32(cid.encode("utf-8")) % len(self._shards)
+        return hash(cid) % len(self._shards)
+
+    def get(self, cid: Hashable, default=None):
+        """
+        Get the chatbot of a conversation and mark it as the most recently used one, without locking.
+
+        Args:
+            cid (Hashable): id of the conversation
+            default (optional): Value returned if the conversation has no chatbot. Defaults to None.
+
+        Returns:
+            The chatbot of the conversation, or default.
+        """
+        entry = self._shards[self._shard_index(cid)].get(cid)
+        if entry is None:
+            return default
+        entry.last_used = next(self._clock)
+        return entry.chatbot
+
+    def put(self, cid: Hashable, chatbot) -> None:
+        """
+        Add or replace the chatbot of a conversation, as the most recently used one.
+
+        Args:
+            cid (Hashable): id of the conversation
+            chatbot: the chatbot of the conversation
+
+        Returns:
+            None
+        """
+        index = self._shard_index(cid)
+        with self._locks[index]:
+            self._shards[index][cid] = _Entry(chatbot, next(self._clock))
+
+    def pop(self, cid: Hashable, chatbot=None):
+        """
+        Remove the chatbot of a conversation.
+
+        Args:
+            cid (Hashable): id of the conversation
+            chatbot (optional): If given, the chatbot is only removed if it is still the one registered for the conversation. Defaults to None.
+
+        Returns:
+            The removed chatbot, or None if nothing was removed.
+        """
+        index = self._shard_index(cid)
+        with self._locks[index]:
+            shard = self._shards[index]
+            entry = shard.get(cid)
+            if entry is None or (chatbot is not None and entry.chatbot is not chatbot):
+                return None
+            del shard[cid]
+            return entry.chatbot
+
+    def items(self) -> list:
+        """
+        Returns a snapshot of the (conversation id, chatbot) pairs of the registry.
+
+        Returns:
+            list: The pairs, in no particular order.
+        """
+        return [
+            (cid, entry.chatbot)
+            for shard in self._shards
+            for cid, entry in shard.copy().items()
+        ]
+
+    def values(self) -> list:
+        """
+        Returns a snapshot of the chatbots of the registry.
+
+        Returns:
+            list: The chatbots, in no particular order.
+        """
+        return [chatbot for _, chatbot in self.items()]
+
+    def least_recently_used(self) -> list:
+        """
+        Returns a snapshot of the (conversation id, chatbot) pairs, from the least to the most recently used.
+
+        Returns:
+            list: The sorted pairs.
+        """
+        entries = [
+            (entry.last_used, cid, entry.chatbot)
+            for shard in self._shards
+            for cid, entry in shard.copy().items()
+        ]
+        entries.sort(key=lambda entry: entry[0])
+        return [(cid, chatbot) for _, cid, chatbot in entries]
+
+    def __contains__(self, cid: Hashable) -> bool:
+        return cid in self._shards[self._shard_index(cid)]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
@@ -0,0 +1,295 @@
+"""
+Module containing the scheduler of the requests to the chat model.
+"""
+
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from threading import Condition, Event
+from typing import Iterator, Optional
+
+from .PROMPTS import CONVERSATION_PROMPT_TYPE
+from .hedging import LLMAttemptCancelledError, LLMTimeoutError
+from ..metrics import Histogram
+
+# Priority classes of the requests, from the most to the least urgent
+INTERACTIVE = 0
+ANALYSIS = 1
+FINAL_FEEDBACK = 2
+PRIORITY_NAMES = ("interactive", "analysis", "final_feedback")
+
+# Interval (in seconds) at which a cancellable request waiting for the scheduler checks whether it was cancelled
+CANCEL_POLL_INTERVAL = 0.05
+
+# Priority of the prompt types that are not analyses of a single message
+PROMPT_PRIORITIES = {
+    CONVERSATION_PROMPT_TYPE: INTERACTIVE,
+    "FINAL_FEEDBACK_SYSTEM_PROMPT": FINAL_FEEDBACK,
+    "USER_OPINION_SYNTHESIS": FINAL_FEEDBACK,
+    "CONVERSATION_SUMMARY_SYSTEM_PROMPT": FINAL_FEEDBACK,
+    # Generated ahead of time, usually hours before the conversation starts
+    "CONVERSATION_OPENING_INSTRUCTION": FINAL_FEEDBACK,
+}
+
+LLM_SCHEDULER_WAIT = Histogram(
+    "teachme_llm_scheduler_wait_seconds",
+    "Time spent by the requests to the chat model waiting for the scheduler, by priority class.",
+    ("priority",),
+)
+
+
+def get_priority(prompt_type: str) -> int:
+    """
+    Get the priority class of a request to the chat model.
+
+    Args:
+        prompt_type (str): name of the system prompt of the request
+
+    Returns:
+        int: INTERACTIVE for the turns of the conversations, FINAL_FEEDBACK for the end of conversation
+        feedback and summaries, ANALYSIS for the post-message analyses
+    """
+    return PROMPT_PRIORITIES.get(prompt_type, ANALYSIS)
+
+
+class LLMGrant:
+    """
+    Permission to send a request to the chat model, returned by LLMScheduler.slot.
+
+    Attributes:
+        priority (int): Priority class of the request.
+        estimated_tokens (int): Tokens reserved for the request.
+        wait_time (float): Time (in seconds) the request waited for the permission.
+    """
+
+    def __init__(self, priority: int, estimated_tokens: int, wait_time: float):
+        self.priority = priority
+        self.estimated_tokens = estimated_tokens
+        self.wait_time = wait_time
+        self.used_tokens = None
+
+    def settle(self, used_tokens: int) -> None:
+        """Record the tokens actually used by the request, which replace the estimate in the budget."""
+        self.used_tokens = used_tokens
+
+
+class LLMScheduler:
+    """
+    Priority scheduler of the requests to the chat model, shared by all the chatbots.
+
+    The requests wait in a single queue ordered by priority class (interactive turns, then
+    post-message analyses, then end of conversation feedback) and by arrival. A request starts when
+    it is the first of the queue and both budgets allow it:
+
+    * at most ``max_concurrency`` requests run at the same time, and the requests of the background
+      classes never take the last ``interactive_slots`` of them;
+    * the estimated tokens of the requests are taken from a bucket refilled at ``tokens_per_minute``,
+      and the background classes never take the last ``interactive_token_share`` of the bucket.
+
+    The reserves keep the background work from starving the students waiting for a reply: an
+    interactive turn waits at most for the interactive turns ahead of it.
+
+    Args:
+        max_concurrency (int, optional): Maximum number of concurrent requests. Defaults to None (no limit).
+        tokens_per_minute (int, optional): Tokens per minute of the model provider quota. Defaults to None (no limit).
+        interactive_slots (int, optional): Concurrent requests reserved to the interactive turns. Defaults to 1.
+        interactive_token_share (float, optional): Fraction of the token bucket reserved to the interactive turns. Defaults to 0.2.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = None,
+        tokens_per_minute: int = None,
+        interactive_slots: int = 1,
+        interactive_token_share: float = 0.2,
+    ):
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("The maximum concurrency must be at least 1.")
+        if tokens_per_minute is not None and tokens_per_minute <= 0:
+            raise ValueError("The tokens per minute must be positive.")
+        if not 0 <= interactive_token_share < 1:
+            raise ValueError("The interactive token share must be in [0, 1).")
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.interactive_slots = (
+            min(interactive_slots, max_concurrency - 1) if max_concurrency else 0
+        )
+        self.interactive_token_share = interactive_token_share
+
+        self._condition = Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._tokens = float(tokens_per_minute or 0)
+        self._refilled_at = time.monotonic()
+        self._granted = [0] * len(PRIORITY_NAMES)
+        self._total_wait = [0.0] * len(PRIORITY_NAMES)
+        self._max_wait = [0.0] * len(PRIORITY_NAMES)
+        self._expired = [0] * len(PRIORITY_NAMES)
+        self._tokens_used = 0
+
+    @contextmanager
+    def slot(
+        self,
+        priority: int,
+        estimated_tokens: int = 0,
+        timeout: Optional[float] = None,
+        cancelled: Optional[Event] = None,
+    ) -> Iterator[LLMGrant]:
+        """
+        Waits until the request can be sent, then runs the body of the with statement as a running request.
+
+        Args:
+            priority (int): priority class of the request (INTERACTIVE, ANALYSIS or FINAL_FEEDBACK)
+            estimated_tokens (int, optional): tokens the request is expected to use. Defaults to 0.
+            timeout (Optional[float], optional): maximum time (in seconds) to wait, usually the deadline of the request. Defaults to None (no limit).
+            cancelled (Optional[Event], optional): set when the request is no longer needed, e.g. a hedge that lost. Defaults to None.
+
+        Raises:
+            LLMTimeoutError: If the request could not start before the timeout.
+            LLMAttemptCancelledError: If the request was cancelled before it started.
+
+        Returns:
+            Iterator[LLMGrant]: the permission to send the request, on which the used tokens are settled
+        """
+        if self.tokens_per_minute is not None:
+            # A request larger than the whole bucket would never start
+            estimated_tokens = min(estimated_tokens, self.tokens_per_minute)
+        queued_at = time.monotonic()
+        expires_at = queued_at + timeout if timeout is not None else None
+        with self._condition:
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    if self._waiting[0] == entry:
+                        delay = self._admission_delay(priority, estimated_tokens)
+                        if delay == 0:
+                            break
+                    else:
+                        delay = None
+                    if cancelled is not None:
+                        if cancelled.is_set():
+                            raise LLMAttemptCancelledError()
+                        delay = (
+                            CANCEL_POLL_INTERVAL
+                            if delay is None
+                            else min(delay, CANCEL_POLL_INTERVAL)
+                        )
+                    if expires_at is not None:
+                        remaining = expires_at - time.monotonic()
+                        if remaining <= 0:
+                            self._expired[priority] += 1
+                            raise LLMTimeoutError(
+                                f"The request could not start in {timeout} seconds."
+                            )
+                        delay = remaining if delay is None else min(delay, remaining)
+                    self._condition.wait(delay)
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._running += 1
+            self._tokens -= estimated_tokens
+            wait_time = time.monotonic() - queued_at
+            self._granted[priority] += 1
+            self._total_wait[priority] += wait_time
+            self._max_wait[priority] = max(self._max_wait[priority], wait_time)
+            # The next request in the queue may be admitted too
+            self._condition.notify_all()
+        LLM_SCHEDULER_WAIT.labels(PRIORITY_NAMES[priority]).observe(wait_time)
+
+        grant = LLMGrant(priority, estimated_tokens, wait_time)
+        try:
+            yield grant
+        finally:
+            with self._condition:
+                self._running -= 1
+                if grant.used_tokens is not None:
+                    self._tokens -= grant.used_tokens - estimated_tokens
+                    self._tokens_used += grant.used_tokens
+                else:
+                    self._tokens_used += estimated_tokens
+                self._condition.notify_all()
+
+    def _admission_delay(self, priority: int, estimated_tokens: int) -> Optional[float]:
+        """
+        Returns 0 if the first request of the queue can start now, otherwise the time to wait before
+        checking again (None to wait for a running request to complete). Called holding the condition.
+        """
+        if self.max_concurrency is not None:
+            limit = self.max_concurrency
+            if priority != INTERACTIVE:
+                limit -= self.interactive_slots
+            if self._running >= limit:
+                return None
+        if self.tokens_per_minute is None:
+            return 0
+
+        self._refill()
+        reserve = (
+            0
+            if priority == INTERACTIVE
+            else self.interactive_token_share * self.tokens_per_minute
+        )
+        missing = estimated_tokens + reserve - self._tokens
+        if missing <= 0:
+            return 0
+        return missing * 60 / self.tokens_per_minute
+
+    def _refill(self) -> None:
+        # Called holding the condition
+        now = time.monotonic()
+        self._tokens = min(
+            self.tokens_per_minute,
+            self._tokens + (now - self._refilled_at) * self.tokens_per_minute / 60,
+        )
+        self._refilled_at = now
+
+    @property
+    def running(self) -> int:
+        """Returns the number of running requests."""
+        with self._condition:
+            return self._running
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the scheduler.
+
+        Returns:
+            dict: Dictionary with the limits, the running requests, the available tokens, the tokens used
+            and, for each priority class, the waiting and granted requests, their wait times and the requests
+            that could not start before their deadline.
+        """
+        with self._condition:
+            waiting = [0] * len(PRIORITY_NAMES)
+            for priority, _ in self._waiting:
+                waiting[priority] += 1
+            if self.tokens_per_minute is not None:
+                self._refill()
+            return {
+                "max_concurrency": self.max_concurrency,
+                "tokens_per_minute": self.tokens_per_minute,
+                "running": self._running,
+                "available_tokens": (
+                    round(self._tokens) if self.tokens_per_minute is not None else None
+                ),
+                "tokens_used": self._tokens_used,
+                "priorities": {
+                    name: {
+                        "waiting": waiting[i],
+                        "granted": self._granted[i],
+                        "avg_wait": (
+                            self._total_wait[i] / self._granted[i]
+                            if self._granted[i]
+                            else 0.0
+                        ),
+                        "max_wait": self._max_wait[i],
+                        "expired": self._expired[i],
+                    }
+                    for i, name in enumerate(PRIORITY_NAMES)
+                },
+            }
@@ -0,0 +1,67 @@
+"""
+Module containing the queue serializing the turns of a conversation.
+"""
+
+from contextlib import contextmanager
+from threading import Condition
+
+
+class TurnQueue:
+    """
+    First-in first-out queue of the turns of a conversation.
+
+    Turns run one at a time, in the order in which they entered the queue, so that the history of
+    the conversation is read and written by a single turn at a time. Each conversation has its own
+    queue, so the turns of different conversations still run in parallel.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._next_ticket = 0
+        self._now_serving = 0
+        self._completed = 0
+        self._max_length = 0
+
+    @contextmanager
+    def turn(self):
+        """
+        Waits for the previous turns to complete, then runs the body of the with statement as the current turn.
+        """
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._max_length = max(self._max_length, self._next_ticket - self._now_serving)
+            while ticket != self._now_serving:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._now_serving += 1
+                self._completed += 1
+                self._condition.notify_all()
+
+    @property
+    def length(self) -> int:
+        """Returns the number of turns in the queue, including the running one."""
+        with self._condition:
+            return self._next_ticket - self._now_serving
+
+    @property
+    def waiting(self) -> int:
+        """Returns the number of turns waiting for the running one to complete."""
+        return max(0, self.length - 1)
+
+    def stats(self) -> dict:
+        """
+        Returns the statistics of the queue.
+
+        Returns:
+            dict: Dictionary with the number of turns in the queue, the largest length reached and the number of completed turns.
+        """
+        with self._condition:
+            return {
+                "length": self._next_ticket - self._now_serving,
+                "max_length": self._max_length,
+                "completed": self._completed,
+            }
@@ -0,0 +1 @@
+from .metrics import Counter, Gauge, Histogram, MetricsRegistry, REGISTRY
@@ -0,0 +1,332 @@
+"""
+Module containing the metrics of the application and their registry, exposed in the Prometheus
+text format.
+
+Updating a metric takes a dictionary lookup and a short lock, so the metrics can stay enabled in
+production. The metrics are only formatted when they are scraped.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+from typing import Iterable, Optional
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape_label_value(str(value))}"' for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """
+    Registry of the metrics exposed by the application.
+    """
+
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = Lock()
+
+    def register(self, metric: "Metric") -> None:
+        """
+        Register a metric.
+
+        Args:
+            metric (Metric): the metric to register
+
+        Raises:
+            ValueError: If a metric with the same name is already registered.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional["Metric"]:
+        """
+        Get a registered metric by its name.
+
+        Args:
+            name (str): name of the metric
+
+        Returns:
+            Optional[Metric]: the metric, or None if it is not registered
+        """
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        Format all the registered metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: the formatted metrics
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(
+                    f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+# Registry of the application metrics
+REGISTRY = MetricsRegistry()
+
+
+class Metric:
+    """
+    Base class of the metrics. A metric with label names holds one value per combination of label
+    values, selected with ``labels``.
+
+    Args:
+        name (str): Name of the metric.
+        documentation (str): Description of the metric.
+        labelnames (Iterable[str], optional): Names of the labels of the metric. Defaults to no labels.
+        registry (MetricsRegistry, optional): Registry of the metric. Defaults to REGISTRY.
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        registry: MetricsRegistry = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        self._lock = Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *labelvalues, **labelkwargs) -> "_LabelledMetric":
+        """
+        Select the value of the metric for the given label values, by position or by name.
+
+        Raises:
+            ValueError: If the label values do not match the label names of the metric.
+
+        Returns:
+            _LabelledMetric: the metric restricted to the label values
+        """
+        if labelkwargs:
+            if labelvalues or set(labelkwargs) != set(self.labelnames):
+                raise ValueError(
+                    f"Metric {self.name} expects the labels {self.labelnames}."
+                )
+            labelvalues = tuple(labelkwargs[name] for name in self.labelnames)
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects the labels {self.labelnames}.")
+        return _LabelledMetric(self, tuple(str(value) for value in labelvalues))
+
+    def _check_unlabelled(self):
+        if self.labelnames:
+            raise ValueError(
+                f"Metric {self.name} has labels {self.labelnames}, select them with labels()."
+            )
+
+    def _new_value(self):
+        return 0.0
+
+    def _update(self, key: tuple, update) -> None:
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._new_value()
+            self._values[key] = update(value)
+
+    def samples(self) -> list:
+        """
+        Returns the samples of the metric, as (name suffix, labels, value) tuples.
+
+        Returns:
+            list: the samples of the metric
+        """
+        with self._lock:
+            values = dict(self._values)
+        return [
+            ("", dict(zip(self.labelnames, key)), value)
+            for key, value in sorted(values.items())
+        ]
+
+
+class _LabelledMetric:
+    """
+    A metric restricted to some label values.
+    """
+
+    __slots__ = ("_metric", "_key")
+
+    def __init__(self, metric: Metric, key: tuple):
+        self._metric = metric
+        self._key = key
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._metric._inc(self._key, amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._metric._inc(self._key, -amount)
+
+    def set(self, value: float) -> None:
+        self._metric._set(self._key, value)
+
+    def observe(self, value: float) -> None:
+        self._metric._observe(self._key, value)
+
+    def set_total(self, value: float) -> None:
+        self._metric._set_total(self._key, value)
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count (e.g. the number of requests).
+    """
+
+    type = "counter"
+
+    def inc(self, amount: float = 1.0) -> None:
+        """Increment the counter by amount (which must not be negative)."""
+        self._check_unlabelled()
+        self._inc((), amount)
+
+    def set_total(self, value: float) -> None:
+        """
+        Set the counter to a total counted elsewhere, e.g. in the statistics of a component, when the
+        metrics are scraped. The total is a count since the start of the process: it never decreases.
+        """
+        self._check_unlabelled()
+        self._set_total((), value)
+
+    def _inc(self, key: tuple, amount: float) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only be incremented.")
+        self._update(key, lambda value: value + amount)
+
+    def _set_total(self, key: tuple, value: float) -> None:
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down (e.g. the number of queued tasks).
+    """
+
+    type = "gauge"
+
+    def set(self, value: float) -> None:
+        """Set the gauge to value."""
+        self._check_unlabelled()
+        self._set((), value)
+
+    def inc(self, amount: float = 1.0) -> None:
+        """Increment the gauge by amount."""
+        self._check_unlabelled()
+        self._inc((), amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        """Decrement the gauge by amount."""
+        self._check_unlabelled()
+        self._inc((), -amount)
+
+    def _set(self, key: tuple, value: float) -> None:
+        with self._lock:
+            self._values[key] = float(value)
+
+    def _inc(self, key: tuple, amount: float) -> None:
+        self._update(key, lambda value: value + amount)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (e.g. latencies), counted in cumulative buckets.
+
+    Args:
+        buckets (Iterable[float], optional): Upper bounds of the buckets. Defaults to DEFAULT_BUCKETS, suited to latencies in seconds.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+        registry: MetricsRegistry = REGISTRY,
+    ):
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float) -> None:
+        """Record an observed value."""
+        self._check_unlabelled()
+        self._observe((), value)
+
+    def _new_value(self):
+        # Counts per bucket (the last one is +Inf), then the sum of the values
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def _observe(self, key: tuple, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._new_value()
+                self._values[key] = counts
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> list:
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        samples = []
+        for key, counts in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts[:-1]):
+                cumulative += count
+                samples.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            samples.append(("_sum", labels, counts[-1]))
+            samples.append(("_count", labels, cumulative))
+        return samples
@@ -2,3 +2,4 @@ from .authRoutes import register_auth_routes
 from .logRoutes import register_log_routes
 from .userRoutes import register_user_routes
 from .conversationRoutes import register_conversation_routes
+from .metricsRoutes import register_metrics_routes
@@ -1,11 +1,33 @@
+from dataclasses import asdict
 from datetime import datetime
+import json
 import os
 
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, request, jsonify, make_response, stream_with_context
 
 from lib.log import LogType, Logger, Log
 from lib.database import MongoDB
-from lib.llm import ConversationalChatBot, ChatbotManager
+from lib.llm import (
+    CHATBOT_ERROR_MESSAGE,
+    CHATBOT_TIMEOUT_MESSAGE,
+    ChatbotManager,
+    ConversationalChatBot,
+    LLMTimeoutError,
+)
+
+
+def format_server_sent_event(event: str, data: dict) -> str:
+    """
+    Formats an event according to the Server-Sent Events protocol.
+
+    Args:
+        event (str): name of the event
+        data (dict): JSON-serializable payload of the event
+
+    Returns:
+        str: the formatted event, terminated by a blank line
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 def register_conversation_routes(
@@ -23,7 +45,8 @@ def register_conversation_routes(
         * topic (optional, string): Topic of the conversation. Defaults to None.
         * teacher_email (required, string): Email address of the teacher who created the conversation.
         * student_email (required, string): Email address of the student whom the conversation was assigned to.
-        * time_limit (optional, string or int): Time limit of the conversation (in minutes). Defaults to 5 minutes.
+        * time_limit (optional, string or number): Time limit of the conversation (in whole minutes). Defaults to 5 minutes.
+        * pregenerate (optional, bool): Whether the system prompt and the opening turn of the chatbot are generated ahead of time, in the background. Defaults to the PREGENERATE_OPENINGS setting.
 
         Returns (Response):
         The function returns the simple message "Ok" upon successful creation of the conversation.
@@ -34,11 +57,12 @@ def register_conversation_routes(
         topic = data.get("topic")
         teacher_email = data.get("teacher_email")
         student_email = data.get("student_email")
-        time_limit_temp = data.get("time_limit")
-        if isinstance(time_limit_temp, str) and time_limit_temp.isdigit():
-            time_limit = int(time_limit_temp)
-        else:
-            time_limit = time_limit_temp
+        time_limit = data.get("time_limit")
+        try:
+            # e.g. "10", "7.5" or 7.5 minutes
+            time_limit = int(float(time_limit))
+        except (TypeError, ValueError, OverflowError):
+            pass
 
         conversations_collection = db.get_collection("conversations")
         managed_conversations_collection = db.get_collection("managed_conversations")
@@ -54,6 +78,8 @@ def register_conversation_routes(
         managed_conversations_collection.create_managed_conversation(
             conversation_id=str(conv._id),
         )
+        if data.get("pregenerate", cbm.pregenerate_openings):
+            cbm.prepare_conversation(str(conv._id), db)
 
         return jsonify({"conversation_id": str(conv._id)})
 
@@ -76,6 +102,8 @@ def register_conversation_routes(
             conversations = conversations_collection.get_user_conversations(
                 user_email=user_email
             )
+            # The student is likely to start one of their open conversations soon
+            cbm.warm_up_student_conversations(user_email, conversations, db, logger)
             return jsonify(conversations)
         else:
             return make_response(400, "The user email was not specified.")
@@ -97,7 +125,10 @@ def register_conversation_routes(
                 conversation_id=conversation_id
             )
             conversation._id = str(conversation._id)
-            return jsonify(conversation)
+            # The system prompt stays on the server: the client only shows the opening turn
+            conversation_info = asdict(conversation)
+            del conversation_info["system_prompt"]
+            return jsonify(conversation_info)
         else:
             return make_response(400, "The conversation id was not specified.")
 
@@ -128,19 +159,30 @@ def register_conversation_routes(
         * conversation_id (required, string): The unique identifier of the conversation.
         * sender_id (required, string): The unique identifier of the user who sends the message.
         * message (required, string): The text message sent by the user.
+        * stream (optional, bool): Whether to stream the response as Server-Sent Events. Defaults to false.
+        * message_id (optional, string): Id of the message chosen by the client, the same when the message is sent again.
+          A message sent again gets the response of the first one. Defaults to the content of the message.
 
         Returns (Response):
         A JSON object with the following properties:
         * conversation_id (string): The conversation ID (same as the request parameter).
         * response (string): The chatbot's response to the user message.
+
+        If stream is true, the response is a "text/event-stream" made of "token" events, each carrying
+        a chunk of the chatbot's response, followed by a single "end" event carrying the JSON object above,
+        or by an "error" event if the chat model did not answer in time or the turn failed.
         """
         data = request.get_json()
         conversation_id = data.get("conversation_id")
         sender_id = data.get("sender_id")
         message = data.get("message")
+        message_id = data.get("message_id")
+
+        if data.get("stream", False):
+            return stream_user_chat_message(conversation_id, message, message_id)
 
         status_code, response = cbm.send_message_to_chatbot(
-            cid=conversation_id, message=message
+            cid=conversation_id, message=message, message_id=message_id
         )
 
         return make_response(
@@ -148,6 +190,52 @@ def register_conversation_routes(
             status_code,
         )
 
+    def stream_user_chat_message(conversation_id: str, message: str, message_id: str):
+        status_code, response = cbm.stream_message_to_chatbot(
+            cid=conversation_id, message=message, message_id=message_id
+        )
+        if status_code != 200:
+            return make_response(
+                jsonify({"conversation_id": conversation_id, "response": response}),
+                status_code,
+            )
+
+        def generate_events():
+            chunks = []
+            try:
+                for chunk in response:
+                    chunks.append(chunk)
+                    yield format_server_sent_event("token", {"token": chunk})
+            except LLMTimeoutError:
+                # The turn is not recorded: the client can send the message again
+                yield format_server_sent_event(
+                    "error",
+                    {"conversation_id": conversation_id, "response": CHATBOT_TIMEOUT_MESSAGE},
+                )
+                return
+            except Exception as exc:
+                # The headers are already sent: the error is reported in the stream, and the turn is not recorded
+                logger.log(
+                    Log(
+                        LogType.ERROR,
+                        f"Streamed turn of conversation {conversation_id} failed: {exc!r}",
+                    )
+                )
+                yield format_server_sent_event(
+                    "error",
+                    {"conversation_id": conversation_id, "response": CHATBOT_ERROR_MESSAGE},
+                )
+                return
+            yield format_server_sent_event(
+                "end", {"conversation_id": conversation_id, "response": "".join(chunks)}
+            )
+
+        return Response(
+            stream_with_context(generate_events()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     @app.route("/end-conversation/<conversation_id>", methods=["GET"])
     def end_conversation(conversation_id: str):
         """
@@ -196,6 +284,7 @@ def register_conversation_routes(
 
         Request Body:
             - conversation_id (str): The ID of the existing conversation to base the new conversation on.
+            - pregenerate (bool, optional): Whether the system prompt and the opening turn of the chatbot are generated ahead of time, in the background. Defaults to the PREGENERATE_OPENINGS setting.
 
         Returns:
             Response:
@@ -226,5 +315,7 @@ def register_conversation_routes(
         mcc.create_managed_conversation(
             conversation_id=str(conv_new._id),
         )
+        if data.get("pregenerate", cbm.pregenerate_openings):
+            cbm.prepare_conversation(str(conv_new._id), db)
 
         return jsonify({"conversation_id": str(conv_new._id)})
@@ -0,0 +1,158 @@
+import time
+
+from flask import Flask, Response, g, request
+
+from lib.llm import ChatbotManager
+from lib.metrics import Counter, Gauge, Histogram, REGISTRY
+
+HTTP_REQUESTS = Counter(
+    "teachme_http_requests_total",
+    "HTTP requests handled, by route, method and status code.",
+    ("route", "method", "status"),
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "teachme_http_request_duration_seconds",
+    "Duration of the HTTP requests, until the response headers for the streamed responses.",
+    ("route", "method"),
+)
+
+# Statistics of the chatbot manager, read when the metrics are scraped
+CHATBOT_MANAGER_GAUGES = {
+    ("chatbots",): Gauge("teachme_chatbots", "Chatbots held in memory."),
+    ("chatbots_memory",): Gauge(
+        "teachme_chatbots_memory_bytes", "Estimated memory of the chatbots held in memory."
+    ),
+    ("initializing",): Gauge("teachme_chatbots_initializing", "Chatbots being built."),
+    ("warm_chatbots",): Gauge(
+        "teachme_warm_chatbots", "Chatbots built ahead of time, waiting for their conversation to start."
+    ),
+    ("queued_turns",): Gauge(
+        "teachme_queued_turns", "Turns waiting behind the running turn of their conversation."
+    ),
+    ("deadlines", "deadlines"): Gauge(
+        "teachme_deadlines", "Idle and time limit deadlines scheduled."
+    ),
+    ("background", "workers"): Gauge(
+        "teachme_background_workers", "Workers of the background executor."
+    ),
+    ("background", "queued"): Gauge(
+        "teachme_background_queued_tasks", "Tasks waiting in the background executor."
+    ),
+    ("background", "in_flight"): Gauge(
+        "teachme_background_in_flight_tasks", "Tasks running in the background executor."
+    ),
+    ("llm_scheduler", "running"): Gauge(
+        "teachme_llm_scheduler_running_requests", "Requests to the chat model running."
+    ),
+    ("llm_scheduler", "available_tokens"): Gauge(
+        "teachme_llm_scheduler_available_tokens", "Tokens left in the budget of the LLM scheduler."
+    ),
+    ("llm_circuit_breaker", "open"): Gauge(
+        "teachme_llm_circuit_breaker_open", "Whether the circuit breaker of the chat model is open (1) or not (0)."
+    ),
+    ("jobs", "running"): Gauge("teachme_jobs_running", "Jobs running in this process."),
+    ("model_pool", "open_connections"): Gauge(
+        "teachme_model_pool_open_connections", "Open connections of the chat model pool."
+    ),
+}
+
+ANALYSIS_CACHE_HITS = Counter(
+    "teachme_analysis_cache_hits_total",
+    "Analyses served by the analysis cache, by source (memory or database).",
+    ("source",),
+)
+
+# Counts of the chatbot manager since the start of the process, read when the metrics are scraped
+CHATBOT_MANAGER_COUNTERS = {
+    ("evictions",): Counter(
+        "teachme_chatbot_evictions_total", "Chatbots evicted from memory."
+    ),
+    ("rehydrations",): Counter(
+        "teachme_chatbot_rehydrations_total", "Chatbots rebuilt from the database."
+    ),
+    ("warm_hits",): Counter(
+        "teachme_warm_chatbot_hits_total", "Conversations started with a chatbot built ahead of time."
+    ),
+    ("background", "submitted"): Counter(
+        "teachme_background_submitted_tasks_total", "Tasks submitted to the background executor."
+    ),
+    ("background", "failed"): Counter(
+        "teachme_background_failed_tasks_total", "Background tasks failed."
+    ),
+    ("background", "rejected"): Counter(
+        "teachme_background_rejected_tasks_total", "Background tasks rejected."
+    ),
+    ("analysis_cache", "hits"): ANALYSIS_CACHE_HITS.labels("memory"),
+    ("analysis_cache", "persistent_hits"): ANALYSIS_CACHE_HITS.labels("database"),
+    ("analysis_cache", "misses"): Counter(
+        "teachme_analysis_cache_misses_total", "Analyses missing from the analysis cache."
+    ),
+    ("llm_call_policy", "hedges"): Counter(
+        "teachme_llm_hedges_sent_total", "Hedge requests sent to the chat model."
+    ),
+    ("llm_call_policy", "timed_out"): Counter(
+        "teachme_llm_timed_out_requests_total", "Requests to the chat model aborted at their deadline."
+    ),
+    ("llm_circuit_breaker", "rejected"): Counter(
+        "teachme_llm_circuit_breaker_rejected_requests_total", "Requests to the chat model rejected by the circuit breaker."
+    ),
+    ("jobs", "completed"): Counter(
+        "teachme_jobs_completed_total", "Jobs completed by this process."
+    ),
+    ("jobs", "retried"): Counter(
+        "teachme_jobs_retried_total", "Failed job attempts scheduled for a retry by this process."
+    ),
+    ("jobs", "failed"): Counter(
+        "teachme_jobs_failed_total", "Jobs failed for good in this process."
+    ),
+    ("jobs", "deferred"): Counter(
+        "teachme_jobs_deferred_total", "Jobs deferred by this process while the chat model was unavailable."
+    ),
+}
+
+
+def _get_stat(stats: dict, path: tuple):
+    for key in path:
+        if not isinstance(stats, dict):
+            return None
+        stats = stats.get(key)
+    return stats
+
+
+def register_metrics_routes(app: Flask, cbm: ChatbotManager):
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started_at = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response: Response):
+        started_at = g.get("request_started_at")
+        if started_at is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        HTTP_REQUESTS.labels(route, request.method, response.status_code).inc()
+        HTTP_REQUEST_DURATION.labels(route, request.method).observe(
+            time.perf_counter() - started_at
+        )
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        """
+        Exposes the metrics of the application in the Prometheus text format: HTTP requests,
+        MongoDB operations, chat model requests and tokens, and the state of the chatbot manager.
+
+        Returns (Response):
+        The metrics, as text/plain.
+        """
+        stats = cbm.get_stats()
+        for path, gauge in CHATBOT_MANAGER_GAUGES.items():
+            value = _get_stat(stats, path)
+            if value is not None:
+                gauge.set(value)
+        for path, counter in CHATBOT_MANAGER_COUNTERS.items():
+            value = _get_stat(stats, path)
+            if value is not None:
+                counter.set_total(value)
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
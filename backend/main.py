@@ -2,7 +2,6 @@
 from os import getenv, system
 
 # dependency imports
-from dotenv import load_dotenv
 from flask import Flask
 from flask_cors import CORS
 
@@ -11,9 +10,7 @@ from lib.routes import *
 from lib.auth import AuthenticationService
 from lib.database import MongoDBConnector
 from lib.log import Logger
-from lib.llm import ChatbotManager
-
-load_dotenv()
+from services import JOB_QUEUE, create_chatbot_manager
 
 # services initialization
 
@@ -23,7 +20,15 @@ app_db_connector = MongoDBConnector(getenv("MONGODB_URI"))
 db = app_db_connector.connect("teachme_main")
 user_auth = AuthenticationService(db)
 logger = Logger(db)
-chatbot_manager = ChatbotManager(5000)
+chatbot_manager = create_chatbot_manager(db, logger)
+
+if JOB_QUEUE == "inprocess":
+    # Started by the first request rather than on import, so that only the processes serving
+    # requests run a job worker (e.g. not the parent process of the flask reloader)
+    @app.before_request
+    def start_job_worker():
+        chatbot_manager.start_job_worker()
+
 
 # route registration
 
@@ -31,6 +36,7 @@ register_auth_routes(app, user_auth)
 register_log_routes(app, db)
 register_user_routes(app, db, logger)
 register_conversation_routes(app, db, chatbot_manager, logger)
+register_metrics_routes(app, chatbot_manager)
 
 if __name__ == "__main__":
     chatbot_manager.start_heartbeat()
@@ -0,0 +1,158 @@
+"""
+Module containing the construction of the services shared by the web server (main.py) and the job
+worker processes (worker.py), configured by the environment. Building them starts no job worker.
+"""
+
+# stdlib imports
+import json
+from os import getenv
+
+# dependency imports
+from dotenv import load_dotenv
+
+# custom imports
+from lib.database import MongoDB
+from lib.log import Logger
+from lib.llm import (
+    AnalysisCache,
+    ChatbotManager,
+    CircuitBreaker,
+    ChatModelPool,
+    HistoryCompactionSettings,
+    JobQueue,
+    LLMCallPolicy,
+    LLMScheduler,
+)
+from lib.llm.PROMPTS import CONVERSATION_PROMPT_TYPE
+
+load_dotenv()
+
+# "inprocess": the web server runs the jobs, "external": only worker.py runs them, "off": no job queue
+JOB_QUEUE = getenv("JOB_QUEUE", "inprocess")
+
+
+def create_chatbot_manager(db: MongoDB, logger: Logger) -> ChatbotManager:
+    """
+    Create the chatbot manager configured by the environment. Its job worker is not started: the web
+    server starts it with JOB_QUEUE=inprocess, and worker.py runs it with JOB_QUEUE=external.
+
+    Args:
+        db (MongoDB): database instance containing the conversations data
+        logger (Logger): logger instance to log messages
+
+    Returns:
+        ChatbotManager: the chatbot manager
+    """
+    return ChatbotManager(
+        5000,
+        post_actions_mode=getenv("POST_ACTIONS_MODE", "parallel"),
+        background_workers=int(getenv("BACKGROUND_WORKERS", "8")),
+        background_queue_size=int(getenv("BACKGROUND_QUEUE_SIZE", "256")),
+        background_policy=getenv("BACKGROUND_POLICY", "reject"),
+        history_compaction=(
+            HistoryCompactionSettings(
+                window_turns=int(getenv("HISTORY_WINDOW_TURNS", "6")),
+                max_turns=int(getenv("HISTORY_MAX_TURNS", "12")),
+                max_tokens=int(getenv("HISTORY_MAX_TOKENS", "1500")),
+            )
+            if getenv("HISTORY_COMPACTION", "false").lower() == "true"
+            else None
+        ),
+        analysis_cache=AnalysisCache(
+            max_size=int(getenv("ANALYSIS_CACHE_SIZE", "10000")),
+            ttl=int(getenv("ANALYSIS_CACHE_TTL", str(7 * 24 * 60 * 60))),
+            collection=(
+                db.get_collection("analysis_cache")
+                if getenv("ANALYSIS_CACHE_PERSIST", "false").lower() == "true"
+                else None
+            ),
+        ),
+        model_pool=ChatModelPool(
+            api_key=getenv("OPENAI_API_KEY"),
+            max_connections=int(getenv("LLM_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            provider=getenv("LLM_PROVIDER", "openai"),
+            model_options=(
+                {
+                    "latency_distribution": getenv("FAKE_LLM_LATENCY_DISTRIBUTION", "constant"),
+                    "latency_mean": float(getenv("FAKE_LLM_LATENCY_MEAN", "0")),
+                    "latency_stddev": float(getenv("FAKE_LLM_LATENCY_STDDEV", "0")),
+                    # e.g. {"CONVERSATIONAL_SYSTEM_PROMPT": 2.5}
+                    "latency_mean_by_prompt": json.loads(
+                        getenv("FAKE_LLM_LATENCY_MEAN_BY_PROMPT", "{}")
+                    ),
+                    "tokens_per_second": (
+                        float(getenv("FAKE_LLM_TOKENS_PER_SECOND"))
+                        if getenv("FAKE_LLM_TOKENS_PER_SECOND")
+                        else None
+                    ),
+                    "error_rate": float(getenv("FAKE_LLM_ERROR_RATE", "0")),
+                    "seed": int(getenv("FAKE_LLM_SEED", "0")),
+                }
+                if getenv("LLM_PROVIDER", "openai") == "fake"
+                else None
+            ),
+        ),
+        llm_scheduler=LLMScheduler(
+            max_concurrency=(
+                int(getenv("LLM_MAX_CONCURRENCY")) if getenv("LLM_MAX_CONCURRENCY") else None
+            ),
+            tokens_per_minute=(
+                int(getenv("LLM_TOKENS_PER_MINUTE")) if getenv("LLM_TOKENS_PER_MINUTE") else None
+            ),
+            interactive_slots=int(getenv("LLM_INTERACTIVE_SLOTS", "1")),
+            interactive_token_share=float(getenv("LLM_INTERACTIVE_TOKEN_SHARE", "0.2")),
+        ),
+        llm_call_policy=LLMCallPolicy(
+            timeouts={
+                CONVERSATION_PROMPT_TYPE: float(getenv("LLM_INTERACTIVE_TIMEOUT", "30")),
+                **json.loads(getenv("LLM_TIMEOUTS", "{}")),
+            },
+            default_timeout=float(getenv("LLM_TIMEOUT", "120")),
+            hedge_percentile=(
+                float(getenv("LLM_HEDGE_PERCENTILE")) if getenv("LLM_HEDGE_PERCENTILE") else None
+            ),
+            hedge_budget=float(getenv("LLM_HEDGE_BUDGET", "0.05")),
+            # Caps the conversation turns running at the same time while hedging is enabled
+            hedge_workers=int(getenv("LLM_HEDGE_WORKERS", "64")),
+        ),
+        max_chatbots=int(getenv("MAX_CHATBOTS")) if getenv("MAX_CHATBOTS") else None,
+        max_chatbots_memory=(
+            int(getenv("MAX_CHATBOTS_MEMORY_MB")) * 1024 * 1024
+            if getenv("MAX_CHATBOTS_MEMORY_MB")
+            else None
+        ),
+        db=db,
+        logger=logger,
+        job_queue=(
+            JobQueue(
+                db.get_collection("jobs"),
+                lease_time=int(getenv("JOB_LEASE_TIME", "300")),
+                max_attempts=int(getenv("JOB_MAX_ATTEMPTS", "5")),
+                retry_delay=float(getenv("JOB_RETRY_DELAY", "5")),
+            )
+            if JOB_QUEUE != "off"
+            else None
+        ),
+        job_workers=int(getenv("JOB_WORKERS", "2")),
+        feedback_mode=getenv("FEEDBACK_MODE", "final"),
+        running_feedback_interval=int(getenv("RUNNING_FEEDBACK_INTERVAL", "3")),
+        pregenerate_openings=getenv("PREGENERATE_OPENINGS", "false").lower() == "true",
+        warmup_chatbots=int(getenv("WARMUP_CHATBOTS", "0")),
+        warmup_ttl=int(getenv("WARMUP_TTL", "600")),
+        llm_circuit_breaker=(
+            CircuitBreaker(
+                failure_rate_threshold=float(getenv("LLM_BREAKER_FAILURE_RATE", "0.5")),
+                slow_call_duration=float(getenv("LLM_BREAKER_SLOW_CALL_DURATION", "20")),
+                slow_call_rate_threshold=float(getenv("LLM_BREAKER_SLOW_CALL_RATE", "0.8")),
+                window=int(getenv("LLM_BREAKER_WINDOW", "20")),
+                min_calls=int(getenv("LLM_BREAKER_MIN_CALLS", "10")),
+                open_duration=float(getenv("LLM_BREAKER_OPEN_DURATION", "30")),
+                half_open_probes=int(getenv("LLM_BREAKER_PROBES", "3")),
+            )
+            if getenv("LLM_CIRCUIT_BREAKER", "true").lower() == "true"
+            else None
+        ),
+        duplicate_turn_ttl=int(getenv("DUPLICATE_TURN_TTL", "600")),
+        duplicate_content_ttl=int(getenv("DUPLICATE_CONTENT_TTL", "0")),
+    )
@@ -0,0 +1,23 @@
+"""
+Runs the jobs of the job queue (post-message analyses and final feedback) in a separate process,
+so that their throughput scales independently of the web server.
+
+Usage (from the backend folder, with the same environment as the web server):
+    JOB_QUEUE=external python3 worker.py
+
+With JOB_QUEUE=external the web server only enqueues the jobs. Any number of worker processes can
+run at the same time: each job is leased by a single worker.
+"""
+
+from os import getenv
+
+from lib.database import MongoDBConnector
+from lib.log import Logger
+from services import JOB_QUEUE, create_chatbot_manager
+
+if __name__ == "__main__":
+    if JOB_QUEUE == "off":
+        raise SystemExit("The job queue is disabled (JOB_QUEUE=off).")
+    db = MongoDBConnector(getenv("MONGODB_URI")).connect("teachme_main")
+    chatbot_manager = create_chatbot_manager(db, Logger(db))
+    chatbot_manager.job_worker.run_forever()
@@ -87,7 +87,12 @@ export default function ConversationPage() {
   // Begin Conversation
   const begin = () => {
     setIsStart(true);
-    setIsPlaying(false);
+    // Mimi opens the conversation if its first turn was prepared in advance
+    if (data && data["opening_message"]) {
+      activateMimi(data["opening_message"], userLevel);
+    } else {
+      setIsPlaying(false);
+    }
   };
 
   // Activate Mimi function